@@ -1,132 +1,45 @@
 from __future__ import division, print_function
 
 # coding=utf-8
-import os
-import torch
-import argparse
-import pickle
-from torchvision import transforms
-from model import EncoderCNN, DecoderRNN
-from PIL import Image
-import pathlib
+import io
+from batching import MicroBatcher
+from inference import ModelRegistry, caption_to_hashtags, get_args, load_image
 
 # Flask utils
-from flask import Flask, redirect, url_for, request, render_template
-from werkzeug.utils import secure_filename
+from flask import Flask, Request, redirect, url_for, request, render_template, abort
 from gevent.pywsgi import WSGIServer
 
+
+class InMemoryRequest(Request):
+    """Keep uploaded files in memory instead of spooling them to temp files."""
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        return io.BytesIO()
+
+
 # Define a flask app
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+# Uploads are held in memory, so cap their size
+app.config["MAX_CONTENT_LENGTH"] = 32 * 1024 * 1024
+
+# Model stays resident between requests; see inference.ModelRegistry
+registry = ModelRegistry(get_args())
 
-# Device configuration
-device = torch.device("cpu")
-BASE_DIR = pathlib.Path().resolve().parent
-
-
-def load_image(image_path, transform=None):
-    image = Image.open(image_path)
-    image = image.resize([224, 224], Image.LANCZOS)
-
-    if transform is not None:
-        image = transform(image).unsqueeze(0)
-
-    return image
-
-
-def process(args):
-    # Image preprocessing
-    transform = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
-        ]
-    )
-
-    # Load vocabulary wrapper
-    with open(args.vocab_path, "rb") as f:
-        vocab = pickle.load(f)
-
-    # Build models
-    encoder = EncoderCNN(
-        args.embed_size
-    ).eval()  # eval mode (batchnorm uses moving mean/variance)
-    decoder = DecoderRNN(args.embed_size, args.hidden_size, len(vocab), args.num_layers)
-    encoder = encoder.to(device)
-    decoder = decoder.to(device)
-
-    # Load the trained model parameters
-    encoder.load_state_dict(
-        torch.load(args.encoder_path, map_location=lambda storage, loc: storage)
-    )
-    decoder.load_state_dict(
-        torch.load(args.decoder_path, map_location=lambda storage, loc: storage)
-    )
-
-    # Prepare an image
-    image = load_image(args.image, transform)
-    image_tensor = image.to(device)
-
-    # Generate an caption from the image
-    feature = encoder(image_tensor)
-    sampled_ids = decoder.sample(feature)
-    sampled_ids = (
-        sampled_ids[0].cpu().numpy()
-    )  # (1, max_seq_length) -> (max_seq_length)
-
-    # Convert word_ids to words
-    sampled_caption = []
-    for word_id in sampled_ids:
-        word = vocab.idx2word[word_id]
-        sampled_caption.append(word)
-        if word == "<end>":
-            break
-    sentence = " ".join(sampled_caption)
-
-    return sentence
-    # plt.imshow(np.asarray(image))
-
-
-def predict(img_path):
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "--image", type=str, default=img_path, help="input image for generating caption"
-    )
-    parser.add_argument(
-        "--encoder_path",
-        type=str,
-        default=os.path.join(BASE_DIR, "encoder-40-330.ckpt"),
-        help="path for trained encoder",
-    )
-    parser.add_argument(
-        "--decoder_path",
-        type=str,
-        default=os.path.join(BASE_DIR, "decoder-40-330.ckpt"),
-        help="path for trained decoder",
-    )
-    parser.add_argument(
-        "--vocab_path",
-        type=str,
-        default=os.path.join(BASE_DIR, "publishmedia/vocab.pkl"),
-        help="path for vocabulary wrapper",
-    )
-
-    # Model parameters (should be same as paramters in train.py)
-    parser.add_argument(
-        "--embed_size",
-        type=int,
-        default=256,
-        help="dimension of word embedding vectors",
-    )
-    parser.add_argument(
-        "--hidden_size", type=int, default=512, help="dimension of lstm hidden states"
-    )
-    parser.add_argument(
-        "--num_layers", type=int, default=2, help="number of layers in lstm"
-    )
-    args = parser.parse_args()
-    predicted_caption = process(args)
-
-    return predicted_caption
+# Concurrent requests share one encoder/decoder pass; see batching.MicroBatcher
+batcher = MicroBatcher(
+    registry,
+    max_batch_size=registry.args.max_batch_size,
+    max_wait_ms=registry.args.max_wait_ms,
+)
+
+
+def predict(image_file):
+    """Caption an image given as a path or a file object."""
+    image = load_image(image_file, registry.get().transform)
+    return batcher.caption(image)
 
 
 @app.route("/", methods=["GET"])
@@ -141,27 +54,43 @@ def upload():
         # Get the file from post request
         f = request.files["file"]
 
-        # Save the file to input/
-        basepath = os.path.dirname(__file__)
-        file_path = os.path.join(basepath, "input", secure_filename(f.filename))
-        f.save(file_path)
-
-        # Make prediction
-        preds = predict(file_path)
-        hashtags_list = preds.split(" ")
-        hashtags_list.remove("<start>")
-        hashtags_list.remove("<end>")
-        tags = []
-        for tag in hashtags_list:
-            if tag not in tags:
-                tags.append(tag)
-        text = ""
-        for tag in tags:
-            text = text + "  #" + str(tag)
-        text = " " + text
-        return text
+        # Make prediction straight from the uploaded bytes
+        preds = predict(f.stream)
+        return caption_to_hashtags(preds)
     return None
 
 
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Counters of the batcher and the encoder feature cache."""
+    cache = registry.feature_cache
+    return {
+        "model_version": registry.version,
+        "batches": batcher.batches,
+        "images": batcher.images,
+        "feature_cache": cache.stats() if cache is not None else None,
+    }
+
+
+@app.route("/reload", methods=["POST"])
+def reload():
+    """Swap in new checkpoints without restarting the server."""
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(403)
+    overrides = {
+        "encoder_path": request.form.get("encoder_path"),
+        "decoder_path": request.form.get("decoder_path"),
+        "vocab_path": request.form.get("vocab_path"),
+    }
+    # Set by serve.py: every worker has to reload, not only this one.
+    handler = app.config.get("RELOAD_HANDLER")
+    if handler is not None:
+        return handler(overrides), 202
+    version = registry.reload(**overrides)
+    return {"version": version}
+
+
 if __name__ == "__main__":
+    if registry.args.eager_load:
+        registry.get()
     app.run(debug=True)
@@ -0,0 +1,237 @@
+"""Concurrent Instagram publishing on asyncio.
+
+publish_content() in posting_content.py walks every Graph API call one after
+another. Here every independent container is created at the same time, the
+status of all pending containers is fetched in one request per round (with
+the same backoff as status_poller.StatusPoller), and each container is
+published the moment it reports FINISHED.
+"""
+import asyncio
+import os
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+from posting_content import CAROUSEL_MAX_ITEMS
+from utils import getCreds, recordUsage
+from status_poller import backoffIntervals
+
+load_dotenv()
+
+TERMINAL_ERRORS = ("ERROR", "EXPIRED")
+
+
+class PublishError(RuntimeError):
+    """A Graph API call returned an error payload."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+async def makeApiCallAsync(session, url, endpointParams, type):
+    """Async counterpart of utils.makeApiCall.
+
+    Args:
+            session: aiohttp.ClientSession to send the request with
+            url: string of the url endpoint to make request from
+            endpointParams: dictionary keyed by the names of the url parameters
+            type: "POST" or "GET"
+
+    Returns:
+            object: json data from the endpoint
+
+    """
+    if type == "POST":
+        request = session.post(url, data=endpointParams)
+    else:
+        request = session.get(url, params=endpointParams)
+    async with request as data:
+        recordUsage(data.headers)
+        json_data = await data.json(content_type=None)
+    if "error" in json_data:
+        raise PublishError(
+            json_data["error"].get("message", json_data["error"]), json_data["error"].get("code")
+        )
+    return json_data
+
+
+async def createContainer(session, params, post, is_carousel_item=False):
+    """Create an image, video or carousel-child container; returns its id."""
+    url = params["endpoint_base"] + params["instagram_account_id"] + "/media"
+
+    endpointParams = dict()
+    endpointParams["access_token"] = params["access_token"]
+    if is_carousel_item:
+        endpointParams["is_carousel_item"] = "true"
+    else:
+        endpointParams["caption"] = post.get("caption", "")
+
+    if post.get("media_type", "IMAGE") == "IMAGE":
+        endpointParams["image_url"] = post["media_url"]
+    else:
+        endpointParams["media_type"] = post["media_type"]
+        endpointParams["video_url"] = post["media_url"]
+
+    return (await makeApiCallAsync(session, url, endpointParams, "POST"))["id"]
+
+
+async def createCarousel(session, params, post):
+    """Create all children of a carousel concurrently, then its container."""
+    if not 2 <= len(post["media_urls"]) <= CAROUSEL_MAX_ITEMS:
+        raise PublishError(
+            "A carousel needs 2 to {} items, got {}".format(CAROUSEL_MAX_ITEMS, len(post["media_urls"]))
+        )
+    children = [
+        {"media_type": post.get("child_media_type", "IMAGE"), "media_url": media_url}
+        for media_url in post["media_urls"]
+    ]
+    child_ids = await asyncio.gather(
+        *(createContainer(session, params, child, True) for child in children)
+    )
+
+    url = params["endpoint_base"] + params["instagram_account_id"] + "/media"
+    endpointParams = dict()
+    endpointParams["caption"] = post.get("caption", "")
+    endpointParams["media_type"] = "CAROUSEL"
+    endpointParams["children"] = ",".join(child_ids)
+    endpointParams["access_token"] = params["access_token"]
+    return (await makeApiCallAsync(session, url, endpointParams, "POST"))["id"]
+
+
+async def getStatuses(session, params, container_ids):
+    """Status codes of several containers in one request, keyed by id."""
+    url = params["endpoint_base"]
+
+    endpointParams = dict()
+    endpointParams["ids"] = ",".join(container_ids)
+    endpointParams["fields"] = "status_code"
+    endpointParams["access_token"] = params["access_token"]
+    json_data = await makeApiCallAsync(session, url, endpointParams, "GET")
+    return {key: data.get("status_code") for key, data in json_data.items()}
+
+
+async def publishContainer(session, params, container_id):
+    url = params["endpoint_base"] + params["instagram_account_id"] + "/media_publish"
+
+    endpointParams = dict()
+    endpointParams["creation_id"] = container_id
+    endpointParams["access_token"] = params["access_token"]
+    return (await makeApiCallAsync(session, url, endpointParams, "POST"))["id"]
+
+
+async def publishPosts(posts, params, initial_interval=0.5, max_interval=10.0, session=None,
+                       timeout=300.0):
+    """Publish several posts concurrently.
+
+    Args:
+            posts: list of dictionaries with "caption" and either "media_url"
+                (plus "media_type", default IMAGE) or "media_urls" with
+                "media_type" CAROUSEL
+            params: credentials from utils.getCreds()
+            initial_interval: seconds before the second status round; later
+                rounds back off exponentially up to max_interval
+            max_interval: longest wait between status rounds
+            session: optional aiohttp.ClientSession to reuse
+            timeout: seconds after which containers that are still
+                processing are given up on and reported as FAILED
+
+    Returns:
+            list: one result dictionary per post with "container_id",
+                "media_id", "status" and "elapsed" (seconds) or "error"
+                (and "error_code" when publishing was refused)
+
+    """
+    if session is None:
+        async with aiohttp.ClientSession() as session:
+            return await publishPosts(
+                posts, params, initial_interval, max_interval, session, timeout
+            )
+
+    start = time.perf_counter()
+    results = [dict() for _ in posts]
+
+    async def create(post):
+        if post.get("media_type") == "CAROUSEL":
+            return await createCarousel(session, params, post)
+        return await createContainer(session, params, post)
+
+    created = await asyncio.gather(*(create(post) for post in posts), return_exceptions=True)
+    pending = dict()  # container id -> index into posts
+    for index, container_id in enumerate(created):
+        if isinstance(container_id, Exception):
+            results[index].update(status="FAILED", error=str(container_id))
+        else:
+            results[index]["container_id"] = container_id
+            pending[container_id] = index
+
+    async def publish(container_id, index):
+        try:
+            results[index]["media_id"] = await publishContainer(session, params, container_id)
+            results[index]["status"] = "PUBLISHED"
+        except PublishError as e:
+            results[index].update(status="FAILED", error=str(e), error_code=e.code)
+        results[index]["elapsed"] = time.perf_counter() - start
+
+    publishing = []
+    last_status = dict()  # container id -> status of the latest round
+    intervals = backoffIntervals(initial_interval, max_interval)
+    while pending:
+        try:
+            statuses = await getStatuses(session, params, list(pending))
+        except (PublishError, aiohttp.ClientError) as e:
+            statuses = dict.fromkeys(pending, e)
+        for container_id in list(pending):
+            status = statuses.get(container_id)
+            if status is None:
+                index = pending.pop(container_id)
+                results[index].update(
+                    status="FAILED", error="No status returned for container " + container_id
+                )
+            elif isinstance(status, Exception) or status in TERMINAL_ERRORS:
+                index = pending.pop(container_id)
+                results[index].update(status="FAILED", error=str(status))
+            elif status == "FINISHED":
+                index = pending.pop(container_id)
+                publishing.append(asyncio.ensure_future(publish(container_id, index)))
+            else:
+                last_status[container_id] = status
+        remaining = timeout - (time.perf_counter() - start)
+        if pending and remaining <= 0:
+            for container_id, index in pending.items():
+                results[index].update(
+                    status="FAILED",
+                    error="Still {} after {}s".format(last_status[container_id], timeout),
+                )
+            pending.clear()
+        if pending:
+            await asyncio.sleep(min(next(intervals), remaining))
+
+    await asyncio.gather(*publishing)
+    return results
+
+
+def publish_content_async(text, initial_interval=0.5):
+    """Asyncio version of posting_content.publish_content.
+
+    Publishes the MEDIA_URL post and the MEDIA_URL_1/MEDIA_URL_2 carousel
+    configured in the environment concurrently.
+    """
+    params = getCreds()
+    caption = os.environ.get("CAPTION") + text
+    posts = [
+        {
+            "media_type": os.environ.get("MEDIA_TYPE"),
+            "media_url": os.environ.get("MEDIA_URL"),
+            "caption": caption,
+        },
+        {
+            "media_type": "CAROUSEL",
+            "media_urls": [os.environ.get("MEDIA_URL_1"), os.environ.get("MEDIA_URL_2")],
+            "caption": "Default",
+        },
+    ]
+    results = asyncio.run(publishPosts(posts, params, initial_interval))
+    for result in results:
+        print(f"\n---- PUBLISH RESULT -----\n\tResponse:{result}")
+    return results
@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent caption requests into batched model calls.
+
+    Callers submit one preprocessed image at a time and get a Future back.
+    A single worker thread waits for the first request, then keeps collecting
+    until it has max_batch_size images or max_wait_ms have passed, runs the
+    whole group through the encoder and decoder at once and resolves each
+    Future with its own caption.
+    """
+
+    def __init__(self, registry, max_batch_size=8, max_wait_ms=10):
+        """Set up the queue; the worker thread starts on the first submit.
+
+        Args:
+            registry: inference.ModelRegistry serving the live model.
+            max_batch_size: largest number of images run in one pass.
+            max_wait_ms: how long the first request of a batch may wait for
+                company before the batch is run anyway.
+        """
+        self.registry = registry
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.images = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker thread if it is not running yet."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="caption-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Finish the queued requests and stop the worker thread."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def submit(self, image):
+        """Queue one image for captioning.
+
+        Args:
+            image: tensor of shape (3, 224, 224) or (1, 3, 224, 224).
+
+        Returns:
+            Future: resolves to the caption string.
+        """
+        if image.dim() == 4:
+            image = image.squeeze(0)
+        future = Future()
+        self.start()
+        self._queue.put((image, future))
+        return future
+
+    def caption(self, image):
+        """Caption one image, blocking until its batch has run."""
+        return self.submit(image).result()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Let the outer loop see the stop marker after this batch.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = self._collect(item)
+            futures = [future for _, future in batch]
+            try:
+                images = torch.stack([image for image, _ in batch], 0)
+                captions = self.registry.get().caption_images(images)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.images += len(batch)
+            for future, caption in zip(futures, captions):
+                future.set_result(caption)
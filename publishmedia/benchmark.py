@@ -0,0 +1,1091 @@
+"""Micro-benchmarks for the captioning and publishing paths.
+
+Each sub command prints a small table; run with --help for the options.
+"""
+import argparse
+import time
+
+import numpy as np
+
+
+def percentiles(samples):
+    """Return (p50, p99) of a list of durations in milliseconds."""
+    samples = np.asarray(samples) * 1000.0
+    return np.percentile(samples, 50), np.percentile(samples, 99)
+
+
+def report(name, samples):
+    p50, p99 = percentiles(samples)
+    print("{:<24} n={:<5} p50={:9.2f}ms p99={:9.2f}ms".format(name, len(samples), p50, p99))
+
+
+def bench_latency(args):
+    """Per-request latency of reloading the model every call vs. keeping it warm."""
+    from inference import CaptionModel, ModelRegistry, get_args
+
+    model_args = get_args(args.model_args)
+
+    cold = []
+    for _ in range(args.cold_repeats):
+        start = time.perf_counter()
+        CaptionModel(model_args).caption(args.image)
+        cold.append(time.perf_counter() - start)
+    report("reload per request", cold)
+
+    registry = ModelRegistry(model_args)
+    registry.get()
+    warm = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        registry.get().caption(args.image)
+        warm.append(time.perf_counter() - start)
+    report("resident model", warm)
+
+
+def bench_batching(args):
+    """Throughput and latency of the micro-batcher for several batch/wait settings."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from batching import MicroBatcher
+    from inference import ModelRegistry, get_args, load_image
+
+    registry = ModelRegistry(get_args(args.model_args))
+    image = load_image(args.image, registry.get().transform)
+
+    print(
+        "{:>5} {:>8} {:>11} {:>10} {:>10} {:>10}".format(
+            "batch", "wait_ms", "images/sec", "p50_ms", "p99_ms", "avg_batch"
+        )
+    )
+    for batch_size in args.batch_sizes:
+        for wait_ms in args.wait_ms:
+            batcher = MicroBatcher(registry, batch_size, wait_ms)
+            batcher.caption(image)  # warm up
+            batcher.batches = batcher.images = 0
+
+            def timed_request(_):
+                start = time.perf_counter()
+                batcher.caption(image)
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                samples = list(pool.map(timed_request, range(args.requests)))
+            elapsed = time.perf_counter() - start
+            batcher.stop()
+
+            p50, p99 = percentiles(samples)
+            print(
+                "{:>5} {:>8} {:>11.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                    batch_size,
+                    wait_ms,
+                    args.requests / elapsed,
+                    p50,
+                    p99,
+                    batcher.images / max(batcher.batches, 1),
+                )
+            )
+
+
+def load_batch(model, image_paths, batch_size):
+    """Stack image files into one batch, repeating them to fill batch_size."""
+    import torch
+
+    from inference import load_image
+
+    images = [load_image(path, model.transform) for path in image_paths]
+    images = [images[i % len(images)] for i in range(batch_size)]
+    return torch.cat(images, 0)
+
+
+def bench_decoding(args):
+    """Fixed-length greedy decoding vs. early exit with batch compaction."""
+    import torch
+
+    from inference import ModelRegistry, get_args
+
+    model = ModelRegistry(get_args(args.model_args)).get()
+    decoder = model.decoder
+    with torch.inference_mode():
+        features = model.encoder(load_batch(model, args.images, args.batch_size))
+
+        full, early = [], []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            sampled_ids = decoder.sample(features)
+            full.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            early_ids, lengths = decoder.sample_early_exit(features, model.end_id)
+            early.append(time.perf_counter() - start)
+
+    # Both decoders must agree on every caption up to its end token.
+    for row, early_row, length in zip(sampled_ids, early_ids, lengths):
+        assert torch.equal(row[:length], early_row[:length])
+
+    batch_size = features.size(0)
+    print("lstm steps:     {} -> {}".format(sampled_ids.size(1), early_ids.size(1)))
+    print(
+        "row-steps:      {} -> {}".format(
+            batch_size * sampled_ids.size(1), int(lengths.sum())
+        )
+    )
+    print("mean length:    {:.2f}".format(lengths.float().mean().item()))
+    report("fixed length", full)
+    report("early exit", early)
+
+
+def bench_decoders(args):
+    """Captions/sec of greedy search, beam search and top-k/nucleus sampling."""
+    import torch
+
+    from inference import ModelRegistry, get_args
+
+    model = ModelRegistry(get_args(args.model_args)).get()
+    decoder = model.decoder
+    decoders = [("greedy", lambda f: decoder.sample_early_exit(f, model.end_id))]
+    for width in args.beam_widths:
+        decoders.append(
+            (
+                "beam k={}".format(width),
+                lambda f, width=width: decoder.beam_search(f, model.end_id, width),
+            )
+        )
+    decoders.append(
+        (
+            "top_k={} top_p={}".format(args.top_k, args.top_p),
+            lambda f: decoder.sample_top_k(f, model.end_id, args.top_k, args.top_p),
+        )
+    )
+
+    with torch.inference_mode():
+        features = model.encoder(load_batch(model, args.images, args.batch_size))
+        for name, decode in decoders:
+            samples = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                sampled_ids, lengths = decode(features)
+                samples.append(time.perf_counter() - start)
+            print(
+                "{:<24} {:>10.1f} captions/sec   e.g. {}".format(
+                    name,
+                    features.size(0) / np.mean(samples),
+                    model.decode(sampled_ids[:1], lengths[:1])[0],
+                )
+            )
+
+
+def module_bytes(module):
+    """Serialized size of a module's weights."""
+    import io
+
+    import torch
+
+    buffer = io.BytesIO()
+    if isinstance(module, torch.jit.ScriptModule):
+        torch.jit.save(module, buffer)
+    else:
+        torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+def bench_optimize(args):
+    """Latency, throughput, weight size and caption agreement per --optimize mode."""
+    import torch
+
+    from inference import CaptionModel, get_args
+    from optimize import MODES
+
+    reference = None
+    print(
+        "{:<9} {:>9} {:>9} {:>11} {:>9} {:>10}".format(
+            "mode", "p50_ms", "p99_ms", "images/sec", "MB", "agreement"
+        )
+    )
+    for mode in args.modes or MODES:
+        model = CaptionModel(get_args(args.model_args + ["--optimize", mode]))
+        images = load_batch(model, args.images, args.batch_size)
+
+        samples = []
+        for i in range(args.repeats):
+            start = time.perf_counter()
+            model.caption_images(images[i % len(images)].unsqueeze(0))
+            samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        captions = model.caption_images(images)
+        throughput = len(images) / (time.perf_counter() - start)
+
+        if reference is None:
+            reference = captions
+        agreement = np.mean([a == b for a, b in zip(captions, reference)])
+        size = module_bytes(model.encoder) + module_bytes(model.decoder)
+        p50, p99 = percentiles(samples)
+        print(
+            "{:<9} {:>9.2f} {:>9.2f} {:>11.2f} {:>9.1f} {:>9.0%}".format(
+                mode, p50, p99, throughput, size / 2.0 ** 20, agreement
+            )
+        )
+
+
+def run_backbone(backbone, embed_size, batch_size, repeats):
+    """Time one backbone in a fresh process; returns (images/sec, peak RSS MB)."""
+    import resource
+
+    import torch
+
+    from model import EncoderCNN
+
+    encoder = EncoderCNN(embed_size, backbone, pretrained=False).eval()
+    images = torch.randn(batch_size, 3, 224, 224)
+    with torch.inference_mode():
+        encoder(images)  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            encoder(images)
+        elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return batch_size * repeats / elapsed, peak_kb / 1024.0
+
+
+def bench_backbones(args):
+    """Encoder images/sec and peak RSS for each backbone in model.BACKBONES."""
+    import multiprocessing
+
+    from model import BACKBONES
+
+    context = multiprocessing.get_context("spawn")
+    print("{:<20} {:>11} {:>9}".format("backbone", "images/sec", "RSS_MB"))
+    for backbone in args.backbones or sorted(BACKBONES):
+        with context.Pool(1) as pool:
+            images_per_sec, rss = pool.apply(
+                run_backbone,
+                (backbone, args.embed_size, args.batch_size, args.repeats),
+            )
+        print("{:<20} {:>11.2f} {:>9.0f}".format(backbone, images_per_sec, rss))
+
+
+def wait_for_server(url, timeout=600):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.5)
+    raise RuntimeError("Server at {} did not come up".format(url))
+
+
+def load_test(url, image, concurrency, num_requests):
+    """Fire num_requests uploads from concurrency threads; returns (req/sec, samples)."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    with open(image, "rb") as f:
+        payload = f.read()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def timed_request(_):
+        start = time.perf_counter()
+        response = session.post(url, files={"file": ("image.jpg", payload)})
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        samples = list(pool.map(timed_request, range(num_requests)))
+    return num_requests / (time.perf_counter() - start), samples
+
+
+def bench_loadtest(args):
+    """Requests/sec of serve.py for each worker count (or of a running --url)."""
+    import signal
+    import subprocess
+    import sys
+
+    print("{:>7} {:>9} {:>9} {:>9}".format("workers", "req/sec", "p50_ms", "p99_ms"))
+    if args.url:
+        throughput, samples = load_test(args.url, args.image, args.concurrency, args.requests)
+        print("{:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format("-", throughput, *percentiles(samples)))
+        return
+
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    for workers in args.workers:
+        server = subprocess.Popen(
+            [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(args.port),
+             "--workers", str(workers)] + args.model_args
+        )
+        try:
+            wait_for_server(base_url + "/")
+            load_test(base_url + "/predict", args.image, workers, workers)  # warm up
+            throughput, samples = load_test(
+                base_url + "/predict", args.image, args.concurrency, args.requests
+            )
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        print("{:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(workers, throughput, *percentiles(samples)))
+
+
+def fake_graph_env(api):
+    """Point the .env driven publishing code at a FakeGraphAPI."""
+    import os
+
+    creds = api.creds()
+    os.environ.update(
+        GRAPH_DOMAIN=creds["graph_domain"],
+        GRAPH_VERSION=creds["graph_version"],
+        ACCESS_TOKEN=creds["access_token"],
+        INSTAGRAM_ACCOUNT_ID=creds["instagram_account_id"],
+        MEDIA_TYPE="IMAGE",
+        MEDIA_URL="https://example.com/image.jpg",
+        MEDIA_URL_1="https://example.com/image_1.jpg",
+        MEDIA_URL_2="https://example.com/image_2.jpg",
+        CAPTION="benchmark",
+    )
+
+
+def bench_publish(args):
+    """End-to-end time of publish_content vs. the asyncio engine on a fake Graph API."""
+    import contextlib
+    import io
+
+    from fake_graph_api import FakeGraphAPI
+
+    with FakeGraphAPI(latency=args.latency_ms / 1000.0,
+                      processing_time=args.processing_time) as api:
+        fake_graph_env(api)
+
+        from async_publishing import publish_content_async
+        from posting_content import publish_content
+
+        for name, publish in [("publish_content", publish_content),
+                              ("publish_content_async", publish_content_async)]:
+            samples = []
+            for _ in range(args.repeats):
+                calls = api.calls
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    publish(" #benchmark")
+                samples.append(time.perf_counter() - start)
+            print(
+                "{:<24} {:>8.2f}s per run (2 posts) {:>4} api calls".format(
+                    name, np.mean(samples), api.calls - calls
+                )
+            )
+
+
+def bench_api(args):
+    """Per-call latency of bare requests vs. the pooled session and batch calls."""
+    import requests
+
+    import utils
+    from fake_graph_api import FakeGraphAPI
+
+    with FakeGraphAPI(latency=args.latency_ms / 1000.0, processing_time=0) as api:
+        params = api.creds()
+        url = params["endpoint_base"] + params["instagram_account_id"] + "/media"
+        container_id = requests.post(
+            url, {"image_url": "https://example.com/a.jpg", "access_token": "x"}
+        ).json()["id"]
+        status_url = params["endpoint_base"] + container_id
+        endpointParams = {"fields": "status_code", "access_token": params["access_token"]}
+
+        samples = []
+        for _ in range(args.calls):
+            start = time.perf_counter()
+            requests.get(status_url, endpointParams).json()
+            samples.append(time.perf_counter() - start)
+        report("new connection", samples)
+
+        utils.configureSession()
+        samples = []
+        for _ in range(args.calls):
+            start = time.perf_counter()
+            utils.makeApiCall(status_url, endpointParams, "GET")
+            samples.append(time.perf_counter() - start)
+        report("pooled session", samples)
+
+        calls = [(status_url, endpointParams, "GET")] * args.calls
+        start = time.perf_counter()
+        utils.makeBatchApiCall(calls, params)
+        per_call = (time.perf_counter() - start) / args.calls
+        print("{:<24} {:.2f}ms per call".format("batch of {}".format(args.calls), per_call * 1000))
+
+
+def bench_carousel(args):
+    """Wall time to publish one carousel with children created serially vs. concurrently."""
+    from fake_graph_api import FakeGraphAPI
+    from posting_content import publishCarousel
+    from status_poller import StatusPoller
+
+    with FakeGraphAPI(latency=args.latency_ms / 1000.0,
+                      processing_time=args.processing_time) as api:
+        params = api.creds()
+        params["media_type"] = "IMAGE"
+        params["media_urls"] = [
+            "https://example.com/image_{}.jpg".format(i) for i in range(args.items)
+        ]
+        for name, max_workers in [("serial", 1), ("concurrent", args.items)]:
+            samples = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                publishCarousel(params, max_workers, StatusPoller(params, initial_interval=0.25))
+                samples.append(time.perf_counter() - start)
+            print("{:<12} {:>8.2f}s per {}-item carousel".format(name, np.mean(samples), args.items))
+
+
+def bench_queue(args):
+    """Enqueue/claim throughput of the SQLite job queue, then a full drain on a fake Graph API."""
+    import os
+    import tempfile
+
+    from fake_graph_api import FakeGraphAPI
+    from job_queue import PUBLISHED, JobQueue, work
+
+    def post(i):
+        return {"media_url": "https://example.com/{}.jpg".format(i), "caption": str(i)}
+
+    jobs = JobQueue(os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+    n = args.jobs
+    start = time.perf_counter()
+    for i in range(n):
+        jobs.enqueue(post(i), "account")
+    print("{:<28} {:>10.0f} jobs/s".format("enqueue one by one", n / (time.perf_counter() - start)))
+    start = time.perf_counter()
+    for offset in range(n, 2 * n, args.batch_size):
+        jobs.enqueue_many([post(i) for i in range(offset, min(offset + args.batch_size, 2 * n))], "account")
+    print("{:<28} {:>10.0f} jobs/s".format(
+        "enqueue batches of {}".format(args.batch_size), n / (time.perf_counter() - start)
+    ))
+    start = time.perf_counter()
+    duplicates = jobs.enqueue_many([post(i) for i in range(n)], "account")
+    assert not any(added for _, added in duplicates)
+    print("{:<28} {:>10.0f} jobs/s".format("re-enqueue (all duplicates)", n / (time.perf_counter() - start)))
+
+    for name, limit in [("claim + advance one", 1), ("claim + advance batch", args.batch_size)]:
+        start = time.perf_counter()
+        done = 0
+        while done < n:
+            claimed = jobs.claim("bench", limit)
+            for job in claimed:
+                jobs.advance(job, PUBLISHED)
+            done += len(claimed)
+        print("{:<28} {:>10.0f} jobs/s".format(name, n / (time.perf_counter() - start)))
+
+    with FakeGraphAPI(latency=args.latency_ms / 1000.0, processing_time=args.processing_time,
+                      quota_total=10 ** 9) as api:
+        jobs = JobQueue(os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+        jobs.enqueue_many([post(i) for i in range(args.publish_jobs)], "account")
+        start = time.perf_counter()
+        stats = work(jobs, api.creds(), args.workers, idle_wait=0.05)
+        elapsed = time.perf_counter() - start
+        print("{:<28} {:>10.1f} posts/s {} ({} api calls)".format(
+            "publish {} posts".format(args.publish_jobs), args.publish_jobs / elapsed, stats, api.calls
+        ))
+
+
+def bench_fb(args):
+    """Per-post Facebook latency: page lookups on every post vs. the cached page list."""
+    from fake_graph_api import FakeGraphAPI
+    from fb_pages import PageCache
+    from posting_content import (
+        get_fb_user_id,
+        get_list_of_all_pages,
+        get_page_access_token_from_user_access_token,
+        upload_post_to_fb,
+    )
+
+    with FakeGraphAPI(latency=args.latency_ms / 1000.0, pages=args.pages) as api:
+        params = api.creds()
+        params["media_type"] = "IMAGE"
+        params["media_url"] = "https://example.com/image.jpg"
+
+        def lookup_every_post():
+            user_id = get_fb_user_id(params)["json_data"]["id"]
+            page_id = get_list_of_all_pages(user_id, params)["json_data"]["data"][0]["id"]
+            token = get_page_access_token_from_user_access_token(params, page_id)["json_data"]["access_token"]
+            upload_post_to_fb(params, page_id, token)
+
+        cache = PageCache(params, path=None)
+        cache.pages()
+        for name, publish in [("lookups, first page", lookup_every_post),
+                              ("cached, all {} pages".format(args.pages), lambda: cache.publish(params))]:
+            samples = []
+            calls = api.calls
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                publish()
+                samples.append(time.perf_counter() - start)
+            p50, p99 = percentiles(samples)
+            print("{:<24} p50={:8.2f}ms p99={:8.2f}ms {:>5.1f} api calls per post".format(
+                name, p50, p99, (api.calls - calls) / args.repeats
+            ))
+
+        api.rotate_page_tokens()
+        results = cache.publish(params)
+        print("after token rotation: {} of {} pages posted, {} page list fetches".format(
+            sum("id" in data for data in results.values()), args.pages, cache.fetches
+        ))
+
+
+def bench_pipeline(args):
+    """Caption-and-publish of a folder: one image at a time vs. the overlapped pipeline."""
+    import os
+    import shutil
+    import tempfile
+
+    from fake_graph_api import FakeGraphAPI
+    from inference import ModelRegistry, get_args
+    from pipeline import Pipeline, format_metrics, graph_publisher, iter_images
+
+    folder = tempfile.mkdtemp()
+    for i in range(args.count):
+        source = args.images[i % len(args.images)]
+        shutil.copy(source, os.path.join(folder, "{:05d}{}".format(i, os.path.splitext(source)[1])))
+    paths = list(iter_images(folder))
+
+    registry = ModelRegistry(get_args(args.model_args))
+    model = registry.get()
+    with FakeGraphAPI(latency=args.latency_ms / 1000.0, processing_time=args.processing_time,
+                      quota_total=10 ** 9) as api:
+        publish = graph_publisher(api.creds(), "https://example.com/", initial_interval=0.25)
+
+        start = time.perf_counter()
+        for path in paths:
+            publish(path, model.caption(path))
+        print("{:<12} {:>8.2f}s for {} images".format("sequential", time.perf_counter() - start, len(paths)))
+
+        pipeline = Pipeline(registry, publish, args.batch_size, args.queue_size,
+                            publishers=args.publishers, caption_prefix="")
+        results, metrics = pipeline.run(paths)
+        print("{:<12} {:>8.2f}s for {} images".format("pipeline", metrics["wall"], len(results)))
+        print(format_metrics(metrics))
+    shutil.rmtree(folder)
+
+
+def synthetic_coco(folder, captions, images, image_size=64, seed=0):
+    """Annotation file and images shaped like the training data, made up from vocab.pkl words.
+
+    Returns:
+        (image root, annotation file path, vocabulary)
+    """
+    import os
+    import pickle
+
+    from PIL import Image
+
+    with open("vocab.pkl", "rb") as f:
+        vocab = pickle.load(f)
+    rng = np.random.RandomState(seed)
+    words = [vocab.idx2word[i] for i in range(4, len(vocab))]
+    root = os.path.join(folder, "images")
+    os.makedirs(root, exist_ok=True)
+    for i in range(images):
+        pixels = rng.randint(0, 255, (image_size, image_size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(root, "cat_{}.jpg".format(i)))
+    annotations = {}
+    for i in range(captions):
+        length = int(np.clip(rng.normal(11, 4), 3, 40))
+        caption = " ".join(words[j] for j in rng.randint(0, len(words), length)) + "."
+        annotations[str(i)] = ["cat", "{}.jpg".format(rng.randint(images)), caption]
+    json_path = os.path.join(folder, "captions.txt")
+    with open(json_path, "w") as f:
+        f.write(repr(annotations))
+    return root, json_path, vocab
+
+
+def rss_mb():
+    import os
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def bench_dataset(args):
+    """Dataset startup, RSS and samples/s: parsing + tokenizing vs. the memory-mapped caption store."""
+    import gc
+    import os
+    import tempfile
+
+    from caption_store import build_caption_store
+    from data_loader import CocoDataset
+
+    folder = tempfile.mkdtemp()
+    root, json_path, vocab = synthetic_coco(folder, args.captions, args.images)
+    store_path = os.path.join(folder, "store")
+    start = time.perf_counter()
+    build_caption_store(json_path, vocab, store_path)
+    print("one-time caption store build: {:.2f}s for {} captions".format(
+        time.perf_counter() - start, args.captions))
+
+    rng = np.random.RandomState(0)
+    indices = rng.randint(0, args.captions, args.samples)
+    for name, store in [("annotations", None), ("caption store", store_path)]:
+        gc.collect()
+        before = rss_mb()
+        start = time.perf_counter()
+        dataset = CocoDataset(root, json_path, vocab, caption_store=store)
+        startup = time.perf_counter() - start
+        grown = rss_mb() - before
+        start = time.perf_counter()
+        for index in indices:
+            dataset[index]
+        rate = len(indices) / (time.perf_counter() - start)
+        print("{:<14} startup {:8.1f}ms  +{:6.1f}MB RSS  {:8.0f} samples/s".format(
+            name, startup * 1000, grown, rate))
+        del dataset
+
+
+def bench_train(args):
+    """Per-epoch training time on images vs. on features precomputed by features.py."""
+    import os
+    import tempfile
+
+    import torch
+    import torch.nn as nn
+    import torchvision.transforms as transforms
+
+    from caption_store import build_caption_store
+    from data_loader import get_feature_loader, get_image_loader, get_loader
+    from features import extract_features, feature_transform
+    from model import DecoderRNN, EncoderCNN
+    from train import train_epoch
+
+    folder = tempfile.mkdtemp()
+    root, json_path, vocab = synthetic_coco(folder, args.captions, args.images, image_size=256)
+    store_path = os.path.join(folder, "store")
+    store = build_caption_store(json_path, vocab, store_path)
+
+    torch.manual_seed(0)
+    encoder = EncoderCNN(256, args.backbone, pretrained=False)
+    decoder = DecoderRNN(256, 512, len(vocab), 1)
+    params = list(decoder.parameters()) + list(encoder.linear.parameters()) + list(encoder.bn.parameters())
+    optimizer = torch.optim.Adam(params, lr=0.001)
+    criterion = nn.CrossEntropyLoss()
+
+    features_path = os.path.join(folder, "features.npy")
+    start = time.perf_counter()
+    extract_features(encoder, get_image_loader(root, store.paths, feature_transform(),
+                                               args.batch_size, args.num_workers), features_path)
+    print("{:<18} {:8.1f}s for {} images (once)".format("feature extraction",
+                                                         time.perf_counter() - start, args.images))
+
+    transform = transforms.Compose([
+        transforms.RandomCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
+    image_loader = get_loader(root, json_path, vocab, transform, args.batch_size, True,
+                              args.num_workers, caption_store=store_path)
+    feature_loader = get_feature_loader(store_path, features_path, vocab, args.batch_size, True,
+                                        args.num_workers)
+    encoder.train()
+    image_epoch, _ = train_epoch(encoder, decoder, criterion, optimizer, image_loader, log_step=0)
+    encoder.resnet.eval()
+    feature_epoch, _ = train_epoch(encoder, decoder, criterion, optimizer, feature_loader,
+                                   precomputed=True, log_step=0)
+    print("{:<18} {:8.1f}s per epoch of {} captions".format("images", image_epoch, args.captions))
+    print("{:<18} {:8.1f}s per epoch ({:.0f}x faster)".format(
+        "features", feature_epoch, image_epoch / feature_epoch))
+
+
+def bench_bucketing(args):
+    """Padding ratio, collate time and decoder steps/s: random batches vs. length buckets."""
+    import os
+    import tempfile
+
+    import torch
+    import torch.nn as nn
+
+    from caption_store import build_caption_store
+    from data_loader import collate_fn, collate_padded, get_feature_loader
+    from model import DecoderRNN, EncoderCNN
+    from train import train_epoch
+
+    folder = tempfile.mkdtemp()
+    _, json_path, vocab = synthetic_coco(folder, args.captions, args.images)
+    store_path = os.path.join(folder, "store")
+    store = build_caption_store(json_path, vocab, store_path)
+
+    torch.manual_seed(0)
+    encoder = EncoderCNN(256, args.backbone, pretrained=False)
+    encoder.resnet.eval()
+    features_path = os.path.join(folder, "features.npy")
+    np.save(features_path, np.random.RandomState(0).rand(
+        len(store.paths), encoder.linear.in_features).astype(np.float32))
+
+    # Collate alone, on the same batches
+    rng = np.random.RandomState(0)
+    batches = []
+    for _ in range(50):
+        batches.append([(torch.zeros(1), torch.from_numpy(store.caption(i).astype(np.int64)))
+                        for i in rng.randint(0, len(store), args.batch_size)])
+    for name, collate in [("loop", collate_fn), ("vectorized", collate_padded)]:
+        start = time.perf_counter()
+        for batch in batches:
+            collate(list(batch))
+        print("collate {:<12} {:8.3f}ms per batch of {}".format(
+            name, (time.perf_counter() - start) / len(batches) * 1000, args.batch_size))
+
+    criterion = nn.CrossEntropyLoss()
+    for name, bucketing in [("random", False), ("bucketed", True)]:
+        loader = get_feature_loader(store_path, features_path, vocab, args.batch_size, True,
+                                    args.num_workers, bucketing=bucketing)
+        tokens = padded = 0
+        for _, _, lengths in loader:
+            tokens += sum(lengths)
+            padded += len(lengths) * lengths[0]
+        torch.manual_seed(0)
+        decoder = DecoderRNN(256, 512, len(vocab), 1)
+        params = list(decoder.parameters()) + list(encoder.linear.parameters()) + list(encoder.bn.parameters())
+        optimizer = torch.optim.Adam(params, lr=0.001)
+        seconds, loss = train_epoch(encoder, decoder, criterion, optimizer, loader,
+                                    precomputed=True, log_step=0)
+        print("{:<10} padding {:5.1f}%  {:7.1f} steps/s  {:8.0f} captions/s  loss {:.3f}".format(
+            name, 100.0 * (padded - tokens) / padded, len(loader) / seconds,
+            args.captions / seconds, loss))
+
+
+def evict(paths):
+    """Drop the files from the page cache, so the next read comes from disk."""
+    import os
+
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_shards(args):
+    """Images/s from a cold page cache: one file per image vs. tar shards."""
+    import os
+    import tempfile
+
+    import torchvision.transforms as transforms
+
+    from caption_store import build_caption_store
+    from data_loader import get_loader, get_shard_loader
+    from shards import iter_shard, write_shards
+
+    folder = tempfile.mkdtemp()
+    root, json_path, vocab = synthetic_coco(folder, args.captions, args.images, args.image_size)
+    store_path = os.path.join(folder, "store")
+    store = build_caption_store(json_path, vocab, store_path)
+    shard_dir = os.path.join(folder, "shards")
+    start = time.perf_counter()
+    # Same size and JPEG quality (PIL's default) as the files, so both decode alike.
+    index = write_shards(root, store, shard_dir, args.image_size, args.shard_mb << 20, quality=75)
+    print("one-time packing: {:.2f}s for {} images into {} shards".format(
+        time.perf_counter() - start, args.images, len(index)))
+
+    files = [os.path.join(root, path) for path in store.paths]
+    shard_files = [index.shard_path(shard) for shard in index.shards]
+
+    # Raw reads only: open + read of every image once
+    evict(files)
+    start = time.perf_counter()
+    for path in files:
+        with open(path, "rb") as f:
+            f.read()
+    print("{:<22} {:8.0f} images/s".format("read, one file each", len(files) / (time.perf_counter() - start)))
+    evict(shard_files)
+    start = time.perf_counter()
+    for path, shard in zip(shard_files, index.shards):
+        for _ in iter_shard(path, shard):
+            pass
+    print("{:<22} {:8.0f} images/s".format("read, shards", len(files) / (time.perf_counter() - start)))
+
+    # Full training input: decode, random crop, normalise, collate
+    transform = transforms.Compose([
+        transforms.RandomCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
+    loaders = [
+        ("loader, one file each", files,
+         get_loader(root, json_path, vocab, transform, args.batch_size, True, args.num_workers,
+                    caption_store=store_path)),
+        ("loader, shards", shard_files,
+         get_shard_loader(shard_dir, store_path, vocab, transform, args.batch_size, True,
+                          args.num_workers, args.shuffle_buffer)),
+    ]
+    for name, paths, loader in loaders:
+        evict(paths)
+        samples = 0
+        start = time.perf_counter()
+        for images, _, _ in loader:
+            samples += len(images)
+        print("{:<22} {:8.0f} samples/s ({} samples)".format(
+            name, samples / (time.perf_counter() - start), samples))
+
+
+def bench_vocab(args):
+    """build_vocab time: whole-file literal_eval + serial tokenizing vs. streaming over 1/4/16 workers."""
+    import ast
+    import json
+    import os
+    import tempfile
+    from collections import Counter
+
+    import nltk
+
+    from build_vocab import build_vocab
+
+    folder = tempfile.mkdtemp()
+    _, json_path, _ = synthetic_coco(folder, args.captions, 1, image_size=8)
+    jsonl_path = os.path.join(folder, "captions.jsonl")
+    with open(json_path) as f:
+        annotations = ast.literal_eval(f.read())
+    with open(jsonl_path, "w") as f:
+        for ann in annotations.values():
+            f.write(json.dumps(ann) + "\n")
+    del annotations
+    print("{} captions; {} CPUs, {} usable by this process".format(
+        args.captions, os.cpu_count(), len(os.sched_getaffinity(0))))
+
+    # The previous build_vocab: parse the whole literal, tokenize on one core
+    start = time.perf_counter()
+    with open(json_path) as f:
+        coco = ast.literal_eval(f.read())
+    counter = Counter()
+    for ann_id in coco:
+        counter.update(nltk.tokenize.word_tokenize(str(coco[ann_id][2]).lower()))
+    baseline = time.perf_counter() - start
+    words = ["<pad>", "<start>", "<end>", "<unk>"] + list(counter)
+    print("{:<22} {:8.2f}s".format("literal_eval, serial", baseline))
+    del coco
+
+    for path in [json_path, jsonl_path]:
+        for workers in args.workers:
+            start = time.perf_counter()
+            vocab = build_vocab(path, 1, workers, args.chunk_size)
+            seconds = time.perf_counter() - start
+            same = [vocab.idx2word[i] for i in range(len(vocab))] == words
+            print("{:<22} {:8.2f}s  {:5.2f}x  same vocabulary: {}".format(
+                "{} workers={}".format(os.path.splitext(path)[1], workers), seconds,
+                baseline / seconds, same))
+
+
+def bench_sessions(args):
+    """Startup-to-first-upload time with a cold vs. a warm session cache.
+
+    Logs into a real account and uploads args.image to its story once per
+    run, so use a test account.
+    """
+    import os
+    import tempfile
+
+    from session_store import SessionStore
+
+    store = SessionStore(args.session_dir or tempfile.mkdtemp())
+    for name in ["cold", "warm"]:
+        samples = []
+        for _ in range(args.repeats):
+            if name == "cold":
+                store.forget(args.username or os.environ.get("USERNAME"))
+            start = time.perf_counter()
+            cl = store.login(args.username, args.password)
+            cl.photo_upload_to_story(args.image)
+            samples.append(time.perf_counter() - start)
+        print("{:<8} {:>8.2f}s to first upload".format(name, np.mean(samples)))
+    print("full logins: {}, restored sessions: {}".format(store.logins, store.restored))
+
+
+def bench_media(args):
+    """Bytes and time of media preparation: first run vs. content-hash cache hit."""
+    import tempfile
+
+    from media_prep import MediaPreprocessor
+
+    paths = args.images + args.videos
+    preprocessor = MediaPreprocessor(args.workers, args.cache_dir or tempfile.mkdtemp())
+    preprocessor.clear()
+    for name in ["encode", "cached"]:
+        start = time.perf_counter()
+        results = preprocessor.map(paths)
+        elapsed = time.perf_counter() - start
+        print("{:<8} {:>8.2f}s for {} files".format(name, elapsed, len(paths)))
+    for path, result in zip(paths, results):
+        print("  {:<32} {:>10} -> {:>10} bytes ({:.1f}%)".format(
+            path, result["bytes_in"], result["bytes_out"], 100.0 * result["bytes_out"] / result["bytes_in"]
+        ))
+    preprocessor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    latency = subparsers.add_parser("latency", help=bench_latency.__doc__)
+    latency.add_argument("--image", type=str, default="Input/tiger.jpg")
+    latency.add_argument("--repeats", type=int, default=50)
+    latency.add_argument("--cold_repeats", type=int, default=5)
+    latency.set_defaults(func=bench_latency)
+
+    batching = subparsers.add_parser("batching", help=bench_batching.__doc__)
+    batching.add_argument("--image", type=str, default="Input/tiger.jpg")
+    batching.add_argument("--requests", type=int, default=200)
+    batching.add_argument("--concurrency", type=int, default=32)
+    batching.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    batching.add_argument("--wait_ms", type=float, nargs="+", default=[0, 5, 10, 20])
+    batching.set_defaults(func=bench_batching)
+
+    decoding = subparsers.add_parser("decoding", help=bench_decoding.__doc__)
+    decoding.add_argument(
+        "--images", type=str, nargs="+", default=["Input/tiger.jpg", "Input/ram.png"]
+    )
+    decoding.add_argument("--batch_size", type=int, default=16)
+    decoding.add_argument("--repeats", type=int, default=50)
+    decoding.set_defaults(func=bench_decoding)
+
+    decoders = subparsers.add_parser("decoders", help=bench_decoders.__doc__)
+    decoders.add_argument(
+        "--images", type=str, nargs="+", default=["Input/tiger.jpg", "Input/ram.png"]
+    )
+    decoders.add_argument("--batch_size", type=int, default=16)
+    decoders.add_argument("--repeats", type=int, default=20)
+    decoders.add_argument("--beam_widths", type=int, nargs="+", default=[3, 5])
+    decoders.add_argument("--top_k", type=int, default=10)
+    decoders.add_argument("--top_p", type=float, default=0.9)
+    decoders.set_defaults(func=bench_decoders)
+
+    optimize = subparsers.add_parser("optimize", help=bench_optimize.__doc__)
+    optimize.add_argument(
+        "--images", type=str, nargs="+", default=["Input/tiger.jpg", "Input/ram.png"]
+    )
+    optimize.add_argument("--modes", type=str, nargs="+", default=None)
+    optimize.add_argument("--batch_size", type=int, default=16)
+    optimize.add_argument("--repeats", type=int, default=20)
+    optimize.set_defaults(func=bench_optimize)
+
+    backbones = subparsers.add_parser("backbones", help=bench_backbones.__doc__)
+    backbones.add_argument("--backbones", type=str, nargs="+", default=None)
+    backbones.add_argument("--embed_size", type=int, default=256)
+    backbones.add_argument("--batch_size", type=int, default=8)
+    backbones.add_argument("--repeats", type=int, default=5)
+    backbones.set_defaults(func=bench_backbones)
+
+    loadtest = subparsers.add_parser("loadtest", help=bench_loadtest.__doc__)
+    loadtest.add_argument("--image", type=str, default="Input/tiger.jpg")
+    loadtest.add_argument("--url", type=str, default=None)
+    loadtest.add_argument("--port", type=int, default=8765)
+    loadtest.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    loadtest.add_argument("--concurrency", type=int, default=16)
+    loadtest.add_argument("--requests", type=int, default=200)
+    loadtest.set_defaults(func=bench_loadtest)
+
+    publish = subparsers.add_parser("publish", help=bench_publish.__doc__)
+    publish.add_argument("--latency_ms", type=float, default=50)
+    publish.add_argument("--processing_time", type=float, default=1.0)
+    publish.add_argument("--repeats", type=int, default=3)
+    publish.set_defaults(func=bench_publish)
+
+    api = subparsers.add_parser("api", help=bench_api.__doc__)
+    api.add_argument("--latency_ms", type=float, default=0)
+    api.add_argument("--calls", type=int, default=50)
+    api.set_defaults(func=bench_api)
+
+    carousel = subparsers.add_parser("carousel", help=bench_carousel.__doc__)
+    carousel.add_argument("--items", type=int, default=10)
+    carousel.add_argument("--latency_ms", type=float, default=50)
+    carousel.add_argument("--processing_time", type=float, default=1.0)
+    carousel.add_argument("--repeats", type=int, default=3)
+    carousel.set_defaults(func=bench_carousel)
+
+    jobqueue = subparsers.add_parser("queue", help=bench_queue.__doc__)
+    jobqueue.add_argument("--jobs", type=int, default=20000)
+    jobqueue.add_argument("--batch_size", type=int, default=500)
+    jobqueue.add_argument("--publish_jobs", type=int, default=500)
+    jobqueue.add_argument("--workers", type=int, default=16)
+    jobqueue.add_argument("--latency_ms", type=float, default=20)
+    jobqueue.add_argument("--processing_time", type=float, default=1.0)
+    jobqueue.set_defaults(func=bench_queue)
+
+    fb = subparsers.add_parser("fb", help=bench_fb.__doc__)
+    fb.add_argument("--pages", type=int, default=3)
+    fb.add_argument("--latency_ms", type=float, default=50)
+    fb.add_argument("--repeats", type=int, default=20)
+    fb.set_defaults(func=bench_fb)
+
+    pipeline = subparsers.add_parser("pipeline", help=bench_pipeline.__doc__)
+    pipeline.add_argument(
+        "--images", type=str, nargs="+", default=["Input/tiger.jpg", "Input/ram.png"]
+    )
+    pipeline.add_argument("--count", type=int, default=64)
+    pipeline.add_argument("--batch_size", type=int, default=8)
+    pipeline.add_argument("--queue_size", type=int, default=32)
+    pipeline.add_argument("--publishers", type=int, default=8)
+    pipeline.add_argument("--latency_ms", type=float, default=50)
+    pipeline.add_argument("--processing_time", type=float, default=1.0)
+    pipeline.set_defaults(func=bench_pipeline)
+
+    dataset = subparsers.add_parser("dataset", help=bench_dataset.__doc__)
+    dataset.add_argument("--captions", type=int, default=200000)
+    dataset.add_argument("--images", type=int, default=200)
+    dataset.add_argument("--samples", type=int, default=20000)
+    dataset.set_defaults(func=bench_dataset)
+
+    train = subparsers.add_parser("train", help=bench_train.__doc__)
+    train.add_argument("--backbone", type=str, default="resnet152")
+    train.add_argument("--captions", type=int, default=512)
+    train.add_argument("--images", type=int, default=64)
+    train.add_argument("--batch_size", type=int, default=32)
+    train.add_argument("--num_workers", type=int, default=0)
+    train.set_defaults(func=bench_train)
+
+    bucketing = subparsers.add_parser("bucketing", help=bench_bucketing.__doc__)
+    bucketing.add_argument("--backbone", type=str, default="resnet152")
+    bucketing.add_argument("--captions", type=int, default=20000)
+    bucketing.add_argument("--images", type=int, default=200)
+    bucketing.add_argument("--batch_size", type=int, default=128)
+    bucketing.add_argument("--num_workers", type=int, default=0)
+    bucketing.set_defaults(func=bench_bucketing)
+
+    shards = subparsers.add_parser("shards", help=bench_shards.__doc__)
+    shards.add_argument("--captions", type=int, default=10000)
+    shards.add_argument("--images", type=int, default=2000)
+    shards.add_argument("--image_size", type=int, default=256)
+    shards.add_argument("--shard_mb", type=int, default=64)
+    shards.add_argument("--shuffle_buffer", type=int, default=1000)
+    shards.add_argument("--batch_size", type=int, default=128)
+    shards.add_argument("--num_workers", type=int, default=0)
+    shards.set_defaults(func=bench_shards)
+
+    vocab = subparsers.add_parser("vocab", help=bench_vocab.__doc__)
+    vocab.add_argument("--captions", type=int, default=200000)
+    vocab.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    vocab.add_argument("--chunk_size", type=int, default=10000)
+    vocab.set_defaults(func=bench_vocab)
+
+    sessions = subparsers.add_parser("sessions", help=bench_sessions.__doc__.splitlines()[0])
+    sessions.add_argument("--image", type=str, default="Input/tiger.jpg")
+    sessions.add_argument("--username", type=str, default=None)
+    sessions.add_argument("--password", type=str, default=None)
+    sessions.add_argument("--session_dir", type=str, default=None)
+    sessions.add_argument("--repeats", type=int, default=1)
+    sessions.set_defaults(func=bench_sessions)
+
+    media = subparsers.add_parser("media", help=bench_media.__doc__)
+    media.add_argument(
+        "--images", type=str, nargs="+", default=["Input/tiger.jpg", "Input/ram.png"]
+    )
+    media.add_argument("--videos", type=str, nargs="*", default=[])
+    media.add_argument("--workers", type=int, default=None)
+    media.add_argument("--cache_dir", type=str, default=None)
+    media.set_defaults(func=bench_media)
+
+    args, model_args = parser.parse_known_args()
+    args.model_args = model_args
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
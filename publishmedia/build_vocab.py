@@ -7,7 +7,11 @@
 import nltk
 import pickle
 import argparse
-from collections import Counter
+import json
+import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 #from pycocotools.coco import COCO
 import ast
 
@@ -33,21 +37,152 @@ class Vocabulary(object):
     def __len__(self):
         return len(self.word2idx)
 
-def build_vocab(json, threshold):
-    """Build a simple vocabulary wrapper."""
-    
-    with open(json, "r") as data:
-        coco = ast.literal_eval(data.read())
-    
+# String literals (the closing quote is missing if the buffer ends inside
+# the string), brackets and commas
+LITERAL_TOKEN = re.compile(r"""'(?:[^'\\]|\\.)*(')?|"(?:[^"\\]|\\.)*(")?|[\[\](){},]""", re.S)
+
+
+def iter_literal(f, block_size=1 << 20):
+    """(key, value) pairs of a dict literal file, parsed one entry at a time.
+
+    The annotation files are one big {ann_id: [category, image_id, caption]}
+    literal, usually on a single line. Instead of reading and literal_eval-ing
+    the whole file, it is scanned block by block for the commas between
+    top-level entries and every entry is evaluated on its own, so memory
+    stays flat however large the file is.
+    """
+    buffer = ''
+    scan = 0
+    start = None
+    depth = 0
+    while True:
+        block = f.read(block_size)
+        buffer += block
+        for match in LITERAL_TOKEN.finditer(buffer, scan):
+            if block and match.group()[0] in '\'"' and match.group(1) is None and match.group(2) is None:
+                break  # the string continues in the next block
+            scan = match.end()
+            token = match.group()
+            if token in ('(', '[', '{'):
+                depth += 1
+                if depth == 1:
+                    start = scan
+            elif token in (')', ']', '}'):
+                depth -= 1
+            if depth == 0 and start is not None or token == ',' and depth == 1:
+                entry = buffer[start:match.start()]
+                if entry.strip():
+                    yield next(iter(ast.literal_eval('{' + entry + '}').items()))
+                start = scan if depth == 1 else None
+        if not block:
+            return
+        keep = scan if start is None else start
+        buffer = buffer[keep:]
+        scan -= keep
+        if start is not None:
+            start = 0
+
+
+def iter_annotations(path):
+    """(image path, caption) of every annotation, streamed from path.
+
+    Files ending in .jsonl hold one annotation per line, either an object
+    with "category", "image_id" and "caption" or a [category, image_id,
+    caption] list; anything else is read as the dict literal format.
+    """
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if not line.strip():
+                    continue
+                ann = json.loads(line)
+                if isinstance(ann, dict):
+                    ann = [ann['category'], ann['image_id'], ann['caption']]
+                yield str(ann[0]) + '_' + str(ann[1]), str(ann[2])
+        else:
+            for _, ann in iter_literal(f):
+                yield ann[0] + '_' + ann[1], str(ann[2])
+
+
+def tokenize_chunk(chunk, keep_tokens=False):
+    """Word counts of a chunk of (image path, caption); also the tokens if asked."""
     counter = Counter()
-    ids = coco.keys()
-    for i, id in enumerate(ids):
-        caption = str(coco[id][2])
-        tokens = nltk.tokenize.word_tokenize(caption.lower())
-        counter.update(tokens)
-
-        if (i+1) % 1000 == 0:
-            print("[{}/{}] Tokenized the captions.".format(i+1, len(ids)))
+    tokens = [] if keep_tokens else None
+    for path, caption in chunk:
+        words = nltk.tokenize.word_tokenize(caption.lower())
+        counter.update(words)
+        if keep_tokens:
+            tokens.append((path, words))
+    return counter, tokens
+
+
+def write_tokens(f, tokens):
+    for path, words in tokens:
+        f.write(json.dumps([path, words]) + '\n')
+
+
+def chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def count_words(json, workers=1, chunk_size=10000, token_cache=None):
+    """Counter of all caption words, tokenized across worker processes.
+
+    Chunks of chunk_size captions are tokenized in parallel, at most two per
+    worker in flight so the input is never read far ahead, and the per-chunk
+    Counters are merged in input order. Words therefore appear in the same
+    order as with a serial pass and the vocabulary gets the same ids.
+
+    token_cache: optional .jsonl file receiving [image path, tokens] per
+    caption, for caption_store.py to reuse instead of tokenizing again.
+    """
+    counter = Counter()
+    cache = open(token_cache + '.tmp', 'w') if token_cache else None
+
+    def merge(result, done):
+        chunk_counter, tokens = result
+        counter.update(chunk_counter)
+        if cache is not None:
+            write_tokens(cache, tokens)
+        print("[{}] Tokenized the captions.".format(done))
+
+    done = 0
+    try:
+        if workers <= 1:
+            for chunk in chunks(iter_annotations(json), chunk_size):
+                done += len(chunk)
+                merge(tokenize_chunk(chunk, cache is not None), done)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                pending = deque()
+                for chunk in chunks(iter_annotations(json), chunk_size):
+                    pending.append((pool.submit(tokenize_chunk, chunk, cache is not None), len(chunk)))
+                    if len(pending) >= 2 * workers:
+                        future, size = pending.popleft()
+                        done += size
+                        merge(future.result(), done)
+                while pending:
+                    future, size = pending.popleft()
+                    done += size
+                    merge(future.result(), done)
+    finally:
+        if cache is not None:
+            cache.close()
+    if cache is not None:
+        os.replace(token_cache + '.tmp', token_cache)
+    return counter
+
+
+def build_vocab(json, threshold, workers=1, chunk_size=10000, token_cache=None):
+    """Build a simple vocabulary wrapper."""
+    counter = count_words(json, workers, chunk_size, token_cache)
 
     # If the word frequency is less than 'threshold', then the word is discarded.
     words = [word for word, cnt in counter.items() if cnt >= threshold]
@@ -65,7 +200,8 @@ def build_vocab(json, threshold):
     return vocab
 
 def main(args):
-    vocab = build_vocab(json=args.caption_path, threshold=args.threshold)
+    vocab = build_vocab(json=args.caption_path, threshold=args.threshold, workers=args.workers,
+                        chunk_size=args.chunk_size, token_cache=args.token_cache)
     vocab_path = args.vocab_path
     with open(vocab_path, 'wb') as f:
         pickle.dump(vocab, f)
@@ -82,6 +218,12 @@ if __name__ == '__main__':
                         help='path for saving vocabulary wrapper')
     parser.add_argument('--threshold', type=int, default=1, 
                         help='minimum word count threshold')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes tokenizing the captions')
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help='captions handed to a worker at a time')
+    parser.add_argument('--token_cache', type=str, default=None,
+                        help='also save the tokens of every caption here (.jsonl) for caption_store.py')
     args = parser.parse_args()
     main(args)
 # %%
@@ -0,0 +1,300 @@
+"""Bulk uploads to many Instagram accounts from a manifest.
+
+The manifest is CSV or JSONL with one upload per row:
+
+    account,type,media,caption,title
+    ram_photos,photo,Input/tiger.jpg,Jay Shree Ram!,
+    ram_photos,album,Input/a.jpg|Input/b.jpg,Two pictures,
+
+type is one of photo, video, album, story or igtv; album rows list their
+files separated by "|" (JSONL rows may give a list instead). Uploads for
+different accounts run concurrently on a bounded pool of workers, uploads
+for one account run one at a time with at least --min_interval seconds
+between them, and every result is reported as soon as it is known.
+
+    python bulk_publish.py manifest.csv --accounts accounts.json --workers 4
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from publish_content_all_users import login
+from media_prep import MediaPreprocessor
+from session_store import LOGIN_ERRORS, ClientPool, SessionStore
+
+MEDIA_SEPARATOR = "|"
+
+
+def _upload_story(cl, item):
+    path = item["media"][0]
+    if path.lower().endswith(".mp4"):
+        return cl.video_upload_to_story(path, caption=item["caption"], thumbnail=item.get("thumbnail"))
+    return cl.photo_upload_to_story(path, caption=item["caption"])
+
+
+# Manifest type -> callable(client, item) performing the upload
+UPLOADERS = {
+    "photo": lambda cl, item: cl.photo_upload(item["media"][0], item["caption"]),
+    "video": lambda cl, item: cl.video_upload(
+        item["media"][0], item["caption"], thumbnail=item.get("thumbnail")
+    ),
+    "album": lambda cl, item: cl.album_upload(item["media"], item["caption"]),
+    "story": _upload_story,
+    "igtv": lambda cl, item: cl.igtv_upload(
+        item["media"][0], title=item.get("title") or item["caption"], caption=item["caption"],
+        thumbnail=item.get("thumbnail"),
+    ),
+}
+
+
+def read_manifest(path):
+    """Yield manifest rows one at a time as normalised dictionaries.
+
+    A row that cannot be read comes out as a failed result instead (see
+    failed_row()), so one bad line does not end the run.
+    """
+    with open(path, newline="") as f:
+        jsonl = path.endswith(".jsonl")
+        rows = (text for text in f if text.strip()) if jsonl else csv.DictReader(f)
+        line = 0
+        while True:
+            line += 1
+            try:
+                row = next(rows)
+                if jsonl:
+                    row = json.loads(row)
+                media = row.get("media") or []
+                if isinstance(media, str):
+                    media = [part.strip() for part in media.split(MEDIA_SEPARATOR) if part.strip()]
+                item = {
+                    "line": line,
+                    "account": row["account"],
+                    "type": (row.get("type") or "photo").lower(),
+                    "media": media,
+                    "caption": row.get("caption") or "",
+                    "title": row.get("title") or "",
+                }
+            except StopIteration:
+                return
+            except Exception as e:
+                item = failed_row(line, e)
+            yield item
+
+
+def failed_row(line, error):
+    """Result for a manifest row that was never uploaded."""
+    return {
+        "line": line, "account": None, "type": None, "media": [], "status": "failed",
+        "error": "{}: {}".format(type(error).__name__, error), "seconds": 0.0,
+    }
+
+
+def load_credentials(path=None):
+    """Map of username -> password.
+
+    Read from a JSON file when path is given; otherwise the USERNAME and
+    PASSWORD pair from the environment is the only account.
+    """
+    if path:
+        with open(path) as f:
+            return json.load(f)
+    return {os.environ.get("USERNAME"): os.environ.get("PASSWORD")}
+
+
+class BulkPublisher(object):
+    """Run manifest uploads across accounts with per-account ordering and throttling."""
+
+    def __init__(self, credentials, workers=4, min_interval=30.0, max_pending=None,
+                 login=login, preprocessor=None, discard=None):
+        """Configure the engine.
+
+        Args:
+            credentials: map of username -> password.
+            workers: uploads running at the same time (across accounts).
+            min_interval: seconds between two uploads of the same account.
+            max_pending: manifest rows read ahead of the uploads
+                (default 4 x workers), so huge manifests are streamed.
+            login: callable(username, password) returning a logged-in Client.
+            preprocessor: optional media_prep.MediaPreprocessor; media is
+                converted on it as soon as a row is read, ahead of its upload.
+            discard: optional callable(username) dropping a rejected session
+                (ClientPool.discard), so the next login is a fresh one.
+        """
+        self.credentials = credentials
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_pending = max_pending or 4 * workers
+        self.login = login
+        self.preprocessor = preprocessor
+        self.discard = discard
+        self._clients = {}
+        self._queues = {}  # account -> deque of items waiting for it
+        self._busy = set()  # accounts with an upload running or scheduled
+        self._last_upload = {}
+        self._lock = threading.Lock()
+
+    def client(self, account):
+        """Logged-in client for account; only called from that account's chain."""
+        if account not in self._clients:
+            if account not in self.credentials:
+                raise RuntimeError("No credentials for account {}".format(account))
+            self._clients[account] = self.login(account, self.credentials[account])
+        return self._clients[account]
+
+    def upload(self, item):
+        """Upload one manifest item; returns its result dictionary."""
+        result = {key: item[key] for key in ("line", "account", "type", "media")}
+        start = time.perf_counter()
+        try:
+            uploader = UPLOADERS.get(item["type"])
+            if uploader is None:
+                raise ValueError("Unknown upload type {!r}".format(item["type"]))
+            if "prepared" in item:
+                prepared = [future.result() for future in item["prepared"]]
+                item = dict(item, media=[media["path"] for media in prepared],
+                            thumbnail=prepared[0]["thumbnail"])
+                result["bytes_in"] = sum(media["bytes_in"] for media in prepared)
+                result["bytes_out"] = sum(media["bytes_out"] for media in prepared)
+            try:
+                media = uploader(self.client(item["account"]), item)
+            except LOGIN_ERRORS as e:
+                # The session expired mid-run: log in again and retry this item once.
+                logging.info("Session of %s expired (%s), logging in again", item["account"], e)
+                self._clients.pop(item["account"], None)
+                if self.discard is not None:
+                    self.discard(item["account"])
+                media = uploader(self.client(item["account"]), item)
+            result["status"] = "ok"
+            result["media_pk"] = getattr(media, "pk", None)
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    def run(self, items):
+        """Upload items and yield each result as soon as it is finished.
+
+        Args:
+            items: iterable of manifest rows, e.g. read_manifest(path).
+        """
+        results = queue.Queue()
+        slots = threading.Semaphore(self.max_pending)
+        done_reading = threading.Event()
+        in_flight = [0]
+        pool = ThreadPoolExecutor(self.workers)
+
+        def run_next(account):
+            with self._lock:
+                item = self._queues[account].popleft()
+            results.put(self.upload(item))
+            slots.release()
+            with self._lock:
+                self._last_upload[account] = time.monotonic()
+                in_flight[0] -= 1
+                if not self._queues[account]:
+                    self._busy.discard(account)
+                    return
+            # Throttle without holding a worker: schedule the next upload.
+            timer = threading.Timer(self.min_interval, pool.submit, (run_next, account))
+            timer.daemon = True
+            timer.start()
+
+        def dispatch(item):
+            account = item["account"]
+            if self.preprocessor is not None:
+                story = item["type"] == "story"
+                item["prepared"] = [self.preprocessor.submit(path, story) for path in item["media"]]
+            with self._lock:
+                in_flight[0] += 1
+                self._queues.setdefault(account, deque()).append(item)
+                if account in self._busy:
+                    return
+                self._busy.add(account)
+                since_last = time.monotonic() - self._last_upload.get(account, float("-inf"))
+            delay = max(0.0, self.min_interval - since_last)
+            timer = threading.Timer(delay, pool.submit, (run_next, account))
+            timer.daemon = True
+            timer.start()
+
+        def feed():
+            try:
+                for item in items:
+                    if item.get("status") == "failed":
+                        results.put(item)
+                        continue
+                    slots.acquire()
+                    try:
+                        dispatch(item)
+                    except Exception as e:
+                        slots.release()
+                        results.put(failed_row(item.get("line"), e))
+            finally:
+                done_reading.set()
+                results.put(None)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                try:
+                    result = results.get(timeout=0.5)
+                except queue.Empty:
+                    result = None
+                if result is not None:
+                    yield result
+                    continue
+                with self._lock:
+                    idle = in_flight[0] == 0
+                if done_reading.is_set() and idle and results.empty():
+                    return
+        finally:
+            pool.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", type=str, help="CSV or JSONL manifest of uploads")
+    parser.add_argument("--accounts", type=str, default=None, help="JSON file of username -> password")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent uploads")
+    parser.add_argument("--min_interval", type=float, default=30.0,
+                        help="seconds between uploads of one account")
+    parser.add_argument("--prep_workers", type=int, default=None,
+                        help="processes converting media ahead of the uploads")
+    parser.add_argument("--no_prep", action="store_true", help="upload media files as they are")
+    parser.add_argument("--session_dir", type=str, default=None,
+                        help="directory of saved sessions (default SESSION_DIR)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    store = SessionStore(args.session_dir) if args.session_dir else SessionStore()
+    pool = ClientPool(store)
+    preprocessor = None if args.no_prep else MediaPreprocessor(args.prep_workers)
+    engine = BulkPublisher(load_credentials(args.accounts), args.workers, args.min_interval,
+                           login=pool.get, preprocessor=preprocessor, discard=pool.discard)
+    counts = {"ok": 0, "failed": 0}
+    start = time.perf_counter()
+    try:
+        for result in engine.run(read_manifest(args.manifest)):
+            counts[result["status"]] += 1
+            logging.info(
+                "[%d ok / %d failed] line %d %s %s: %s in %.1fs%s",
+                counts["ok"], counts["failed"], result["line"], result["account"],
+                result["type"], result["status"], result["seconds"],
+                " ({})".format(result["error"]) if "error" in result else "",
+            )
+    finally:
+        if preprocessor is not None:
+            preprocessor.close()
+    logging.info("Finished %d uploads in %.1fs", sum(counts.values()), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import ast
+import json
+import os
+import pickle
+
+import nltk
+import numpy as np
+
+
+class CaptionStore(object):
+    """Pre-tokenized captions memory-mapped from disk.
+
+    build_caption_store() writes, once per annotation file and vocabulary:
+
+        tokens.npy       int32, the word ids of all captions back to back,
+                         each wrapped in <start> ... <end>
+        offsets.npy      int64, caption i is tokens[offsets[i]:offsets[i + 1]]
+        image_index.npy  int32, caption i belongs to image paths[image_index[i]]
+        paths.json       the unique image file names
+        meta.json        counts and the vocabulary size the ids refer to
+
+    The arrays are opened with mmap_mode='r', so opening a store is instant,
+    DataLoader workers share the same page cache pages instead of each
+    holding a parsed copy of the annotations, and a caption is a slice.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, 'paths.json')) as f:
+            self.paths = json.load(f)
+        self.tokens = np.load(os.path.join(directory, 'tokens.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+        self.image_index = np.load(os.path.join(directory, 'image_index.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def caption(self, index):
+        """Word ids of caption index, including <start> and <end>."""
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def length(self, index):
+        return int(self.offsets[index + 1] - self.offsets[index])
+
+    def lengths(self):
+        """Lengths of all captions as one array."""
+        return np.diff(self.offsets)
+
+    def path(self, index):
+        return self.paths[self.image_index[index]]
+
+    def check_vocab(self, vocab):
+        if len(vocab) != self.meta['vocab_size']:
+            raise ValueError("Caption store {} was built with a vocabulary of {} words, not {}".format(
+                self.directory, self.meta['vocab_size'], len(vocab)))
+
+
+def load_annotations(json):
+    """The annotation file as a dict: ann_id -> [category, image_id, caption]."""
+    with open(json, "r") as data:
+        return ast.literal_eval(data.read())
+
+
+def encode_caption(caption, vocab):
+    """Word ids of a caption wrapped in <start> ... <end>, as CocoDataset does."""
+    tokens = nltk.tokenize.word_tokenize(str(caption).lower())
+    return [vocab('<start>')] + [vocab(token) for token in tokens] + [vocab('<end>')]
+
+
+def write_caption_store(directory, captions, vocab_size):
+    """Write a store from an iterable of (image path, word ids) pairs."""
+    os.makedirs(directory, exist_ok=True)
+    path_ids = {}
+    tokens = []
+    offsets = [0]
+    image_index = []
+    for path, ids in captions:
+        image_index.append(path_ids.setdefault(path, len(path_ids)))
+        tokens.extend(ids)
+        offsets.append(len(tokens))
+
+    np.save(os.path.join(directory, 'tokens.npy'), np.asarray(tokens, dtype=np.int32))
+    np.save(os.path.join(directory, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(directory, 'image_index.npy'), np.asarray(image_index, dtype=np.int32))
+    with open(os.path.join(directory, 'paths.json'), 'w') as f:
+        json.dump(list(path_ids), f)
+    # meta.json last: its presence marks a complete store
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'captions': len(image_index), 'images': len(path_ids),
+                   'tokens': len(tokens), 'vocab_size': vocab_size}, f)
+
+
+def iter_token_cache(token_cache):
+    """(image path, tokens) pairs of a token cache written by build_vocab.py."""
+    with open(token_cache, 'r') as f:
+        for line in f:
+            path, tokens = json.loads(line)
+            yield path, tokens
+
+
+def build_caption_store(json, vocab, directory, token_cache=None):
+    """Tokenize every caption of the annotation file once and write a CaptionStore.
+
+    With token_cache (build_vocab.py --token_cache) the tokens are read from
+    the cache instead and json is not opened at all.
+    """
+    if token_cache is not None:
+        start, end, unk = vocab('<start>'), vocab('<end>'), vocab('<unk>')
+        word2idx = vocab.word2idx
+        cached = ((path, [start] + [word2idx.get(token, unk) for token in tokens] + [end])
+                  for path, tokens in iter_token_cache(token_cache))
+        write_caption_store(directory, cached, len(vocab))
+        return CaptionStore(directory)
+
+    coco = load_annotations(json)
+
+    def captions():
+        for i, ann_id in enumerate(coco):
+            cat, img_id, caption = coco[ann_id][0], coco[ann_id][1], coco[ann_id][2]
+            yield cat + "_" + img_id, encode_caption(caption, vocab)
+            if (i+1) % 10000 == 0:
+                print("[{}/{}] Tokenized the captions.".format(i+1, len(coco)))
+
+    write_caption_store(directory, captions(), len(vocab))
+    return CaptionStore(directory)
+
+
+def main(args):
+    with open(args.vocab_path, 'rb') as f:
+        vocab = pickle.load(f)
+    store = build_caption_store(args.caption_path, vocab, args.store_path, args.token_cache)
+    print("Saved {} captions of {} images to '{}'".format(
+        len(store), len(store.paths), args.store_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--caption_path', type=str,
+                        default='/media/raid6/shivam/imagecaption/data/train_data.txt',
+                        help='path for train annotation file')
+    parser.add_argument('--vocab_path', type=str, default='/media/raid6/shivam/imagecaption/data/vocab.pkl',
+                        help='path for vocabulary wrapper')
+    parser.add_argument('--store_path', type=str, default='/media/raid6/shivam/imagecaption/data/captions',
+                        help='directory for the tokenized captions')
+    parser.add_argument('--token_cache', type=str, default=None,
+                        help='tokens saved by build_vocab.py --token_cache, instead of tokenizing again')
+    args = parser.parse_args()
+    main(args)
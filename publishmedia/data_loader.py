@@ -7,13 +7,15 @@ import numpy as np
 import nltk
 from PIL import Image
 from build_vocab import Vocabulary
+from caption_store import CaptionStore
+from shards import ShardIndex, decode_image, iter_shard
 import ast
 #from pycocotools.coco import COCO
 
 
 class CocoDataset(data.Dataset):
     """COCO Custom Dataset compatible with torch.utils.data.DataLoader."""
-    def __init__(self, root, json, vocab, transform=None):
+    def __init__(self, root, json, vocab, transform=None, caption_store=None):
         """Set the path for images, captions and vocabulary wrapper.
         
         Args:
@@ -21,17 +23,31 @@ class CocoDataset(data.Dataset):
             json: coco annotation file path.
             vocab: vocabulary wrapper.
             transform: image transformer.
+            caption_store: optional directory written by caption_store.py;
+                captions are then read pre-tokenized from memory-mapped
+                arrays and json is not parsed at all.
         """
         self.root = root
+        self.vocab = vocab
+        self.transform = transform
+        self.store = None
+        if caption_store is not None:
+            self.store = CaptionStore(caption_store)
+            self.store.check_vocab(vocab)
+            return
         with open(json, "r") as data:
             dict_data = ast.literal_eval(data.read())
         self.coco = dict_data
         self.ids = list(self.coco.keys())
-        self.vocab = vocab
-        self.transform = transform
 
     def __getitem__(self, index):
         """Returns one data pair (image and caption)."""
+        if self.store is not None:
+            image = Image.open(os.path.join(self.root, self.store.path(index))).convert('RGB')
+            if self.transform is not None:
+                image = self.transform(image)
+            return image, torch.from_numpy(self.store.caption(index).astype(np.int64))
+
         coco = self.coco
         vocab = self.vocab
         ann_id = self.ids[index]
@@ -55,9 +71,128 @@ class CocoDataset(data.Dataset):
         return image, target
 
     def __len__(self):
+        if self.store is not None:
+            return len(self.store)
         return len(self.ids)
 
 
+class ImageDataset(data.Dataset):
+    """The unique images of a caption store, for running the encoder once per image."""
+    def __init__(self, root, paths, transform=None):
+        self.root = root
+        self.paths = paths
+        self.transform = transform
+
+    def __getitem__(self, index):
+        image = Image.open(os.path.join(self.root, self.paths[index])).convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        return image
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class FeatureDataset(data.Dataset):
+    """(pooled trunk features, caption) pairs from precomputed features.
+
+    features is the .npy file written by features.py: one row per image of
+    the caption store, in the order of its paths table. Both are memory
+    mapped, so no image is opened and no CNN runs while training.
+    """
+    def __init__(self, caption_store, features, vocab):
+        self.store = CaptionStore(caption_store)
+        self.store.check_vocab(vocab)
+        self.features = np.load(features, mmap_mode='r')
+        if len(self.features) != len(self.store.paths):
+            raise ValueError("{} holds features of {} images, the caption store has {}".format(
+                features, len(self.features), len(self.store.paths)))
+
+    def __getitem__(self, index):
+        feature = torch.from_numpy(np.array(self.features[self.store.image_index[index]], dtype=np.float32))
+        return feature, torch.from_numpy(self.store.caption(index).astype(np.int64))
+
+    def __len__(self):
+        return len(self.store)
+
+
+class ShardDataset(data.IterableDataset):
+    """(image, caption) pairs streamed from the tar shards of shards.py.
+
+    Instead of opening one small file per sample, every DataLoader worker
+    reads its own share of the shards sequentially (shard i goes to worker
+    i % num_workers, after the shard order is shuffled for the epoch). The
+    (JPEG, caption) pairs pass through a shuffle buffer of shuffle_buffer
+    entries, and an image is only decoded when its pair leaves the buffer.
+    Workers beyond the number of shards stay idle. Workers hold a copy of
+    the dataset, so call set_epoch() before every epoch for a new order.
+    """
+    def __init__(self, shard_dir, caption_store, vocab, transform=None, shuffle=True,
+                 shuffle_buffer=1000, seed=0):
+        self.index = ShardIndex(shard_dir)
+        self.store = CaptionStore(caption_store)
+        self.store.check_vocab(vocab)
+        self.index.check_store(self.store)
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+        # Captions of every image: captions[starts[i]:starts[i + 1]] belong to image i.
+        image_index = np.asarray(self.store.image_index)
+        self.captions = np.argsort(image_index, kind='stable')
+        self.starts = np.searchsorted(image_index[self.captions], np.arange(len(self.store.paths) + 1))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _records(self, shards, rng):
+        for shard in shards:
+            for image, record in iter_shard(self.index.shard_path(shard), shard):
+                captions = self.captions[self.starts[image]:self.starts[image + 1]]
+                if self.shuffle:
+                    captions = rng.permutation(captions)
+                for caption in captions:
+                    yield record, caption
+
+    def _sample(self, record, caption):
+        image = decode_image(record)
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, torch.from_numpy(self.store.caption(caption).astype(np.int64))
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker is not None else (0, 1)
+        shards = list(self.index.shards)
+        if self.shuffle:
+            # Same seed in all workers, so they agree on the shard order.
+            rng = np.random.RandomState([self.seed, self.epoch])
+            shards = [shards[i] for i in rng.permutation(len(shards))]
+        shards = shards[worker_id::num_workers]
+        rng = np.random.RandomState([self.seed, self.epoch, worker_id + 1])
+
+        if not self.shuffle:
+            for record, caption in self._records(shards, rng):
+                yield self._sample(record, caption)
+            return
+        buffer = []
+        for item in self._records(shards, rng):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            i = rng.randint(len(buffer))
+            buffer[i], item = item, buffer[i]
+            yield self._sample(*item)
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield self._sample(*item)
+
+    def __len__(self):
+        return len(self.store)
+
+
 def collate_fn(data):
     """Creates mini-batch tensors from the list of tuples (image, caption).
     
@@ -90,22 +225,149 @@ def collate_fn(data):
         targets[i, :end] = cap[:end]        
     return images, targets, lengths
 
-def get_loader(root, json, vocab, transform, batch_size, shuffle, num_workers):
-    """Returns torch.utils.data.DataLoader for custom coco dataset."""
+def collate_padded(data):
+    """collate_fn for pre-tokenized captions, without the per-caption loop.
+
+    Same output as collate_fn: the batch is ordered by caption length
+    (descending, as pack_padded_sequence needs), but the ids of all captions
+    are concatenated once and scattered into the padded targets through a
+    length mask in a single indexing operation.
+    """
+    images, captions = zip(*data)
+    lengths = torch.tensor([len(cap) for cap in captions])
+    lengths, order = torch.sort(lengths, descending=True, stable=True)
+    images = torch.stack(images, 0)[order]
+
+    mask = torch.arange(int(lengths[0])) < lengths[:, None]
+    targets = torch.zeros(mask.shape, dtype=torch.long)
+    targets[mask] = torch.cat([captions[i] for i in order.tolist()]).long()
+    return images, targets, lengths.tolist()
+
+
+class BucketBatchSampler(data.Sampler):
+    """Batches of captions of similar length.
+
+    Every epoch the caption indices are shuffled and cut into buckets of
+    bucket_size batches; inside a bucket the captions are sorted by length
+    (ties stay in shuffled order) and split into batches, and finally the
+    batches of all buckets are shuffled. A batch then holds captions of
+    nearly the same length, so little of the padded targets is padding,
+    while the batches still differ from epoch to epoch.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False, seed=0):
+        """
+        Args:
+            lengths: caption lengths, e.g. CaptionStore.lengths().
+            batch_size: captions per batch.
+            bucket_size: batches per bucket; the larger, the tighter the lengths
+                of a batch and the less random its members.
+            shuffle: False gives the same batches, longest first, every epoch.
+            drop_last: drop the incomplete batch of every bucket.
+            seed: base seed; epoch e uses seed + e.
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        """The batches of the current epoch as arrays of indices."""
+        if not self.shuffle:
+            order = np.argsort(-self.lengths, kind='stable')
+            return self._split(order)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths))
+        step = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), step):
+            bucket = indices[start:start + step]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(self._split(bucket))
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def _split(self, indices):
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        # Mirrors batches(): without shuffling everything is one bucket.
+        step = self.batch_size * self.bucket_size if self.shuffle else max(len(self.lengths), 1)
+        sizes = [min(step, len(self.lengths) - start) for start in range(0, len(self.lengths), step)]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in sizes)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in sizes)
+
+
+def _data_loader(dataset, batch_size, shuffle, num_workers, store, bucketing):
+    if not bucketing:
+        return torch.utils.data.DataLoader(dataset=dataset,
+                                           batch_size=batch_size,
+                                           shuffle=shuffle,
+                                           num_workers=num_workers,
+                                           collate_fn=collate_fn)
+    if store is None:
+        raise ValueError("bucketing needs a caption store for the caption lengths")
+    sampler = BucketBatchSampler(store.lengths(), batch_size, shuffle=shuffle)
+    return torch.utils.data.DataLoader(dataset=dataset,
+                                       batch_sampler=sampler,
+                                       num_workers=num_workers,
+                                       collate_fn=collate_padded)
+
+
+def get_loader(root, json, vocab, transform, batch_size, shuffle, num_workers, caption_store=None,
+               bucketing=False):
+    """Returns torch.utils.data.DataLoader for custom coco dataset.
+
+    With bucketing=True (requires caption_store) batches are drawn by
+    BucketBatchSampler and collated by collate_padded.
+    """
     # COCO caption dataset
     coco = CocoDataset(root=root,
                        json=json,
                        vocab=vocab,
-                       transform=transform)
+                       transform=transform,
+                       caption_store=caption_store)
     
     # Data loader for COCO dataset
     # This will return (images, captions, lengths) for each iteration.
     # images: a tensor of shape (batch_size, 3, 224, 224).
     # captions: a tensor of shape (batch_size, padded_length).
     # lengths: a list indicating valid length for each caption. length is (batch_size).
-    data_loader = torch.utils.data.DataLoader(dataset=coco, 
-                                              batch_size=batch_size,
-                                              shuffle=shuffle,
-                                              num_workers=num_workers,
-                                              collate_fn=collate_fn)
-    return data_loader
\ No newline at end of file
+    data_loader = _data_loader(coco, batch_size, shuffle, num_workers, coco.store, bucketing)
+    return data_loader
+
+def get_shard_loader(shard_dir, caption_store, vocab, transform, batch_size, shuffle, num_workers,
+                     shuffle_buffer=1000):
+    """Like get_loader, but streams the images from the shards written by shards.py."""
+    dataset = ShardDataset(shard_dir, caption_store, vocab, transform, shuffle, shuffle_buffer)
+    return torch.utils.data.DataLoader(dataset=dataset,
+                                       batch_size=batch_size,
+                                       num_workers=num_workers,
+                                       collate_fn=collate_padded)
+
+def get_image_loader(root, paths, transform, batch_size, num_workers):
+    """Returns a DataLoader of image batches in the order of paths."""
+    return torch.utils.data.DataLoader(dataset=ImageDataset(root, paths, transform),
+                                       batch_size=batch_size,
+                                       shuffle=False,
+                                       num_workers=num_workers)
+
+
+def get_feature_loader(caption_store, features, vocab, batch_size, shuffle, num_workers, bucketing=False):
+    """Like get_loader, but yields (features, captions, lengths) from precomputed features."""
+    dataset = FeatureDataset(caption_store, features, vocab)
+    return _data_loader(dataset, batch_size, shuffle, num_workers, dataset.store, bucketing)
@@ -0,0 +1,281 @@
+"""Local stand-in for the parts of the Graph API used by posting_content.py.
+
+Containers move from IN_PROGRESS to FINISHED after a configurable processing
+time and every request can be delayed to mimic network latency, so the
+publishing code can be exercised and timed without touching Instagram.
+
+    python fake_graph_api.py --port 8080 --latency_ms 50
+
+then point GRAPH_DOMAIN at http://127.0.0.1:8080/.
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeGraphAPI(object):
+    """In-process fake Graph API server running on a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, processing_time=1.0,
+                 video_processing_time=None, quota_total=25, call_budget=None,
+                 quota_clock=time.monotonic, pages=2):
+        """Create the server; call start() to begin serving.
+
+        Args:
+            host: interface to bind.
+            port: port to bind, 0 picks a free one.
+            latency: seconds every request is delayed by.
+            processing_time: seconds until a new image container is FINISHED.
+            video_processing_time: same for video containers (default 3x).
+            quota_total: posts allowed per 24 hours by content_publishing_limit.
+            call_budget: if set, calls reported as 100% in X-App-Usage.
+            quota_clock: time source for the 24 hour publishing window, so a
+                simulated clock can be shared with the code under test.
+            pages: Facebook pages the user manages.
+        """
+        self.latency = latency
+        self.processing_time = processing_time
+        if video_processing_time is None:
+            video_processing_time = 3 * processing_time
+        self.video_processing_time = video_processing_time
+        self.quota_total = quota_total
+        self.call_budget = call_budget
+        self.quota_clock = quota_clock
+        self.publish_times = []
+        self.containers = {}
+        self.published = {}
+        self.calls = 0
+        self._ids = itertools.count(17000000000000000)
+        self.user_id = self._new_id()
+        self.pages = {}
+        for i in range(pages):
+            self.pages[self._new_id()] = {"name": "Page {}".format(i + 1), "posts": []}
+        self.rotate_page_tokens()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def _handle(self, method):
+                parts = urlsplit(self.path)
+                params = dict(parse_qsl(parts.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode("utf-8")
+                    params.update(parse_qsl(body))
+                status, payload = api.handle(method, split_path(parts.path), params)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in api.usage_headers().items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    def creds(self, graph_version="v13.0"):
+        """Credentials dictionary shaped like utils.getCreds() for this server."""
+        creds = dict()
+        creds["access_token"] = "FAKE_ACCESS_TOKEN"
+        creds["graph_domain"] = self.url
+        creds["graph_version"] = graph_version
+        creds["endpoint_base"] = creds["graph_domain"] + creds["graph_version"] + "/"
+        creds["instagram_account_id"] = "17841400000000000"
+        return creds
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def usage_headers(self):
+        """X-App-Usage header reporting calls against call_budget."""
+        if not self.call_budget:
+            return {}
+        percent = min(100, int(100 * self.calls / self.call_budget))
+        usage = {"call_count": percent, "total_cputime": 0, "total_time": 0}
+        return {"X-App-Usage": json.dumps(usage)}
+
+    def rotate_page_tokens(self):
+        """Issue new page access tokens; the old ones are rejected from now on."""
+        for page_id, page in self.pages.items():
+            page["access_token"] = "PAGE_TOKEN_{}_{}".format(page_id, self._new_id())
+
+    def _quota_usage(self):
+        window_start = self.quota_clock() - 86400
+        return sum(1 for published_at in self.publish_times if published_at > window_start)
+
+    def _new_id(self):
+        return str(next(self._ids))
+
+    def _status(self, container):
+        if container["status_code"] == "IN_PROGRESS" and "children" in container:
+            # A carousel is ready once every child is; a failed child fails it.
+            children = [self._status(self.containers[child]) for child in container["children"]]
+            if any(status in ("ERROR", "EXPIRED") for status in children):
+                container["status_code"] = "ERROR"
+            elif all(status == "FINISHED" for status in children):
+                container["status_code"] = "FINISHED"
+        elif container["status_code"] == "IN_PROGRESS" and time.monotonic() >= container["ready_at"]:
+            container["status_code"] = "FINISHED"
+        return container["status_code"]
+
+    def handle(self, method, path, params):
+        """Serve one HTTP request; returns (http status, json payload)."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if method == "POST" and not path and "batch" in params:
+                return 200, [self._batch_call(call) for call in json.loads(params["batch"])]
+            return self._dispatch(method, path, params)
+
+    def _batch_call(self, call):
+        parts = urlsplit(call["relative_url"])
+        params = dict(parse_qsl(parts.query))
+        params.update(parse_qsl(call.get("body", "")))
+        status, payload = self._dispatch(call["method"], split_path(parts.path), params)
+        return {"code": status, "headers": [], "body": json.dumps(payload)}
+
+    def _dispatch(self, method, path, params):
+        if method == "POST" and len(path) == 2 and path[1] == "media":
+            return self._create_container(params)
+        if method == "POST" and len(path) == 2 and path[1] == "media_publish":
+            return self._publish(params)
+        if method == "GET" and len(path) == 2 and path[1] == "content_publishing_limit":
+            data = {"quota_usage": self._quota_usage()}
+            if "config" in params.get("fields", ""):
+                data["config"] = {"quota_total": self.quota_total, "quota_duration": 86400}
+            return 200, {"data": [data]}
+        if method == "GET" and not path and "ids" in params:
+            payload = {}
+            for container_id in params["ids"].split(","):
+                if container_id in self.containers:
+                    container = self.containers[container_id]
+                    payload[container_id] = {"status_code": self._status(container), "id": container_id}
+            return 200, payload
+        if path and (path[0] in ("me", self.user_id) or path[0] in self.pages):
+            return self._facebook(method, path, params)
+        if method == "GET" and len(path) == 1 and path[0] in self.containers:
+            container = self.containers[path[0]]
+            return 200, {"status_code": self._status(container), "id": path[0]}
+        return 400, error("Unsupported request {} /{}".format(method, "/".join(path)))
+
+    def _facebook(self, method, path, params):
+        if method == "GET" and len(path) == 1 and path[0] in ("me", self.user_id):
+            return 200, {"id": self.user_id, "name": "Fake User"}
+        if method == "GET" and len(path) == 2 and path[1] == "accounts":
+            data = [{"id": page_id, "name": page["name"], "access_token": page["access_token"]}
+                    for page_id, page in self.pages.items()]
+            return 200, {"data": data, "paging": {"cursors": {"before": "", "after": ""}}}
+        page = self.pages.get(path[0])
+        if method == "GET" and len(path) == 1 and page is not None:
+            return 200, {"id": path[0], "access_token": page["access_token"]}
+        if method == "POST" and len(path) == 2 and path[1] in ("photos", "feed") and page is not None:
+            if params.get("access_token") != page["access_token"]:
+                return 400, error("Error validating access token", code=190)
+            post_id = "{}_{}".format(path[0], self._new_id())
+            page["posts"].append(params)
+            return 200, {"id": post_id, "post_id": post_id}
+        return 400, error("Unsupported request {} /{}".format(method, "/".join(path)))
+
+    def _create_container(self, params):
+        media_type = params.get("media_type", "IMAGE")
+        if media_type == "CAROUSEL":
+            children = [child for child in params.get("children", "").split(",") if child]
+            missing = [child for child in children if child not in self.containers]
+            if not 2 <= len(children) <= 10 or missing:
+                return 400, error("Invalid children {}".format(missing or children))
+            delay = 0.0
+        elif "image_url" in params or "video_url" in params:
+            is_video = "video_url" in params
+            delay = self.video_processing_time if is_video else self.processing_time
+        else:
+            return 400, error("Missing image_url or video_url")
+        container_id = self._new_id()
+        self.containers[container_id] = {
+            "media_type": media_type,
+            "params": params,
+            "status_code": "IN_PROGRESS",
+            "ready_at": time.monotonic() + delay,
+        }
+        if media_type == "CAROUSEL":
+            self.containers[container_id]["children"] = children
+        return 200, {"id": container_id}
+
+    def _publish(self, params):
+        container_id = params.get("creation_id")
+        container = self.containers.get(container_id)
+        if container is None:
+            return 400, error("Unknown creation_id {}".format(container_id))
+        status = self._status(container)
+        if status == "PUBLISHED":
+            return 200, {"id": container["media_id"]}
+        if status != "FINISHED":
+            return 400, error("Media is not ready to be published", code=9007)
+        if self._quota_usage() >= self.quota_total:
+            return 400, error("Content publishing limit reached", code=9)
+        self.publish_times.append(self.quota_clock())
+        container["media_id"] = self._new_id()
+        container["status_code"] = "PUBLISHED"
+        self.published[container["media_id"]] = container_id
+        return 200, {"id": container["media_id"]}
+
+
+def split_path(path):
+    """Split a request path into segments, dropping the graph version."""
+    segments = [segment for segment in path.split("/") if segment]
+    if segments and segments[0].startswith("v") and segments[0][1:2].isdigit():
+        segments = segments[1:]
+    return segments
+
+
+def error(message, code=100):
+    return {"error": {"message": message, "type": "OAuthException", "code": code}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency_ms", type=float, default=0)
+    parser.add_argument("--processing_time", type=float, default=1.0)
+    args = parser.parse_args()
+    api = FakeGraphAPI(args.host, args.port, args.latency_ms / 1000.0, args.processing_time)
+    print("Fake Graph API on {}".format(api.url))
+    api.server.serve_forever()
@@ -0,0 +1,161 @@
+"""Cached Facebook page ids and page access tokens.
+
+publish_post_to_fb used to ask for the user id, the page list and the page
+token before every post. /me/accounts already returns every page together
+with its access token, and page tokens obtained from a long-lived user token
+do not expire, so PageCache fetches that list once and keeps it for ttl
+seconds. A token the API rejects (OAuth error 190) drops the cached list
+and the post is retried once with freshly fetched tokens. Posts are sent to
+all pages concurrently, so in steady state a post costs one request per
+page and the requests overlap.
+
+Set FB_PAGE_CACHE to a file to keep the page list across runs (the file
+holds page access tokens, keep it private).
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from posting_content import (
+    get_list_of_all_pages,
+    get_page_access_token_from_user_access_token,
+    upload_post_to_fb,
+)
+
+FB_PAGE_CACHE = os.environ.get("FB_PAGE_CACHE")
+
+# Graph API error codes meaning the access token is invalid or expired
+TOKEN_ERRORS = (190, 102)
+
+
+def isTokenError(json_data):
+    error = json_data.get("error") if isinstance(json_data, dict) else None
+    return bool(error) and error.get("code") in TOKEN_ERRORS
+
+
+class PageCache(object):
+    """Pages of one user access token, refreshed after ttl or a token error."""
+
+    def __init__(self, params, ttl=24 * 60 * 60, path=FB_PAGE_CACHE, clock=time.time):
+        """Create an empty cache.
+
+        Args:
+            params: credentials from utils.getCreds().
+            ttl: seconds the page list is trusted.
+            path: optional JSON file the page list is persisted in.
+            clock: wall clock, so a persisted list ages across runs.
+        """
+        self.params = params
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.fetches = 0
+        self._pages = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved.get("user_token_tail") == self.params["access_token"][-8:]:
+            self._pages = saved["pages"]
+            self._fetched_at = saved["fetched_at"]
+
+    def _save(self):
+        if not self.path:
+            return
+        saved = {
+            "user_token_tail": self.params["access_token"][-8:],
+            "fetched_at": self._fetched_at,
+            "pages": self._pages,
+        }
+        # Page access tokens: the file is created readable by the owner only.
+        fd = os.open(self.path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(saved, f)
+        os.chmod(self.path + ".tmp", 0o600)
+        os.replace(self.path + ".tmp", self.path)
+
+    def _fetch(self):
+        """All pages of the user with their tokens, following pagination."""
+        pages = []
+        after = None
+        while True:
+            response = get_list_of_all_pages("me", self.params, after)["json_data"]
+            if "error" in response:
+                raise RuntimeError(response["error"].get("message", response["error"]))
+            pages.extend(response.get("data", []))
+            after = response.get("paging", {}).get("cursors", {}).get("after")
+            if not after or not response.get("paging", {}).get("next"):
+                break
+        for page in pages:
+            if "access_token" not in page:
+                # Only listed without a token when the user lacks a task on the page.
+                page["access_token"] = get_page_access_token_from_user_access_token(
+                    self.params, page["id"]
+                )["json_data"]["access_token"]
+        self.fetches += 1
+        return [{"id": page["id"], "name": page.get("name"), "access_token": page["access_token"]}
+                for page in pages]
+
+    def pages(self):
+        """Cached page list: dictionaries with "id", "name" and "access_token"."""
+        with self._lock:
+            if self._pages is None or self.clock() - self._fetched_at >= self.ttl:
+                self._pages = self._fetch()
+                self._fetched_at = self.clock()
+                self._save()
+            return self._pages
+
+    def invalidate(self):
+        with self._lock:
+            self._pages = None
+
+    def publish(self, params, page_ids=None, max_workers=None):
+        """Post params["media_type"]/params["media_url"] to the pages.
+
+        Args:
+            params: dictionary of params as used by upload_post_to_fb.
+            page_ids: pages to post to, all pages by default.
+            max_workers: pages posted to at the same time.
+
+        Returns:
+            dict: page id -> json_data of the post (or of the error).
+        """
+        results = self._publish(params, page_ids, max_workers)
+        if any(isTokenError(data) for data in results.values()):
+            # A page token was revoked or rotated: refetch and retry those pages once.
+            self.invalidate()
+            failed = [page_id for page_id, data in results.items() if isTokenError(data)]
+            results.update(self._publish(params, failed, max_workers))
+        return results
+
+    def _publish(self, params, page_ids, max_workers):
+        pages = self.pages()
+        if page_ids is not None:
+            pages = [page for page in pages if page["id"] in page_ids]
+        if not pages:
+            return {}
+
+        def post(page):
+            return upload_post_to_fb(params, page["id"], page["access_token"])["json_data"]
+
+        with ThreadPoolExecutor(max_workers or len(pages)) as pool:
+            return dict(zip([page["id"] for page in pages], pool.map(post, pages)))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def getPageCache(params):
+    """Process-wide PageCache of the user access token in params."""
+    with _caches_lock:
+        if params["access_token"] not in _caches:
+            _caches[params["access_token"]] = PageCache(params)
+        return _caches[params["access_token"]]
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class FeatureCache(object):
+    """Content-addressed cache of encoder outputs.
+
+    Features are keyed by a hash of the decoded image pixels plus an id of
+    the encoder that produced them, so a reposted image skips the CNN while a
+    new encoder checkpoint never sees stale features. Entries live in an
+    in-memory LRU bounded by max_bytes and, when disk_dir is set, are also
+    written through to one .npy file per key that survives restarts. The
+    disk tier is an LRU of its own, bounded by max_disk_bytes; a file's
+    mtime is its last use, so the order carries over to the next process.
+    """
+
+    def __init__(
+        self, max_bytes=64 * 1024 * 1024, disk_dir=None, max_disk_bytes=1024 * 1024 * 1024
+    ):
+        """Create a cache, picking up the files already in disk_dir.
+
+        Args:
+            max_bytes: memory budget for the LRU tier.
+            disk_dir: optional directory for the on-disk tier.
+            max_disk_bytes: size budget for the files in disk_dir.
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._entries = OrderedDict()
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+            with self._lock:
+                self._evict_disk()
+
+    @staticmethod
+    def key(namespace, image):
+        """Hash a preprocessed image tensor under the given namespace."""
+        digest = hashlib.sha1(namespace.encode("utf-8"))
+        digest.update(str(tuple(image.shape)).encode("utf-8"))
+        digest.update(image.detach().contiguous().cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".npy")
+
+    def _scan_disk(self):
+        """Index the files left by earlier runs, least recently used first."""
+        found = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(".npy"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name[: -len(".npy")], stat.st_size))
+        for _, key, size in sorted(found):
+            self._files[key] = size
+            self.disk_bytes += size
+
+    def _evict_disk(self):
+        """Delete the least recently used files until the tier fits; needs _lock."""
+        while self.disk_bytes > self.max_disk_bytes and self._files:
+            key, size = self._files.popitem(last=False)
+            self.disk_bytes -= size
+            self.disk_evictions += 1
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        """Return the cached feature for key, or None on a miss."""
+        with self._lock:
+            feature = self._entries.get(key)
+            if feature is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return feature
+
+        if self.disk_dir is not None:
+            try:
+                feature = torch.from_numpy(np.load(self._disk_path(key)))
+            except (OSError, ValueError):
+                feature = None
+            if feature is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    if key in self._files:
+                        self._files.move_to_end(key)
+                try:
+                    os.utime(self._disk_path(key))
+                except OSError:
+                    pass
+                self._remember(key, feature)
+                return feature
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, feature):
+        """Store a feature vector computed for key."""
+        feature = feature.detach().cpu().clone()
+        self._remember(key, feature)
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, "wb") as f:
+                np.save(f, feature.numpy())
+            size = os.path.getsize(tmp_path)
+            if size > self.max_disk_bytes:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            with self._lock:
+                self.disk_bytes += size - self._files.pop(key, 0)
+                self._files[key] = size
+                self._evict_disk()
+
+    def _remember(self, key, feature):
+        size = feature.element_size() * feature.nelement()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.element_size() * old.nelement()
+            self._entries[key] = feature
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.element_size() * evicted.nelement()
+                self.evictions += 1
+
+    def stats(self):
+        """Counters for monitoring, as a plain dictionary."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_entries": len(self._files),
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+                "disk_evictions": self.disk_evictions,
+            }
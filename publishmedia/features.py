@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from caption_store import CaptionStore
+from data_loader import get_image_loader
+from model import DEFAULT_BACKBONE, EncoderCNN, load_checkpoint
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def feature_transform():
+    """Deterministic resize + normalisation used for extraction.
+
+    Training normally crops and flips at random; with precomputed features
+    every epoch sees the same view of each image.
+    """
+    return transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize((0.485, 0.456, 0.406),
+                             (0.229, 0.224, 0.225))])
+
+
+def extract_features(encoder, data_loader, path, dtype=np.float32):
+    """Run the frozen trunk once over every image and store the pooled features.
+
+    Args:
+        encoder: EncoderCNN; only its trunk is used.
+        data_loader: image batches in caption store path order (get_image_loader).
+        path: .npy file to write, shape (num_images, in_features).
+        dtype: storage type; np.float16 halves the file.
+    """
+    encoder.eval()
+    features = None
+    row = 0
+    with torch.inference_mode():
+        for i, images in enumerate(data_loader):
+            batch = encoder.extract(images.to(device)).cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    path + '.tmp', mode='w+', dtype=dtype,
+                    shape=(len(data_loader.dataset), batch.shape[1]))
+            features[row:row + len(batch)] = batch
+            row += len(batch)
+            if (i+1) % 100 == 0:
+                print("[{}/{}] Extracted features.".format(row, len(data_loader.dataset)))
+    features.flush()
+    del features
+    os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r')
+
+
+def main(args):
+    store = CaptionStore(args.caption_store)
+    encoder = EncoderCNN(args.embed_size, args.backbone, pretrained=args.encoder_path is None)
+    if args.encoder_path is not None:
+        state_dict, meta = load_checkpoint(args.encoder_path)
+        if meta['backbone'] != args.backbone:
+            raise ValueError("{} was trained with {}, not {}".format(
+                args.encoder_path, meta['backbone'], args.backbone))
+        encoder.load_state_dict(state_dict)
+    encoder = encoder.to(device)
+
+    data_loader = get_image_loader(args.image_dir, store.paths, feature_transform(),
+                                   args.batch_size, args.num_workers)
+    features = extract_features(encoder, data_loader, args.features_path,
+                                np.float16 if args.half else np.float32)
+    with open(args.features_path + '.json', 'w') as f:
+        json.dump({'backbone': args.backbone, 'images': features.shape[0],
+                   'in_features': features.shape[1]}, f)
+    print("Saved features of {} images to '{}'".format(features.shape[0], args.features_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=str, default='data/resized2014', help='directory for images')
+    parser.add_argument('--caption_store', type=str, default='data/captions',
+                        help='caption store written by caption_store.py')
+    parser.add_argument('--features_path', type=str, default='data/features.npy',
+                        help='where to write the features')
+    parser.add_argument('--encoder_path', type=str, default=None,
+                        help='encoder checkpoint; ImageNet weights when omitted')
+    parser.add_argument('--backbone', type=str, default=DEFAULT_BACKBONE)
+    parser.add_argument('--embed_size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--half', action='store_true', help='store float16 features')
+    args = parser.parse_args()
+    main(args)
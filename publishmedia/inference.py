@@ -0,0 +1,395 @@
+import argparse
+import hashlib
+import os
+import pathlib
+import pickle
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from model import EncoderCNN, DecoderRNN, load_checkpoint
+from feature_cache import FeatureCache
+from optimize import MODES, optimize_model
+
+# Device configuration
+device = torch.device("cpu")
+BASE_DIR = pathlib.Path().resolve().parent
+
+
+def get_parser():
+    """Command line options shared by the web app and the offline tools."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--encoder_path",
+        type=str,
+        default=os.path.join(BASE_DIR, "encoder-40-330.ckpt"),
+        help="path for trained encoder",
+    )
+    parser.add_argument(
+        "--decoder_path",
+        type=str,
+        default=os.path.join(BASE_DIR, "decoder-40-330.ckpt"),
+        help="path for trained decoder",
+    )
+    parser.add_argument(
+        "--vocab_path",
+        type=str,
+        default=os.path.join(BASE_DIR, "publishmedia/vocab.pkl"),
+        help="path for vocabulary wrapper",
+    )
+
+    # Model parameters (should be same as paramters in train.py; checkpoints
+    # that record them override these)
+    parser.add_argument(
+        "--embed_size",
+        type=int,
+        default=256,
+        help="dimension of word embedding vectors",
+    )
+    parser.add_argument(
+        "--hidden_size", type=int, default=512, help="dimension of lstm hidden states"
+    )
+    parser.add_argument(
+        "--num_layers", type=int, default=2, help="number of layers in lstm"
+    )
+    parser.add_argument(
+        "--backbone",
+        type=str,
+        default=None,
+        help="encoder backbone; defaults to the one recorded in the decoder checkpoint",
+    )
+    parser.add_argument(
+        "--eager_load",
+        action="store_true",
+        help="load the model at process start instead of on the first request",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="largest number of concurrent requests captioned in one pass",
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10,
+        help="how long a request may wait for others to share its batch",
+    )
+    parser.add_argument(
+        "--decoding",
+        type=str,
+        default="greedy",
+        choices=["greedy", "beam", "sample"],
+        help="how words are picked from the decoder output",
+    )
+    parser.add_argument(
+        "--beam_width", type=int, default=3, help="hypotheses kept by beam search"
+    )
+    parser.add_argument(
+        "--length_penalty",
+        type=float,
+        default=0.7,
+        help="beam search ranks by log-probability / length ** length_penalty",
+    )
+    parser.add_argument(
+        "--top_k", type=int, default=0, help="sample from the k most likely words"
+    )
+    parser.add_argument(
+        "--top_p", type=float, default=1.0, help="nucleus size for sampling"
+    )
+    parser.add_argument(
+        "--temperature", type=float, default=1.0, help="softmax temperature for sampling"
+    )
+    parser.add_argument(
+        "--feature_cache_mb",
+        type=float,
+        default=64,
+        help="memory budget of the encoder feature cache (0 disables it)",
+    )
+    parser.add_argument(
+        "--feature_cache_dir",
+        type=str,
+        default=None,
+        help="directory for the on-disk tier of the encoder feature cache",
+    )
+    parser.add_argument(
+        "--feature_cache_disk_mb",
+        type=float,
+        default=1024,
+        help="size budget of the on-disk tier of the encoder feature cache",
+    )
+    parser.add_argument(
+        "--optimize",
+        type=str,
+        default="none",
+        choices=MODES,
+        help="CPU inference build of the encoder/decoder, see optimize.py",
+    )
+    parser.add_argument(
+        "--calibration_dir",
+        type=str,
+        default=os.path.join(BASE_DIR, "publishmedia/Input"),
+        help="images used to calibrate the int8 encoder",
+    )
+    return parser
+
+
+def get_args(argv=None):
+    """Parse the model options, ignoring arguments meant for someone else."""
+    args, _ = get_parser().parse_known_args(argv)
+    return args
+
+
+IMAGE_SIZE = (224, 224)
+MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+
+# (pixel / 255 - mean) / std folded into one multiply and one subtract
+_SCALE = 1.0 / (255.0 * STD)
+_SHIFT = MEAN / STD
+
+
+def normalize_image(image, out=None):
+    """ToTensor + Normalize for a 224x224 RGB image in one float buffer.
+
+    Args:
+        image: PIL image in RGB mode.
+        out: optional preallocated float tensor of shape (3, 224, 224).
+
+    Returns:
+        tensor: out, filled with the normalized image.
+    """
+    pixels = torch.from_numpy(np.array(image, dtype=np.uint8))  # (224, 224, 3)
+    if out is None:
+        out = torch.empty((3,) + pixels.shape[:2])
+    out.copy_(pixels.permute(2, 0, 1))
+    return out.mul_(_SCALE).sub_(_SHIFT)
+
+
+def get_transform():
+    """Image preprocessing applied before the encoder."""
+    return normalize_image
+
+
+def load_image(image_path, transform=None):
+    """Open an image from a path or file object and shrink it to 224x224.
+
+    JPEGs are decoded straight at the smallest DCT scale that still covers
+    the target size, and other formats are reduced by an integer factor
+    before the LANCZOS resize, so a large photo is never fully decoded.
+    """
+    image = Image.open(image_path)
+    image.draft("RGB", IMAGE_SIZE)
+    image = image.convert("RGB")
+    image = image.resize(IMAGE_SIZE, Image.LANCZOS, reducing_gap=3.0)
+
+    if transform is not None:
+        image = transform(image).unsqueeze(0)
+
+    return image
+
+
+def caption_to_hashtags(sentence):
+    """Turn a generated caption into the hashtag string shown to the user."""
+    hashtags_list = sentence.split(" ")
+    tags = []
+    for tag in hashtags_list:
+        if tag in ("<start>", "<end>"):
+            continue
+        if tag not in tags:
+            tags.append(tag)
+    text = ""
+    for tag in tags:
+        text = text + "  #" + str(tag)
+    return " " + text
+
+
+def checkpoint_id(path):
+    """Identify a checkpoint file by its path, size and modification time."""
+    stat = os.stat(path)
+    key = "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class CaptionModel(object):
+    """Vocabulary, encoder and decoder loaded once and kept in eval mode."""
+
+    def __init__(self, args, feature_cache=None):
+        """Load the vocabulary and both checkpoints described by args.
+
+        Args:
+            args: namespace with the options from get_parser().
+            feature_cache: optional FeatureCache for encoder outputs.
+        """
+        self.args = args
+        self.transform = get_transform()
+        self.feature_cache = feature_cache
+        self.encoder_id = checkpoint_id(args.encoder_path) + args.optimize
+
+        # Load vocabulary wrapper
+        with open(args.vocab_path, "rb") as f:
+            self.vocab = pickle.load(f)
+        self.end_id = self.vocab("<end>")
+
+        # Load the trained model parameters; the decoder checkpoint records
+        # which backbone it was trained on, so both halves always match.
+        encoder_state, encoder_meta = load_checkpoint(args.encoder_path)
+        decoder_state, decoder_meta = load_checkpoint(args.decoder_path)
+        self.backbone = args.backbone or decoder_meta["backbone"]
+        for meta in (encoder_meta, decoder_meta):
+            if meta["backbone"] != self.backbone:
+                raise ValueError(
+                    "Checkpoints were trained with {} but --backbone is {}".format(
+                        meta["backbone"], self.backbone
+                    )
+                )
+
+        # Build models; the encoder checkpoint carries the trunk weights too.
+        # Checkpoints from train.py record the sizes they were trained with.
+        embed_size = decoder_meta.get("embed_size", args.embed_size)
+        hidden_size = decoder_meta.get("hidden_size", args.hidden_size)
+        num_layers = decoder_meta.get("num_layers", args.num_layers)
+        encoder = EncoderCNN(embed_size, self.backbone, pretrained=False)
+        decoder = DecoderRNN(embed_size, hidden_size, len(self.vocab), num_layers)
+        encoder.load_state_dict(encoder_state)
+        decoder.load_state_dict(decoder_state)
+
+        # eval mode (batchnorm uses moving mean/variance)
+        self.encoder, self.decoder = optimize_model(
+            encoder.to(device).eval(),
+            decoder.to(device).eval(),
+            args.optimize,
+            self.calibration_images() if args.optimize != "none" else None,
+        )
+
+    def calibration_images(self, limit=32):
+        """Load up to limit images from --calibration_dir as one batch."""
+        directory = self.args.calibration_dir
+        if not directory or not os.path.isdir(directory):
+            return None
+        images = []
+        for name in sorted(os.listdir(directory))[:limit]:
+            try:
+                images.append(load_image(os.path.join(directory, name), self.transform))
+            except OSError:
+                continue
+        return torch.cat(images, 0) if images else None
+
+    def decode(self, sampled_ids, lengths):
+        """Convert a batch of word ids to caption strings.
+
+        Args:
+            sampled_ids: tensor of shape (batch_size, steps).
+            lengths: tensor of shape (batch_size); ids to keep per row.
+
+        Returns:
+            list: one caption per row, up to and including '<end>'.
+        """
+        idx2word = self.vocab.idx2word
+        sentences = []
+        for row, length in zip(sampled_ids.tolist(), lengths.tolist()):
+            sentences.append(" ".join(idx2word[word_id] for word_id in row[:length]))
+        return sentences
+
+    def caption_images(self, images):
+        """Generate captions for a batch of preprocessed images.
+
+        Args:
+            images: tensor of shape (batch_size, 3, 224, 224).
+
+        Returns:
+            list: one caption per image.
+        """
+        with torch.inference_mode():
+            features = self.encode(images)
+            sampled_ids, lengths = self.generate(features)
+        return self.decode(sampled_ids, lengths)
+
+    def encode(self, images):
+        """Run the encoder, skipping images whose features are cached."""
+        if self.feature_cache is None:
+            return self.encoder(images.to(device))
+
+        cache = self.feature_cache
+        keys = [cache.key(self.encoder_id, image) for image in images]
+        features = [cache.get(key) for key in keys]
+        missing = [i for i, feature in enumerate(features) if feature is None]
+        if missing:
+            computed = self.encoder(images[missing].to(device))
+            for i, feature in zip(missing, computed):
+                cache.put(keys[i], feature)
+                features[i] = feature
+        return torch.stack([feature.to(device) for feature in features], 0)
+
+    def generate(self, features):
+        """Run the decoder selected by --decoding on a batch of features."""
+        args = self.args
+        if args.decoding == "beam":
+            return self.decoder.beam_search(
+                features, self.end_id, args.beam_width, args.length_penalty
+            )
+        if args.decoding == "sample":
+            return self.decoder.sample_top_k(
+                features, self.end_id, args.top_k, args.top_p, args.temperature
+            )
+        return self.decoder.sample_early_exit(features, self.end_id)
+
+    def caption(self, image_path):
+        """Generate a caption for a single image file."""
+        image = load_image(image_path, self.transform)
+        return self.caption_images(image)[0]
+
+
+class ModelRegistry(object):
+    """Holds the live CaptionModel and swaps in new checkpoints on reload.
+
+    Requests grab the current model with get() and keep using it until they
+    finish, so a reload never interrupts inference already in flight: the
+    replacement is fully loaded off to the side and only then published.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.version = 0
+        self.feature_cache = None
+        if args.feature_cache_mb > 0:
+            self.feature_cache = FeatureCache(
+                int(args.feature_cache_mb * 1024 * 1024),
+                args.feature_cache_dir,
+                int(args.feature_cache_disk_mb * 1024 * 1024),
+            )
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the live model, loading it on first use."""
+        model = self._model
+        if model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = CaptionModel(self.args, self.feature_cache)
+                    self.version += 1
+                model = self._model
+        return model
+
+    def reload(self, **overrides):
+        """Load new checkpoints and make them live once ready.
+
+        Args:
+            overrides: option names from get_parser() to change, e.g.
+                encoder_path and decoder_path of a new checkpoint pair.
+
+        Returns:
+            int: version number of the model that is now live.
+        """
+        args = argparse.Namespace(**vars(self.args))
+        for key, value in overrides.items():
+            if value is not None:
+                setattr(args, key, value)
+        model = CaptionModel(args, self.feature_cache)
+        with self._lock:
+            self.args = args
+            self._model = model
+            self.version += 1
+            return self.version
@@ -0,0 +1,438 @@
+"""Durable publish queue backed by SQLite.
+
+Every Instagram post is a row that remembers how far it got:
+
+    queued -> created (container_id) -> finished -> published (media_id)
+
+plus failed for posts that ran out of attempts (Facebook page posts go
+straight from queued to published, on every page of the user; the post id
+of every page is stored as soon as that page succeeded, so a retry after a
+partial failure only posts to the remaining pages). Workers claim a row with a
+lease, run the next stage, and store the returned ids before moving on, so a
+crashed worker only loses its lease: the row is picked up again at the
+stage it had reached, without creating the container twice. The children
+of a carousel are recorded one by one as they are created, so a retry only
+creates the ones that are missing. What is left is the moment between the
+Graph API creating a container and its id being written here: a crash in
+exactly that window makes the retry create that container (or carousel
+child) again. The extra one is never published, only the recorded id is,
+and Instagram drops unpublished containers after 24 hours. A post is
+enqueued under a dedupe key (by default a hash of the account and the post
+itself), so enqueueing the same post twice is a no-op.
+
+Containers that are still processing are not waited for on a worker thread;
+the row is put back with a short delay and any worker checks it again later.
+
+    python job_queue.py enqueue --media_url https://.../a.jpg --caption "Hi"
+    python job_queue.py work --workers 8
+    python job_queue.py stats
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOB_DB = os.environ.get("JOB_DB", os.path.join(os.path.dirname(__file__), "jobs.sqlite3"))
+
+QUEUED = "queued"
+CREATED = "created"
+FINISHED = "finished"
+PUBLISHED = "published"
+FAILED = "failed"
+DONE_STAGES = (PUBLISHED, FAILED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    account_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    stage TEXT NOT NULL DEFAULT 'queued',
+    container_id TEXT,
+    media_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    checks INTEGER NOT NULL DEFAULT 0,
+    claims INTEGER NOT NULL DEFAULT 0, -- claims since the stage was reached
+    error TEXT,
+    available_at REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (stage, available_at);
+CREATE TABLE IF NOT EXISTS page_posts (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    page_id TEXT NOT NULL,
+    post_id TEXT NOT NULL,
+    PRIMARY KEY (job_id, page_id)
+);
+CREATE TABLE IF NOT EXISTS carousel_children (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    position INTEGER NOT NULL,
+    container_id TEXT NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+"""
+
+
+def dedupe_key(account_id, post):
+    """Stable key of a post: the same account and content give the same key."""
+    canonical = json.dumps([account_id, post], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class JobQueue(object):
+    """SQLite job table shared by every worker thread and process."""
+
+    def __init__(self, path=JOB_DB, lease=300.0, max_attempts=5, clock=time.time):
+        """Open (and create) the queue.
+
+        Args:
+            path: database file.
+            lease: seconds a claimed job is reserved for its worker; after
+                that another worker may take it over.
+            max_attempts: failures after which a job is marked failed.
+            clock: wall clock; leases must survive restarts, so not monotonic.
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections may not be shared between threads.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def enqueue(self, post, account_id, key=None):
+        """Add a post; returns (job id, True) or (existing id, False) for a duplicate."""
+        return self.enqueue_many([post], account_id, [key] if key else None)[0]
+
+    def enqueue_many(self, posts, account_id, keys=None):
+        """Add many posts in one transaction; returns (job id, added) per post."""
+        keys = keys or [dedupe_key(account_id, post) for post in posts]
+        now = self.clock()
+        connection = self._transaction()
+        try:
+            before = connection.execute("SELECT COALESCE(MAX(id), 0) FROM jobs").fetchone()[0]
+            connection.executemany(
+                "INSERT OR IGNORE INTO jobs (dedupe_key, account_id, payload, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(key, account_id, json.dumps(post), now, now) for key, post in zip(keys, posts)],
+            )
+            ids = {}
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = connection.execute(
+                    "SELECT id, dedupe_key FROM jobs WHERE dedupe_key IN ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk,
+                )
+                ids.update((row["dedupe_key"], row["id"]) for row in rows)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        results, seen = [], set()
+        for key in keys:
+            results.append((ids[key], ids[key] > before and key not in seen))
+            seen.add(key)
+        return results
+
+    def claim(self, worker=None, limit=1):
+        """Reserve up to limit ready jobs for worker; returns them as dicts."""
+        worker = worker or uuid.uuid4().hex
+        now = self.clock()
+        connection = self._transaction()
+        try:
+            rows = connection.execute(
+                "SELECT * FROM jobs WHERE stage IN (?, ?, ?) AND available_at <= ?"
+                " ORDER BY available_at, id LIMIT ?",
+                (QUEUED, CREATED, FINISHED, now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET worker = ?, available_at = ?, claims = claims + 1 WHERE id = ?",
+                [(worker, now + self.lease, row["id"]) for row in rows],
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["payload"] = json.loads(job["payload"])
+            job["claims"] += 1
+            job["worker"] = worker
+            jobs.append(job)
+        return jobs
+
+    def _update(self, job, **fields):
+        # Only the worker holding the lease may move a job on.
+        fields["updated_at"] = self.clock()
+        assignments = ", ".join("{} = ?".format(name) for name in fields)
+        cursor = self._connection().execute(
+            "UPDATE jobs SET {} WHERE id = ? AND worker = ?".format(assignments),
+            list(fields.values()) + [job["id"], job["worker"]],
+        )
+        job.update(fields)
+        return cursor.rowcount == 1
+
+    def advance(self, job, stage, **ids):
+        """Record that job reached stage, with any ids it returned, and release it."""
+        return self._update(
+            job, stage=stage, checks=0, claims=0, error=None, available_at=self.clock(), **ids
+        )
+
+    def retry_later(self, job, delay):
+        """Release job unchanged until delay seconds from now (container still processing)."""
+        return self._update(job, checks=job["checks"] + 1, available_at=self.clock() + delay)
+
+    def fail(self, job, error, delay=30.0):
+        """Count a failed attempt; the job is retried after delay or marked failed."""
+        attempts = job["attempts"] + 1
+        if attempts >= self.max_attempts:
+            return self._update(job, stage=FAILED, attempts=attempts, error=str(error))
+        return self._update(
+            job, attempts=attempts, error=str(error), available_at=self.clock() + delay * attempts
+        )
+
+    def give_up(self, job, error):
+        """Mark job failed without further attempts."""
+        return self._update(job, stage=FAILED, error=str(error))
+
+    def page_posts(self, job):
+        """Facebook pages job already posted to: page id -> post id."""
+        rows = self._connection().execute(
+            "SELECT page_id, post_id FROM page_posts WHERE job_id = ?", (job["id"],)
+        )
+        return {page_id: post_id for page_id, post_id in rows}
+
+    def record_page_posts(self, job, posts):
+        """Store the post ids (page id -> post id) of the pages job posted to."""
+        self._connection().executemany(
+            "INSERT OR IGNORE INTO page_posts (job_id, page_id, post_id) VALUES (?, ?, ?)",
+            [(job["id"], page_id, post_id) for page_id, post_id in posts.items()],
+        )
+
+    def children(self, job):
+        """Carousel children job already created: position -> container id."""
+        rows = self._connection().execute(
+            "SELECT position, container_id FROM carousel_children WHERE job_id = ?", (job["id"],)
+        )
+        return {position: container_id for position, container_id in rows}
+
+    def record_child(self, job, position, container_id):
+        """Store the container id of a carousel child as soon as it exists."""
+        self._connection().execute(
+            "INSERT OR IGNORE INTO carousel_children (job_id, position, container_id) VALUES (?, ?, ?)",
+            (job["id"], position, container_id),
+        )
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def stats(self):
+        """Number of jobs per stage."""
+        rows = self._connection().execute("SELECT stage, COUNT(*) FROM jobs GROUP BY stage")
+        return {stage: count for stage, count in rows}
+
+    def pending(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE stage NOT IN (?, ?)", DONE_STAGES
+        ).fetchone()[0]
+
+
+def runStage(job, params, jobs, initial_interval=0.5, max_interval=10.0):
+    """Run the next stage of one claimed job against the Graph API."""
+    from posting_content import (
+        createCarouselContainer,
+        createCarouselMediaObject,
+        createMediaObject,
+        getMediaObjectStatus,
+        publishMedia,
+    )
+
+    post = dict(params, **job["payload"])
+    post.setdefault("media_type", "IMAGE")
+    post.setdefault("caption", "")
+
+    if job["stage"] == QUEUED and post.get("target") == "facebook":
+        return jobs.advance(job, PUBLISHED, media_id=publishToFacebook(post, jobs, job)["id"])
+
+    if job["stage"] == QUEUED:
+        if post["media_type"] == "CAROUSEL":
+            post["media_type"] = post.get("child_media_type", "IMAGE")
+            post["carousel_caption"] = post["caption"]
+            children = createCarouselMediaObject(
+                post,
+                existing=jobs.children(job),
+                on_created=lambda position, response: jobs.record_child(
+                    job, position, response["json_data"]["id"]
+                ),
+            )
+            for child in children:
+                checkResponse(child)
+            response = createCarouselContainer(post, children)
+        else:
+            response = createMediaObject(post)
+        return jobs.advance(job, CREATED, container_id=checkResponse(response)["id"])
+
+    if job["stage"] == CREATED:
+        status = checkResponse(getMediaObjectStatus(job["container_id"], params)).get("status_code")
+        if status == "FINISHED":
+            return jobs.advance(job, FINISHED)
+        if status == "PUBLISHED":
+            # Published by an earlier run that died before recording it.
+            return jobs.advance(job, PUBLISHED)
+        if status in ("ERROR", "EXPIRED"):
+            return jobs.give_up(job, "Container {} is {}".format(job["container_id"], status))
+        return jobs.retry_later(job, min(initial_interval * 2 ** job["checks"], max_interval))
+
+    if job["stage"] == FINISHED:
+        if job["claims"] > 1:
+            # Claimed in this stage before: that worker may have published and then
+            # crashed or timed out before recording it.
+            status = checkResponse(getMediaObjectStatus(job["container_id"], params)).get("status_code")
+            if status == "PUBLISHED":
+                return jobs.advance(job, PUBLISHED)
+        response = checkResponse(publishMedia(job["container_id"], params))
+        return jobs.advance(job, PUBLISHED, media_id=response["id"])
+
+
+def publishToFacebook(post, jobs, job):
+    """Post to every Facebook page of the user that job has not posted to yet.
+
+    The post id of every page that succeeded is recorded right away, so when
+    one page fails and the job is retried, the other pages are not posted to
+    a second time.
+
+    Returns:
+            dict: "id" with the comma separated ids of the page posts
+    """
+    from fb_pages import getPageCache
+
+    cache = getPageCache(post)
+    posted = jobs.page_posts(job)
+    remaining = [page["id"] for page in cache.pages() if page["id"] not in posted]
+    results = cache.publish(post, page_ids=remaining) if remaining else {}
+    jobs.record_page_posts(job, {page_id: data["id"] for page_id, data in results.items()
+                                 if "error" not in data})
+    failed = {page_id: data["error"] for page_id, data in results.items() if "error" in data}
+    if failed:
+        raise RuntimeError("Posting to pages failed: {}".format(failed))
+    return {"id": ",".join(jobs.page_posts(job).values())}
+
+
+def checkResponse(response):
+    """json_data of a makeApiCall response, raising on a Graph API error."""
+    json_data = response["json_data"]
+    if "error" in json_data:
+        raise RuntimeError(json_data["error"].get("message", json_data["error"]))
+    return json_data
+
+
+def work(jobs, params, workers=4, batch_size=1, idle_wait=0.2, stop_when_empty=True):
+    """Process the queue on a pool of threads.
+
+    Args:
+        jobs: the JobQueue.
+        params: credentials from utils.getCreds().
+        workers: threads claiming and running jobs.
+        batch_size: jobs claimed per transaction by one thread.
+        idle_wait: seconds a thread sleeps when nothing is ready.
+        stop_when_empty: return once no job is left unfinished; otherwise
+            keep waiting for new jobs.
+    """
+
+    def loop():
+        worker = "{}-{}".format(os.getpid(), uuid.uuid4().hex[:8])
+        while True:
+            claimed = jobs.claim(worker, batch_size)
+            if not claimed:
+                if stop_when_empty and not jobs.pending():
+                    return
+                time.sleep(idle_wait)
+                continue
+            for job in claimed:
+                try:
+                    runStage(job, params, jobs)
+                except Exception as e:
+                    jobs.fail(job, e)
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return jobs.stats()
+
+
+def main():
+    from utils import getCreds
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", type=str, default=JOB_DB, help="queue database")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    enqueue = subparsers.add_parser("enqueue", help="add a post")
+    enqueue.add_argument("--media_type", type=str, default=os.environ.get("MEDIA_TYPE", "IMAGE"))
+    enqueue.add_argument("--media_url", type=str, nargs="+", default=[os.environ.get("MEDIA_URL")],
+                         help="several urls make a carousel")
+    enqueue.add_argument("--caption", type=str, default=os.environ.get("CAPTION", ""))
+    enqueue.add_argument("--facebook", action="store_true", help="post to the Facebook pages instead")
+    enqueue.add_argument("--key", type=str, default=None, help="dedupe key (default: content hash)")
+
+    run = subparsers.add_parser("work", help="process queued posts")
+    run.add_argument("--workers", type=int, default=4)
+    run.add_argument("--batch_size", type=int, default=1)
+    run.add_argument("--forever", action="store_true", help="keep waiting for new posts")
+
+    subparsers.add_parser("stats", help="jobs per stage")
+
+    args = parser.parse_args()
+    jobs = JobQueue(args.db)
+    params = getCreds()
+    if args.command == "enqueue":
+        if len(args.media_url) > 1:
+            post = {"media_type": "CAROUSEL", "child_media_type": args.media_type,
+                    "media_urls": args.media_url, "caption": args.caption}
+        else:
+            post = {"media_type": args.media_type, "media_url": args.media_url[0],
+                    "caption": args.caption}
+        if args.facebook:
+            post["target"] = "facebook"
+        job_id, added = jobs.enqueue(post, params["instagram_account_id"], args.key)
+        print("{} job {}".format("Queued" if added else "Already queued as", job_id))
+    elif args.command == "work":
+        print(work(jobs, params, args.workers, args.batch_size, stop_when_empty=not args.forever))
+    else:
+        print(jobs.stats())
+
+
+if __name__ == "__main__":
+    main()
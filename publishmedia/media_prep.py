@@ -0,0 +1,257 @@
+"""Shrink and convert media locally before it is uploaded with instagrapi.
+
+instagrapi only accepts JPEG photos and MP4 videos and Instagram re-encodes
+everything above 1080 pixels wide anyway, so sending a 6000x4000 PNG or a
+50 Mbit/s video wastes upload time. prepare() turns a file into what
+Instagram actually keeps:
+
+* images: JPEG, EXIF rotation applied, transparency flattened on white,
+  fitted into 1080x1350 (1080x1920 for stories);
+* videos: H.264/AAC MP4 at most 1080 pixels wide, 30 fps and 3.5 Mbit/s,
+  transcoded with the ffmpeg binary bundled with moviepy, plus a JPEG
+  thumbnail taken from the first second.
+
+Files that already meet these limits are uploaded as they are: encoding
+them again would only cost quality and, for videos, often grow the file.
+Outputs are cached under MEDIA_CACHE_DIR by a hash of the input bytes and
+the settings, so media that is posted again is never re-encoded.
+MediaPreprocessor runs prepare() on a process pool ahead of the uploads.
+"""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from moviepy.config import get_setting
+from PIL import Image, ImageOps
+
+MEDIA_CACHE_DIR = os.environ.get(
+    "MEDIA_CACHE_DIR", os.path.join(os.path.dirname(__file__), "media_cache")
+)
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".m4v", ".avi", ".mkv", ".webm")
+
+# Largest frames Instagram keeps; bigger media is downscaled on their side.
+POST_MAX_SIZE = (1080, 1350)
+STORY_MAX_SIZE = (1080, 1920)
+JPEG_QUALITY = 85
+VIDEO_MAX_WIDTH = 1080
+VIDEO_MAX_FPS = 30
+VIDEO_MAX_BITRATE = "3500k"
+VIDEO_CRF = 23
+AUDIO_BITRATE = "128k"
+# EXIF tag that exif_transpose() applies; 1 means upright.
+EXIF_ORIENTATION = 0x0112
+
+
+def is_video(path):
+    return path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, digest, profile, extension):
+    """Location of a cached output; profile names the settings used."""
+    key = hashlib.sha1("{}:{}".format(digest, profile).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key[:2], key + extension)
+
+
+def write_atomic(path, write):
+    """Run write(tmp_path) and move the result into place."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp{}".format(path, os.getpid(), os.path.splitext(path)[1])
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def convert_image(source, target, max_size=POST_MAX_SIZE, quality=JPEG_QUALITY):
+    image = Image.open(source)
+    image.draft("RGB", max_size)
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+    image.thumbnail(max_size, Image.LANCZOS, reducing_gap=3.0)
+    image.save(target, "JPEG", quality=quality, optimize=True, progressive=True)
+
+
+def image_is_compliant(path, max_size=POST_MAX_SIZE):
+    """True if the image is an upright RGB/grayscale JPEG within max_size."""
+    try:
+        with Image.open(path) as image:
+            return (
+                image.format == "JPEG"
+                and image.mode in ("RGB", "L")
+                and image.width <= max_size[0]
+                and image.height <= max_size[1]
+                and image.getexif().get(EXIF_ORIENTATION, 1) == 1
+            )
+    except OSError:
+        return False
+
+
+def probe_video(path):
+    """Stream details of a video as printed by ffmpeg -i.
+
+    Returns:
+        dict: "video" and "audio" codec names (None if absent), "pix_fmt",
+            "width", "height", "fps", "duration" in seconds and "rotated".
+    """
+    command = [get_setting("FFMPEG_BINARY"), "-hide_banner", "-i", path]
+    text = subprocess.run(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    ).stderr.decode("utf-8", "replace")
+    info = {"video": None, "audio": None, "pix_fmt": None, "width": None,
+            "height": None, "fps": None, "duration": None,
+            "rotated": "rotate" in text or "displaymatrix" in text}
+    match = re.search(r"Duration: (\d+):(\d+):(\d+\.\d+)", text)
+    if match:
+        hours, minutes, seconds = match.groups()
+        info["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    match = re.search(r"Stream #.*?Video: (\w+)[^,]*, (\w+)[^,]*,.*? (\d+)x(\d+)", text)
+    if match:
+        info["video"], info["pix_fmt"] = match.group(1), match.group(2)
+        info["width"], info["height"] = int(match.group(3)), int(match.group(4))
+    match = re.search(r"Stream #.*?Video: .*?([\d.]+) fps", text)
+    if match:
+        info["fps"] = float(match.group(1))
+    match = re.search(r"Stream #.*?Audio: (\w+)", text)
+    if match:
+        info["audio"] = match.group(1)
+    return info
+
+
+def video_is_compliant(path):
+    """True if transcode_video() would have nothing to bring within limits."""
+    if not path.lower().endswith(".mp4"):
+        return False
+    info = probe_video(path)
+    if not info["duration"] or info["fps"] is None or info["width"] is None:
+        return False
+    max_bitrate = int(VIDEO_MAX_BITRATE[:-1]) + int(AUDIO_BITRATE[:-1])
+    bitrate = os.path.getsize(path) * 8 / 1000.0 / info["duration"]
+    return (
+        info["video"] == "h264"
+        and info["pix_fmt"] == "yuv420p"
+        and info["audio"] in (None, "aac")
+        and not info["rotated"]
+        and info["width"] <= VIDEO_MAX_WIDTH
+        and info["fps"] <= VIDEO_MAX_FPS
+        and bitrate <= max_bitrate
+    )
+
+
+def ffmpeg(*args):
+    command = [get_setting("FFMPEG_BINARY"), "-y", "-loglevel", "error"] + list(args)
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def transcode_video(source, target):
+    ffmpeg(
+        "-i", source,
+        "-vf", "scale='min({},iw)':-2,fps='min({},source_fps)'".format(VIDEO_MAX_WIDTH, VIDEO_MAX_FPS),
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(VIDEO_CRF),
+        "-maxrate", VIDEO_MAX_BITRATE, "-bufsize", "7000k", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", AUDIO_BITRATE,
+        "-movflags", "+faststart",
+        target,
+    )
+
+
+def video_thumbnail(source, target, at=1.0):
+    ffmpeg(
+        "-ss", str(at), "-i", source, "-frames:v", "1",
+        "-vf", "scale='min({},iw)':-2".format(VIDEO_MAX_WIDTH), "-q:v", "3",
+        target,
+    )
+    if not os.path.exists(target):
+        # Clips shorter than `at` have no frame there; take the first one.
+        ffmpeg("-i", source, "-frames:v", "1", "-q:v", "3", target)
+
+
+def prepare(path, story=False, cache_dir=MEDIA_CACHE_DIR):
+    """Convert one file for upload, reusing the cached result when present.
+
+    Args:
+        path: image or video file.
+        story: fit images to the story frame instead of the feed one.
+        cache_dir: where converted files are kept.
+
+    Returns:
+        dict: "path" of the file to upload (path itself if it already meets
+            the limits), "thumbnail" (videos, else None), "bytes_in",
+            "bytes_out" and "cached" (True if nothing was encoded).
+    """
+    result = {"thumbnail": None, "bytes_in": os.path.getsize(path), "cached": True}
+    if is_video(path):
+        digest = file_digest(path)
+        profile = "video:{}:{}:{}:{}".format(VIDEO_MAX_WIDTH, VIDEO_MAX_FPS, VIDEO_MAX_BITRATE, VIDEO_CRF)
+        thumbnail = cache_path(cache_dir, digest, profile, ".jpg")
+        # An empty marker records that the input needs no transcode, so
+        # cached videos are not probed with ffmpeg again.
+        compliant = cache_path(cache_dir, digest, profile, ".compliant")
+        target = cache_path(cache_dir, digest, profile, ".mp4")
+        if os.path.exists(compliant):
+            target = path
+        elif not os.path.exists(target):
+            if video_is_compliant(path):
+                write_atomic(compliant, lambda tmp: open(tmp, "w").close())
+                target = path
+            else:
+                result["cached"] = False
+                write_atomic(target, lambda tmp: transcode_video(path, tmp))
+        if not os.path.exists(thumbnail):
+            result["cached"] = False
+            write_atomic(thumbnail, lambda tmp: video_thumbnail(target, tmp))
+        result["thumbnail"] = thumbnail
+    else:
+        max_size = STORY_MAX_SIZE if story else POST_MAX_SIZE
+        if image_is_compliant(path, max_size):
+            result["path"] = path
+            result["bytes_out"] = result["bytes_in"]
+            return result
+        profile = "image:{}x{}:{}".format(max_size[0], max_size[1], JPEG_QUALITY)
+        target = cache_path(cache_dir, file_digest(path), profile, ".jpg")
+        if not os.path.exists(target):
+            result["cached"] = False
+            write_atomic(target, lambda tmp: convert_image(path, tmp, max_size))
+    result["path"] = target
+    result["bytes_out"] = os.path.getsize(target)
+    return result
+
+
+class MediaPreprocessor(object):
+    """Run prepare() on a process pool so encoding overlaps the uploads."""
+
+    def __init__(self, workers=None, cache_dir=MEDIA_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.pool = ProcessPoolExecutor(workers)
+
+    def submit(self, path, story=False):
+        """Start preparing path; returns a Future of prepare()'s dictionary."""
+        return self.pool.submit(prepare, path, story, self.cache_dir)
+
+    def map(self, paths, story=False):
+        return [future.result() for future in [self.submit(path, story) for path in paths]]
+
+    def close(self):
+        self.pool.shutdown()
+
+    def clear(self):
+        """Delete every cached output."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
@@ -1,26 +1,89 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 from torch.nn.utils.rnn import pack_padded_sequence
 
 
+def resnet_trunk(name):
+    def build(pretrained):
+        resnet = getattr(models, name)(pretrained=pretrained)
+        modules = list(resnet.children())[:-1]      # delete the last fc layer.
+        return nn.Sequential(*modules), resnet.fc.in_features
+    return build
+
+
+def pooled_trunk(name, classifier_index):
+    def build(pretrained):
+        net = getattr(models, name)(pretrained=pretrained)
+        trunk = nn.Sequential(net.features, net.avgpool)  # delete the classifier.
+        return trunk, net.classifier[classifier_index].in_features
+    return build
+
+
+# Backbone name -> builder returning (trunk, number of pooled features).
+BACKBONES = {
+    'resnet152': resnet_trunk('resnet152'),
+    'resnet50': resnet_trunk('resnet50'),
+    'resnet34': resnet_trunk('resnet34'),
+    'mobilenet_v3_large': pooled_trunk('mobilenet_v3_large', 0),
+    'mobilenet_v3_small': pooled_trunk('mobilenet_v3_small', 0),
+    'efficientnet_b0': pooled_trunk('efficientnet_b0', 1),
+}
+DEFAULT_BACKBONE = 'resnet152'
+
+
+def save_checkpoint(path, module, **meta):
+    """Save a state dict together with metadata such as the backbone name."""
+    checkpoint = dict(meta)
+    checkpoint['state_dict'] = module.state_dict()
+    torch.save(checkpoint, path)
+
+
+def load_checkpoint(path):
+    """Load a checkpoint written by save_checkpoint or a bare state dict.
+
+    Returns (state_dict, meta). Bare state dicts predate the metadata and
+    were all trained with the ResNet-152 encoder.
+    """
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    if 'state_dict' not in checkpoint:
+        return checkpoint, {'backbone': DEFAULT_BACKBONE}
+    meta = {key: value for key, value in checkpoint.items() if key != 'state_dict'}
+    meta.setdefault('backbone', DEFAULT_BACKBONE)
+    return checkpoint['state_dict'], meta
+
+
 class EncoderCNN(nn.Module):
-    def __init__(self, embed_size):
-        """Load the pretrained ResNet-152 and replace top fc layer."""
+    def __init__(self, embed_size, backbone=DEFAULT_BACKBONE, pretrained=True):
+        """Load a pretrained CNN backbone and replace its classifier.
+
+        backbone is a key of BACKBONES. pretrained=False skips the ImageNet
+        weights, for when a full encoder checkpoint is loaded right after.
+        """
         super(EncoderCNN, self).__init__()
-        resnet = models.resnet152(pretrained=True)
-        modules = list(resnet.children())[:-1]      # delete the last fc layer.
-        self.resnet = nn.Sequential(*modules)
-        self.linear = nn.Linear(resnet.fc.in_features, embed_size)
+        if backbone not in BACKBONES:
+            raise ValueError('Unknown backbone {!r}, use one of {}'.format(
+                backbone, sorted(BACKBONES)))
+        self.backbone = backbone
+        trunk, in_features = BACKBONES[backbone](pretrained)
+        self.resnet = trunk                         # named resnet for checkpoint compatibility.
+        self.linear = nn.Linear(in_features, embed_size)
         self.bn = nn.BatchNorm1d(embed_size, momentum=0.01)
         
     def forward(self, images):
         """Extract feature vectors from input images."""
+        return self.embed_features(self.extract(images))
+
+    def extract(self, images):
+        """Pooled trunk features (batch_size, in_features); the trunk is frozen."""
         with torch.no_grad():
             features = self.resnet(images)
-        features = features.reshape(features.size(0), -1)
-        features = self.bn(self.linear(features))
-        return features
+        return features.reshape(features.size(0), -1)
+
+    def embed_features(self, features):
+        """Project pooled trunk features, e.g. precomputed ones, to embed_size."""
+        return self.bn(self.linear(features))
 
 
 class DecoderRNN(nn.Module):
@@ -53,4 +116,129 @@ class DecoderRNN(nn.Module):
             inputs = self.embed(predicted)                       # inputs: (batch_size, embed_size)
             inputs = inputs.unsqueeze(1)                         # inputs: (batch_size, 1, embed_size)
         sampled_ids = torch.stack(sampled_ids, 1)                # sampled_ids: (batch_size, max_seq_length)
-        return sampled_ids
\ No newline at end of file
+        return sampled_ids
+
+    def sample_early_exit(self, features, end_id, states=None, choose=None):
+        """Greedy search that stops as soon as every caption has emitted end_id.
+
+        Rows that finish are dropped from the active batch, so later LSTM
+        steps only run on the captions that are still being generated.
+        Returns the ids together with each caption's length (including the
+        end token), so callers can slice instead of scanning for '<end>'.
+        choose maps the (num_active, vocab_size) scores of a step to the
+        next ids; it defaults to the argmax.
+        """
+        batch_size = features.size(0)
+        sampled_ids = torch.full((batch_size, self.max_seg_length), end_id,
+                                 dtype=torch.long, device=features.device)
+        lengths = torch.full((batch_size,), self.max_seg_length,
+                             dtype=torch.long, device=features.device)
+        active = torch.arange(batch_size, device=features.device)  # rows still decoding
+        inputs = features.unsqueeze(1)
+        steps = 0
+        for i in range(self.max_seg_length):
+            hiddens, states = self.lstm(inputs, states)          # hiddens: (num_active, 1, hidden_size)
+            outputs = self.linear(hiddens.squeeze(1))            # outputs:  (num_active, vocab_size)
+            if choose is None:
+                _, predicted = outputs.max(1)                    # predicted: (num_active)
+            else:
+                predicted = choose(outputs)
+            sampled_ids[active, i] = predicted
+            steps = i + 1
+            finished = predicted == end_id
+            if finished.any():
+                lengths[active[finished]] = steps
+                running = ~finished
+                if not running.any():
+                    break
+                active = active[running]                         # compact the batch
+                predicted = predicted[running]
+                states = tuple(state[:, running] for state in states)
+            inputs = self.embed(predicted).unsqueeze(1)          # inputs: (num_active, 1, embed_size)
+        return sampled_ids[:, :steps], lengths
+
+    def sample_top_k(self, features, end_id, top_k=0, top_p=1.0, temperature=1.0,
+                     generator=None):
+        """Generate captions by sampling from the top-k / nucleus of each step.
+
+        top_k keeps only the k most likely words (0 disables it) and top_p
+        keeps the smallest set of words whose probability adds up to top_p.
+        Decoding shares the early-exit loop of sample_early_exit, so the
+        return value is the same (sampled_ids, lengths) pair.
+        """
+        def choose(outputs):
+            logits = outputs / temperature
+            if top_k > 0:
+                kth = logits.topk(min(top_k, logits.size(1)), 1)[0][:, -1:]
+                logits = logits.masked_fill(logits < kth, float('-inf'))
+            if top_p < 1.0:
+                sorted_logits, order = logits.sort(1, descending=True)
+                cumulative = F.softmax(sorted_logits, 1).cumsum(1)
+                # Drop a word once the words ranked above it already cover top_p.
+                drop = cumulative - F.softmax(sorted_logits, 1) >= top_p
+                logits = logits.scatter(1, order, sorted_logits.masked_fill(drop, float('-inf')))
+            probs = F.softmax(logits, 1)
+            return torch.multinomial(probs, 1, generator=generator).squeeze(1)
+
+        return self.sample_early_exit(features, end_id, choose=choose)
+
+    def beam_search(self, features, end_id, beam_width=3, length_penalty=0.7):
+        """Generate captions for given image features using beam search.
+
+        All beams of all images advance together: every timestep is one LSTM
+        call on a (batch_size * beam_width) batch whose hidden states are
+        reordered, not recomputed, when beams are pruned. Finished beams keep
+        their score and compete with the live ones until every beam of every
+        image has emitted end_id. Hypotheses are ranked by
+        log-probability / length ** length_penalty.
+
+        Returns:
+            sampled_ids: (batch_size, steps) best caption per image.
+            lengths: (batch_size) length of each caption including end_id.
+        """
+        batch_size = features.size(0)
+        k = beam_width
+        device = features.device
+
+        # The image feature is the same for every beam, so the first step runs once per image.
+        hiddens, states = self.lstm(features.unsqueeze(1))
+        log_probs = F.log_softmax(self.linear(hiddens.squeeze(1)), 1)     # (batch_size, vocab_size)
+        vocab_size = log_probs.size(1)
+        scores, tokens = log_probs.topk(k, 1)                             # (batch_size, k)
+        sequences = tokens.unsqueeze(2)                                   # (batch_size, k, steps)
+        lengths = torch.ones_like(tokens)
+        finished = tokens == end_id
+        states = tuple(state.repeat_interleave(k, 1) for state in states)  # (num_layers, batch_size * k, hidden_size)
+        offsets = (torch.arange(batch_size, device=device) * k).unsqueeze(1)
+
+        # Finished beams may only be extended by end_id, at no cost.
+        frozen = torch.full((vocab_size,), float('-inf'), device=device)
+        frozen[end_id] = 0
+
+        for _ in range(1, self.max_seg_length):
+            if finished.all():
+                break
+            inputs = self.embed(sequences[:, :, -1].reshape(-1)).unsqueeze(1)
+            hiddens, states = self.lstm(inputs, states)
+            log_probs = F.log_softmax(self.linear(hiddens.squeeze(1)), 1)
+            log_probs = log_probs.view(batch_size, k, vocab_size)
+            log_probs = torch.where(finished.unsqueeze(2), frozen, log_probs)
+
+            candidates = (scores.unsqueeze(2) + log_probs).view(batch_size, -1)
+            candidate_lengths = (lengths + (~finished).long()).unsqueeze(2)
+            candidate_lengths = candidate_lengths.expand(-1, -1, vocab_size).reshape(batch_size, -1)
+            ranking = candidates / candidate_lengths.float().pow(length_penalty)
+            _, best = ranking.topk(k, 1)                                  # (batch_size, k)
+
+            beam = best // vocab_size
+            tokens = best % vocab_size
+            scores = candidates.gather(1, best)
+            lengths = candidate_lengths.gather(1, best)
+            finished = finished.gather(1, beam) | (tokens == end_id)
+            sequences = sequences.gather(1, beam.unsqueeze(2).expand(-1, -1, sequences.size(2)))
+            sequences = torch.cat((sequences, tokens.unsqueeze(2)), 2)
+            states = tuple(state.index_select(1, (offsets + beam).view(-1)) for state in states)
+
+        rows = torch.arange(batch_size, device=device)
+        best = (scores / lengths.float().pow(length_penalty)).argmax(1)
+        return sequences[rows, best], lengths[rows, best]
@@ -0,0 +1,113 @@
+"""Optional CPU inference builds of the encoder and decoder.
+
+Modes, selected with --optimize:
+    none      the fp32 modules as loaded from the checkpoints.
+    jit       fp32, with the encoder's linear + batchnorm head folded into one
+              layer and the encoder traced and frozen with TorchScript.
+    int8      dynamic int8 quantization of EncoderCNN.linear, DecoderRNN.lstm
+              and DecoderRNN.linear, plus FX static quantization of the ResNet
+              trunk (conv + batchnorm folded) calibrated on a few images.
+    int8-jit  int8 followed by the TorchScript export of the encoder.
+
+The decoder loop has data-dependent control flow (early exit, batch
+compaction, beam reordering), so it stays eager; only its layers change.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+MODES = ["none", "jit", "int8", "int8-jit"]
+
+
+def fold_linear_bn(linear, bn):
+    """Return a Linear layer equal to bn(linear(x)) with bn in eval mode."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    folded = nn.Linear(linear.in_features, linear.out_features)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale.unsqueeze(1))
+        folded.bias.copy_((linear.bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+def fold_encoder_head(encoder):
+    """Fold EncoderCNN.bn into EncoderCNN.linear in place."""
+    encoder.linear = fold_linear_bn(encoder.linear, encoder.bn)
+    encoder.bn = nn.Identity()
+    return encoder
+
+
+def quantize_trunk(trunk, calibration_images):
+    """Static int8 quantization of the CNN trunk with torch.fx.
+
+    prepare_fx folds each conv + batchnorm pair before observers are
+    inserted; the observers then see calibration_images to pick the
+    activation ranges.
+    """
+    qconfig_dict = {"": get_default_qconfig("fbgemm")}
+    example_inputs = (calibration_images[:1],)
+    try:
+        prepared = prepare_fx(trunk, qconfig_dict, example_inputs=example_inputs)
+    except TypeError:
+        # torch < 1.13 does not take example_inputs
+        prepared = prepare_fx(trunk, qconfig_dict)
+    with torch.no_grad():
+        prepared(calibration_images)
+    return convert_fx(prepared)
+
+
+def quantize_encoder(encoder, calibration_images=None):
+    """int8 encoder: static trunk (if calibration images are given) + dynamic head."""
+    encoder = fold_encoder_head(copy.deepcopy(encoder).eval())
+    if calibration_images is not None and len(calibration_images):
+        encoder.resnet = quantize_trunk(encoder.resnet, calibration_images)
+    return quantize_dynamic(encoder, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_decoder(decoder):
+    """Dynamic int8 quantization of the decoder's LSTM and output layer."""
+    return quantize_dynamic(
+        copy.deepcopy(decoder).eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8
+    )
+
+
+def script_encoder(encoder, example_images):
+    """Trace the encoder with TorchScript and freeze it for inference."""
+    with torch.no_grad():
+        traced = torch.jit.trace(encoder.eval(), example_images)
+    return torch.jit.freeze(traced)
+
+
+def optimize_model(encoder, decoder, mode, calibration_images=None):
+    """Build the inference pair for one of MODES.
+
+    Args:
+        encoder: EncoderCNN in eval mode.
+        decoder: DecoderRNN in eval mode.
+        mode: one of MODES.
+        calibration_images: tensor of shape (n, 3, 224, 224) used to
+            calibrate the int8 trunk and as the TorchScript example input.
+
+    Returns:
+        tuple: (encoder, decoder) to use for inference.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown optimize mode {!r}, use one of {}".format(mode, MODES))
+    if mode == "none":
+        return encoder, decoder
+
+    if mode.startswith("int8"):
+        encoder = quantize_encoder(encoder, calibration_images)
+        decoder = quantize_decoder(decoder)
+    else:
+        encoder = fold_encoder_head(copy.deepcopy(encoder).eval())
+
+    if mode.endswith("jit"):
+        if calibration_images is None or not len(calibration_images):
+            example_images = torch.zeros(1, 3, 224, 224)
+        else:
+            example_images = calibration_images[:1]
+        encoder = script_encoder(encoder, example_images)
+    return encoder, decoder
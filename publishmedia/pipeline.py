@@ -0,0 +1,352 @@
+"""Caption a batch of images and publish them in one go.
+
+Three stages run at the same time, connected by bounded queues:
+
+    load (threads) -> [loaded] -> caption (model, batched) -> [captioned] -> publish (threads)
+
+Loading decodes and resizes images, captioning runs the resident model on
+batches of up to --batch_size images and turns each caption into hashtags
+with caption_to_hashtags(), and publishing posts every image with
+CAPTION + hashtags, the same text publish_content() would post. Because the
+queues are bounded, a slow stage makes the stages before it wait instead of
+piling up work in memory. At the end the time every stage spent working
+and waiting and the depth of both queues show which stage held the others up.
+
+    python pipeline.py Input/ --publisher graph --media_base_url https://cdn.example.com/
+    ls *.jpg | python pipeline.py - --publisher instagrapi
+"""
+import argparse
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+import torch
+from dotenv import load_dotenv
+
+from inference import ModelRegistry, caption_to_hashtags, get_args, load_image
+
+load_dotenv()
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+_DONE = object()
+
+
+class StageStats(object):
+    """Items, busy time and time blocked on the queues of one stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_for_input = 0.0
+        self.waiting_for_output = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items=0, busy=0.0, waiting_for_input=0.0, waiting_for_output=0.0):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+            self.waiting_for_input += waiting_for_input
+            self.waiting_for_output += waiting_for_output
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "busy": self.busy,
+            "waiting_for_input": self.waiting_for_input,
+            "waiting_for_output": self.waiting_for_output,
+        }
+
+
+class QueueDepth(object):
+    """Queue whose depth is sampled on every put."""
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self._lock:
+            self.samples += 1
+            self.total += depth
+            self.max = max(self.max, depth)
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+    def as_dict(self):
+        return {
+            "maxsize": self.maxsize,
+            "mean": self.total / self.samples if self.samples else 0.0,
+            "max": self.max,
+        }
+
+
+def iter_images(source):
+    """Image paths of a directory (sorted), or one path per line of a stream."""
+    if hasattr(source, "readline"):
+        for line in source:
+            if line.strip():
+                yield line.strip()
+    else:
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(source, name)
+
+
+def graph_publisher(params, media_base_url, initial_interval=0.5):
+    """Publish through the Graph API; images must be served under media_base_url."""
+    from posting_content import createMediaObject, publishMedia
+    from status_poller import StatusPoller
+
+    def publish(path, caption):
+        post = dict(params)
+        post["media_type"] = "IMAGE"
+        post["media_url"] = media_base_url + os.path.basename(path)
+        post["caption"] = caption
+        response = createMediaObject(post)["json_data"]
+        if "error" in response:
+            raise RuntimeError(response["error"].get("message", response["error"]))
+        status = StatusPoller(params, initial_interval).poll([response["id"]])[response["id"]]
+        if status != "FINISHED":
+            raise RuntimeError("Container {} is {}".format(response["id"], status))
+        return publishMedia(response["id"], params)["json_data"].get("id")
+
+    return publish
+
+
+def instagrapi_publisher(username=None, password=None):
+    """Upload the local files with instagrapi, reusing the saved session."""
+    from media_prep import prepare
+    from session_store import LOGIN_ERRORS, ClientPool
+
+    pool = ClientPool()
+    username = username or os.environ.get("USERNAME")
+
+    def publish(path, caption):
+        media = prepare(path)["path"]
+        try:
+            return pool.get(username, password).photo_upload(media, caption).pk
+        except LOGIN_ERRORS:
+            # Session expired mid-run: log in again and retry once.
+            pool.discard(username)
+            return pool.get(username, password).photo_upload(media, caption).pk
+
+    return publish
+
+
+def print_publisher(path, caption):
+    """Dry run: show what would be posted."""
+    print("{}: {}".format(path, caption))
+
+
+class Pipeline(object):
+    """Load, caption and publish images with overlapping stages."""
+
+    def __init__(self, registry, publish, batch_size=8, queue_size=32, loaders=2,
+                 publishers=4, caption_prefix=None):
+        """Configure the stages.
+
+        Args:
+            registry: inference.ModelRegistry holding the model.
+            publish: callable(path, caption) posting one image, e.g.
+                graph_publisher(...); its return value ends up in the result.
+            batch_size: images captioned in one model pass.
+            queue_size: capacity of each queue between two stages.
+            loaders: threads decoding images.
+            publishers: threads publishing.
+            caption_prefix: text put before the hashtags (CAPTION by default).
+        """
+        self.registry = registry
+        self.publish = publish
+        self.batch_size = batch_size
+        self.loaders = loaders
+        self.publishers = publishers
+        if caption_prefix is None:
+            caption_prefix = os.environ.get("CAPTION", "")
+        self.caption_prefix = caption_prefix
+        self.loaded = QueueDepth(queue_size)
+        self.captioned = QueueDepth(queue_size)
+        self.stats = {name: StageStats(name) for name in ("load", "caption", "publish")}
+
+    def _load(self, paths, paths_lock, results):
+        stats = self.stats["load"]
+        try:
+            transform, model_error = None, None
+            try:
+                transform = self.registry.get().transform
+            except Exception as e:
+                model_error = e
+            while True:
+                with paths_lock:
+                    path = next(paths, None)
+                if path is None:
+                    break
+                start = time.perf_counter()
+                try:
+                    if model_error is not None:
+                        raise RuntimeError("model unavailable: {}".format(model_error))
+                    image = load_image(path, transform)
+                except Exception as e:
+                    results.append({"path": path, "status": "failed", "error": "load: {}".format(e)})
+                    stats.add(busy=time.perf_counter() - start)
+                    continue
+                loaded_at = time.perf_counter()
+                self.loaded.put((path, image))
+                stats.add(1, loaded_at - start, waiting_for_output=time.perf_counter() - loaded_at)
+        finally:
+            self.loaded.put(_DONE)
+
+    def _caption(self, results):
+        stats = self.stats["caption"]
+        running = self.loaders
+        try:
+            model = self.registry.get()
+            while running:
+                start = time.perf_counter()
+                batch = []
+                while running and len(batch) < self.batch_size:
+                    try:
+                        # Block for the first image only; then take what is already loaded.
+                        item = self.loaded.get(timeout=None if not batch else 0)
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        running -= 1
+                    else:
+                        batch.append(item)
+                if not batch:
+                    continue
+                ready = time.perf_counter()
+                try:
+                    captions = model.caption_images(torch.cat([image for _, image in batch]))
+                    hashtags = [self.caption_prefix + caption_to_hashtags(caption) for caption in captions]
+                except Exception as e:
+                    for path, _ in batch:
+                        results.append({"path": path, "status": "failed", "error": "caption: {}".format(e)})
+                    stats.add(busy=time.perf_counter() - ready, waiting_for_input=ready - start)
+                    continue
+                done = time.perf_counter()
+                for (path, _), text in zip(batch, hashtags):
+                    self.captioned.put((path, text))
+                stats.add(len(batch), done - ready, ready - start, time.perf_counter() - done)
+        except Exception as e:
+            # No model: fail the rest, and keep the loaders from blocking on a full queue.
+            while running:
+                item = self.loaded.get()
+                if item is _DONE:
+                    running -= 1
+                else:
+                    results.append({"path": item[0], "status": "failed", "error": "caption: {}".format(e)})
+        finally:
+            # The publishers stop on these, whatever happened above.
+            for _ in range(self.publishers):
+                self.captioned.put(_DONE)
+
+    def _publish(self, results):
+        stats = self.stats["publish"]
+        while True:
+            start = time.perf_counter()
+            item = self.captioned.get()
+            ready = time.perf_counter()
+            if item is _DONE:
+                stats.add(waiting_for_input=ready - start)
+                return
+            path, caption = item
+            result = {"path": path, "caption": caption}
+            try:
+                result["media_id"] = self.publish(path, caption)
+                result["status"] = "published"
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = "publish: {}".format(e)
+            results.append(result)
+            stats.add(1, time.perf_counter() - ready, ready - start)
+
+    def run(self, paths):
+        """Push paths through all stages; returns (results, metrics)."""
+        results = []
+        paths_lock = threading.Lock()
+        paths = iter(paths)
+        threads = [
+            threading.Thread(target=self._load, args=(paths, paths_lock, results), name="load")
+            for _ in range(self.loaders)
+        ]
+        threads.append(threading.Thread(target=self._caption, args=(results,), name="caption"))
+        threads.extend(
+            threading.Thread(target=self._publish, args=(results,), name="publish")
+            for _ in range(self.publishers)
+        )
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = {
+            "wall": time.perf_counter() - start,
+            "stages": {name: stats.as_dict() for name, stats in self.stats.items()},
+            "queues": {"loaded": self.loaded.as_dict(), "captioned": self.captioned.as_dict()},
+        }
+        return results, metrics
+
+
+def format_metrics(metrics):
+    """Table of stage timings and queue depths."""
+    lines = ["wall time {:.2f}s".format(metrics["wall"]),
+             "{:<8} {:>6} {:>9} {:>12} {:>12}".format("stage", "items", "busy s", "wait in s", "wait out s")]
+    for name, stage in metrics["stages"].items():
+        lines.append("{:<8} {:>6} {:>9.2f} {:>12.2f} {:>12.2f}".format(
+            name, stage["items"], stage["busy"], stage["waiting_for_input"], stage["waiting_for_output"]
+        ))
+    for name, depth in metrics["queues"].items():
+        lines.append("queue {:<10} mean depth {:5.1f} max {:3d} of {}".format(
+            name, depth["mean"], depth["max"], depth["maxsize"]
+        ))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", type=str, help="directory of images, or - to read paths from stdin")
+    parser.add_argument("--publisher", type=str, default="print", choices=["print", "graph", "instagrapi"])
+    parser.add_argument("--media_base_url", type=str, default=None,
+                        help="public url the images are served under (graph publisher)")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--queue_size", type=int, default=32)
+    parser.add_argument("--loaders", type=int, default=2)
+    parser.add_argument("--publishers", type=int, default=4)
+    args, model_argv = parser.parse_known_args()
+
+    if args.publisher == "graph":
+        from utils import getCreds
+
+        if not args.media_base_url:
+            parser.error("--media_base_url is required with --publisher graph")
+        publish = graph_publisher(getCreds(), args.media_base_url)
+    elif args.publisher == "instagrapi":
+        publish = instagrapi_publisher()
+    else:
+        publish = print_publisher
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    pipeline = Pipeline(ModelRegistry(get_args(model_argv)), publish, args.batch_size,
+                        args.queue_size, args.loaders, args.publishers)
+    source = sys.stdin if args.images == "-" else args.images
+    results, metrics = pipeline.run(iter_images(source))
+    for result in results:
+        if result["status"] == "failed":
+            logging.error("%s failed: %s", result["path"], result["error"])
+    print(format_metrics(metrics))
+
+
+if __name__ == "__main__":
+    main()
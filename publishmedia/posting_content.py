@@ -1,11 +1,16 @@
-import time
 from utils import getCreds, makeApiCall
+from status_poller import StatusPoller
 from dotenv import load_dotenv
+import itertools
 import os
+from concurrent.futures import ThreadPoolExecutor
 from instagrapi import Client
 
 load_dotenv()
 
+# Instagram accepts at most 10 children in one carousel
+CAROUSEL_MAX_ITEMS = 10
+
 
 def createMediaObject(params):
     """Create media object
@@ -39,34 +44,57 @@ def createMediaObject(params):
     return makeApiCall(url, endpointParams, "POST")
 
 
-def createCarouselMediaObject(params):
-    """Create media object
+def createCarouselMediaObject(params, max_workers=CAROUSEL_MAX_ITEMS, existing=None, on_created=None):
+    """Create the child media objects of a carousel, all at the same time
 
     Args:
-            params: dictionary of params
+            params: dictionary of params; "media_urls" lists the children
+                    (or "media_url_1", "media_url_2", ... for older callers)
+            max_workers: children created concurrently, 1 creates them in order
+            existing: optional {position: id} of children created earlier;
+                    they are reused instead of being created again
+            on_created: optional callable(position, response) called as soon
+                    as a child was created
 
     API Endpoint:
             https://graph.facebook.com/v13.0/{ig-user-id}/media?image_url={image-url}&is_carousel_item=true&access_token={access-token}
+            https://graph.facebook.com/v13.0/{ig-user-id}/media?video_url={video-url}&media_type=VIDEO&is_carousel_item=true&access_token={access-token}
 
     Returns:
-            object: data from the endpoint
+            list: data from the endpoint for every child, in order
 
     """
     url = params["endpoint_base"] + params["instagram_account_id"] + "/media"
 
-    endpointParams = dict()
-    endpointParams["access_token"] = params["access_token"]
+    mediaUrls = params.get("media_urls") or [
+        params["media_url_{}".format(i)]
+        for i in itertools.takewhile(lambda i: params.get("media_url_{}".format(i)), itertools.count(1))
+    ]
+    if not 2 <= len(mediaUrls) <= CAROUSEL_MAX_ITEMS:
+        raise ValueError(
+            "A carousel needs 2 to {} items, got {}".format(CAROUSEL_MAX_ITEMS, len(mediaUrls))
+        )
 
-    # IMAGE Media Type
-    if "IMAGE" == params["media_type"]:
-        objects = []
-        endpointParams["image_url"] = params["media_url_1"]
-        objects.append(makeApiCall(url, endpointParams, "POST"))
-        endpointParams["image_url"] = params["media_url_2"]
-        objects.append(makeApiCall(url, endpointParams, "POST"))
+    existing = existing or {}
 
-        return objects
-    return None
+    def createChild(position, mediaUrl):
+        if position in existing:
+            return {"json_data": {"id": existing[position]}}
+        endpointParams = dict()
+        endpointParams["is_carousel_item"] = "true"
+        endpointParams["access_token"] = params["access_token"]
+        if "IMAGE" == params["media_type"]:
+            endpointParams["image_url"] = mediaUrl
+        else:
+            endpointParams["media_type"] = "VIDEO"
+            endpointParams["video_url"] = mediaUrl
+        response = makeApiCall(url, endpointParams, "POST")
+        if on_created is not None and "error" not in response["json_data"]:
+            on_created(position, response)
+        return response
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        return list(pool.map(createChild, range(len(mediaUrls)), mediaUrls))
 
 
 def getMediaObjectStatus(mediaObjectId, params):
@@ -150,8 +178,8 @@ def createCarouselContainer(params, imageMediaObjectsResponse):
     """Create Container
 
     Args:
-            mediaObjectId: id of the media object
             params: dictionary of params
+            imageMediaObjectsResponse: responses of createCarouselMediaObject
 
     API Endpoint:
             https://graph.facebook.com/v13.0/{ig-user-id}/media?caption={caption}&media_type={CAROUSEL}&children={object_id}%2C{object_id2}...&access_token={access-token}
@@ -163,20 +191,48 @@ def createCarouselContainer(params, imageMediaObjectsResponse):
     url = params["endpoint_base"] + params["instagram_account_id"] + "/media"
 
     endpointParams = dict()
-    endpointParams["caption"] = "Default"
+    endpointParams["caption"] = params.get("carousel_caption", "Default")
     endpointParams["media_type"] = "CAROUSEL"
-    endpointParams["children"] = ""
+    endpointParams["children"] = ",".join(
+        obj["json_data"]["id"] for obj in imageMediaObjectsResponse
+    )
     endpointParams["access_token"] = params["access_token"]
-    for obj in imageMediaObjectsResponse:
-        if endpointParams["children"] == "":
-            endpointParams["children"] += f"{obj['json_data']['id']}"
-        else:
-            endpointParams["children"] += f"%2C{obj['json_data']['id']}"
-    url += f"?caption={endpointParams['caption']}&media_type={endpointParams['media_type']}&children={endpointParams['children']}&access_token={endpointParams['access_token']}"
 
     return makeApiCall(url, endpointParams, "POST")
 
 
+def publishCarousel(params, max_workers=CAROUSEL_MAX_ITEMS, poller=None):
+    """Create, wait for and publish one carousel
+
+    The children are created concurrently and the parent container right
+    after the last child id is known; the children and the parent are then
+    polled together and the carousel is published once all are FINISHED.
+
+    Args:
+            params: dictionary of params, see createCarouselMediaObject
+            max_workers: children created concurrently
+            poller: optional status_poller.StatusPoller to wait with
+
+    Returns:
+            object: data from the media_publish endpoint, or None if a
+                    container failed
+
+    """
+    childIds = [
+        obj["json_data"]["id"] for obj in createCarouselMediaObject(params, max_workers)
+    ]
+    carouselContainerId = createCarouselContainer(
+        params, [{"json_data": {"id": childId}} for childId in childIds]
+    )["json_data"]["id"]
+
+    poller = poller or StatusPoller(params)
+    statuses = poller.poll(childIds + [carouselContainerId])
+    if any(status != "FINISHED" for status in statuses.values()):
+        print(f"\n---- CAROUSEL NOT PUBLISHED -----\n\tStatus Codes:\t{statuses}")
+        return None
+    return publishMedia(carouselContainerId, params)
+
+
 def publish_content(text):
     params = getCreds()
     params["media_type"] = os.environ.get("MEDIA_TYPE")
@@ -195,50 +251,28 @@ def publish_content(text):
     carouselContainerId = carouselContainerResponse["json_data"]["id"]
     # id of the media object that was created
     imageMediaObjectId = imageMediaObjectResponse["json_data"]["id"]
-    imageMediaStatusCode = "IN_PROGRESS"
 
     print(f"\n---- IMAGE MEDIA OBJECT -----\n\tID:\t {imageMediaObjectId}")
 
-    while (
-        imageMediaStatusCode != "FINISHED"
-    ):  # keep checking until the object status is finished
-        imageMediaObjectStatusResponse = getMediaObjectStatus(
-            imageMediaObjectId, params
-        )
-        imageMediaStatusCode = imageMediaObjectStatusResponse["json_data"][
-            "status_code"
-        ]
-        if carouselContainerId:
-            carouselContainerStatusResponse = getMediaObjectStatus(
-                carouselContainerId, params
-            )
-            carouselMediaStatusCode = carouselContainerStatusResponse["json_data"][
-                "status_code"
-            ]
-            print(
-                f"\n---- IMAGE MEDIA OBJECT STATUS -----\n\tStatus Code:\t{carouselMediaStatusCode}"
-            )
+    names = {imageMediaObjectId: "IMAGE", carouselContainerId: "CAROUSEL"}
 
+    def publishWhenFinished(mediaObjectId, statusCode):
         print(
-            f"\n---- IMAGE MEDIA OBJECT STATUS -----\n\tStatus Code:\t{imageMediaStatusCode}"
+            f"\n---- {names[mediaObjectId]} MEDIA OBJECT STATUS -----\n\tStatus Code:\t{statusCode}"
         )
-
-        # wait 5 seconds if the media object is still being processed
-        time.sleep(5)
-
-    # publish the post to instagram
-    if carouselContainerId:
-        publishCarouselResponse = publishMedia(carouselContainerId, params)
-    publishImageResponse = publishMedia(imageMediaObjectId, params)
-    # json response from ig api
-    print(
-        f'\n---- PUBLISHED IMAGE RESPONSE -----\n\tResponse:{publishImageResponse["json_data_pretty"]}'
-    )
-    if publishCarouselResponse:
+        if statusCode != "FINISHED":
+            return
+        # publish the post to instagram as soon as its container is ready
+        publishResponse = publishMedia(mediaObjectId, params)
+        # json response from ig api
         print(
-            f'\n---- PUBLISHED CAROUSEL RESPONSE -----\n\tResponse:{publishCarouselResponse["json_data_pretty"]}'
+            f'\n---- PUBLISHED {names[mediaObjectId]} RESPONSE -----\n\tResponse:{publishResponse["json_data_pretty"]}'
         )
 
+    # check both containers in one request per round, backing off until they finish
+    poller = StatusPoller(params)
+    return poller.poll(names, on_terminal=publishWhenFinished)
+
 
 def get_fb_user_id(params):
     """
@@ -251,14 +285,17 @@ def get_fb_user_id(params):
     return makeApiCall(url, endpointParams, "GET")
 
 
-def get_list_of_all_pages(user_id, params):
+def get_list_of_all_pages(user_id, params, after=None):
     """
     API Endpoint:
-            https://graph.facebook.com/v13.0/{user_id}/accounts?access_token={access-token}
+            https://graph.facebook.com/v13.0/{user_id}/accounts?fields=id,name,access_token&after={cursor}&access_token={access-token}
     """
 
     url = params["endpoint_base"] + f"{user_id}/accounts"
     endpointParams = dict()
+    endpointParams["fields"] = "id,name,access_token"
+    if after:
+        endpointParams["after"] = after
     endpointParams["access_token"] = params["access_token"]
     return makeApiCall(url, endpointParams, "GET")
 
@@ -300,26 +337,12 @@ def upload_post_to_fb(params, page_id, page_access_token):
 
 
 def publish_post_to_fb():
+    from fb_pages import getPageCache
+
     params = getCreds()
     params["media_type"] = os.environ.get("MEDIA_TYPE")
     params["media_url"] = os.environ.get("MEDIA_URL")
 
-    # Get the facebook user id
-    userIdObjectResponse = get_fb_user_id(params)
-
-    # Get the list of all the pages the user have
-    # Here we've only one page so we access the id of the one page only as page_id.
-    # page_id will be used to generate page_access_token and publish posts to page
-    listOfAllPagesResponse = get_list_of_all_pages(
-        userIdObjectResponse["json_data"]["id"], params
-    )
-    page_id = listOfAllPagesResponse["json_data"]["data"][0]["id"]
-
-    # Generate page access token to allows posting on facebook page
-    pageAccessTokenResponse = get_page_access_token_from_user_access_token(
-        params, page_id
-    )
-    page_access_token = pageAccessTokenResponse["json_data"]["access_token"]
-
-    # Upload post to facebook
-    upload_post_to_fb(params, page_id, page_access_token)
+    # Pages and their access tokens come from a cache, so in steady state
+    # the only requests are the posts themselves, sent to every page at once
+    return getPageCache(params).publish(params)
@@ -2,14 +2,19 @@ from dotenv import load_dotenv
 import os
 from instagrapi import Client
 import logging
+from media_prep import prepare
 
 load_dotenv()
 
 
-def login():
+def login(username=None, password=None):
+    """Log into an account; USERNAME/PASSWORD from the environment by default."""
     cl = Client()
     try:
-        cl.login(os.environ.get("USERNAME"), os.environ.get("PASSWORD"))
+        cl.login(
+            username or os.environ.get("USERNAME"),
+            password or os.environ.get("PASSWORD"),
+        )
     except:
         raise RuntimeError("Provide Username and password or may be they are invalid")
     return cl
@@ -19,16 +24,16 @@ def upload_photo_to_story(cl):
     """
 
     IMAGE_PATH_TO_STORY: This is an environment variable, which is declared in the .env file.
-    It must has to be specified to upload image to the story. Also, it is recommended to upload jpg or jpeg format.
-    Warning: It doesn't support other image format instead of jpg.
+    It must has to be specified to upload image to the story. Any image format works, it is converted to jpg first.
 
     Method: photo_upload_to_story(path: Path, caption: str, upload_id: str, mentions: List[Usertag], locations: List[StoryLocation], links: List[StoryLink], hashtags: List[StoryHashtag], stickers: List[StorySticker], extra_data: Dict[str, str] = {})
-    Warning: (Support JPG files)
+    Note: (Images are converted to JPG by media_prep.prepare)
 
     """
     try:
         cl.photo_upload_to_story(
-            os.environ.get("IMAGE_PATH_TO_STORY"), caption="Jay Shree Ram!"
+            prepare(os.environ.get("IMAGE_PATH_TO_STORY"), story=True)["path"],
+            caption="Jay Shree Ram!",
         )
     except:
         logging.error(
@@ -40,12 +45,12 @@ def upload_image_post(cl):
     """
 
     Method: photo_upload(path: Path, caption: str, upload_id: str, usertags: List[Usertag], location: Location, extra_data: Dict = {})
-    Warning: (Support JPG files)
+    Note: (Images are converted to JPG by media_prep.prepare)
 
     """
     try:
         cl.photo_upload(
-            os.environ.get("IMAGE_PATH_TO_POST"),
+            prepare(os.environ.get("IMAGE_PATH_TO_POST"))["path"],
             os.environ.get("CAPTION"),
         )
     except Exception as e:
@@ -56,13 +61,15 @@ def upload_video_post(cl):
     """
 
     Method: video_upload(path: Path, caption: str, thumbnail: Path, usertags: List[Usertag], location: Location, extra_data: Dict = {})
-    Warning: (Support MP4 files)
+    Note: (Videos are transcoded to MP4 by media_prep.prepare)
 
     """
     try:
+        video = prepare(os.environ.get("VIDEO_PATH_TO_POST"))
         cl.video_upload(
-            os.environ.get("VIDEO_PATH_TO_POST"),
+            video["path"],
             os.environ.get("CAPTION"),
+            thumbnail=video["thumbnail"],
         )
     except Exception as e:
         print("Failed Inside Video post")
@@ -73,15 +80,15 @@ def upload_carousel_object(cl):
     """
 
     Method: album_upload(paths: List[Path], caption: str, usertags: List[Usertag], location: Location, extra_data: Dict = {})
-    Warning: (Support JPG/MP4 files)
+    Note: (Media is converted to JPG/MP4 by media_prep.prepare)
 
     """
     try:
         cl.album_upload(
             [
-                os.environ.get("MEDIA_URL_1"),
-                os.environ.get("MEDIA_URL_2"),
-                os.environ.get("MEDIA_URL_3"),
+                prepare(os.environ.get("MEDIA_URL_1"))["path"],
+                prepare(os.environ.get("MEDIA_URL_2"))["path"],
+                prepare(os.environ.get("MEDIA_URL_3"))["path"],
             ],
             os.environ.get("CAPTION"),
         )
@@ -93,14 +100,16 @@ def upload_igtv(cl):
     """
 
     Method: igtv_upload(path: Path, title: str, caption: str, thumbnail: Path, usertags: List[Usertag], location: Location, extra_data: Dict = {})
-    Warning: (Support MP4 files)
+    Note: (Videos are transcoded to MP4 by media_prep.prepare)
 
     """
     try:
+        video = prepare(os.environ.get("IGTV_PATH"))
         cl.igtv_upload(
-            os.environ.get("IGTV_PATH"),
+            video["path"],
             title="Jay Shree Ram",
             caption=os.environ.get("CAPTION"),
+            thumbnail=video["thumbnail"],
         )
     except Exception as e:
         logging.error("May be provided path is not valid for IGTV!")
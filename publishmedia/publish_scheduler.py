@@ -0,0 +1,219 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+from async_publishing import publishPosts
+from posting_content import getContentPublishingLimit
+from utils import getUsage
+
+DAY = 24 * 60 * 60
+
+
+# Graph API error code of a publish refused because the quota is used up
+QUOTA_ERROR = 9
+
+
+class QuotaWindow(object):
+    """Local model of an account's rolling 24 hour publishing quota.
+
+    The quota_usage read from the API is taken as used for the whole window:
+    the API does not say when those posts leave it, so that part only drops
+    with the next read. Posts sent through the scheduler since that read are
+    remembered with their send time and free their slot once they are
+    duration seconds old. Nothing is refilled on a timer, so a slot is never
+    assumed free before the API would agree.
+    """
+
+    def __init__(self, capacity, used=0, duration=DAY, clock=time.monotonic):
+        self.clock = clock
+        self.reset(capacity, used, duration)
+
+    def reset(self, capacity, used, duration=DAY):
+        """Resynchronise with the usage reported by the API."""
+        self.capacity = capacity
+        self.used = used
+        self.duration = duration
+        self.sends = deque()
+
+    def _expire(self):
+        now = self.clock()
+        while self.sends and self.sends[0] <= now - self.duration:
+            self.sends.popleft()
+
+    def remaining(self):
+        self._expire()
+        return max(0, self.capacity - self.used - len(self.sends))
+
+    def try_acquire(self):
+        if self.remaining() >= 1:
+            self.sends.append(self.clock())
+            return True
+        return False
+
+    def refund(self):
+        if self.sends:
+            self.sends.pop()
+
+    def exhaust(self):
+        """The API refused a post for quota: treat the window as full."""
+        self._expire()
+        self.used = max(self.used, self.capacity - len(self.sends))
+
+    def time_until_available(self):
+        """Seconds until a slot frees up locally, None if only a new read can tell."""
+        if self.remaining() >= 1:
+            return 0.0
+        # Without sends of our own there is nothing to expire.
+        if self.used >= self.capacity or not self.sends:
+            return None
+        return self.sends[0] + self.duration - self.clock()
+
+
+def publishOne(post, params):
+    """Default publish function: one post through the asyncio engine."""
+    return asyncio.run(publishPosts([post], params))[0]
+
+
+class PublishScheduler(object):
+    """Queue posts and only send them while the account has quota left.
+
+    The content_publishing_limit endpoint is read once per account and then
+    every refresh_interval seconds; in between each account's budget is
+    tracked locally with a QuotaWindow. Posts that do not fit the budget are
+    deferred until a slot frees up or the next read, instead of being sent
+    and rejected; a post the API still refuses for quota (error code 9) is
+    put back in the queue the same way. The
+    app usage headers returned by every Graph API call are honoured too:
+    above usage_threshold percent, or while the API says access has to be
+    regained, nothing is sent.
+    """
+
+    def __init__(self, publish=publishOne, refresh_interval=3600.0, usage_threshold=90.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        """Create an empty scheduler.
+
+        Args:
+            publish: callable(post, params) returning a result dictionary
+                with a "status" of PUBLISHED or FAILED.
+            refresh_interval: seconds between content_publishing_limit reads.
+            usage_threshold: app usage percentage at which sending pauses.
+            clock: time source, replaceable by a simulated clock in tests.
+            sleep: function used by run() to wait for the next due post.
+        """
+        self.publish = publish
+        self.refresh_interval = refresh_interval
+        self.usage_threshold = usage_threshold
+        self.clock = clock
+        self.sleep = sleep
+        self.accounts = {}  # instagram_account_id -> {"params", "bucket", "refreshed"}
+        self.paused_until = 0.0
+        self.sent = 0
+        self.deferred = 0
+        self._queue = []
+        self._order = itertools.count()
+
+    def add_account(self, params):
+        """Register an account's credentials (from utils.getCreds())."""
+        account_id = params["instagram_account_id"]
+        if account_id not in self.accounts:
+            self.accounts[account_id] = {"params": params, "bucket": None, "refreshed": None}
+        return account_id
+
+    def refresh(self, account_id):
+        """Read content_publishing_limit and resynchronise the account's bucket."""
+        account = self.accounts[account_id]
+        response = getContentPublishingLimit(account["params"])["json_data"]
+        data = response.get("data") or [{}]
+        config = data[0].get("config") or {}
+        capacity = config.get("quota_total", 25)
+        duration = config.get("quota_duration", DAY)
+        used = data[0].get("quota_usage", 0)
+        if account["bucket"] is None:
+            account["bucket"] = QuotaWindow(capacity, used, duration, self.clock)
+        else:
+            account["bucket"].reset(capacity, used, duration)
+        account["refreshed"] = self.clock()
+        self._observe_usage()
+        return account["bucket"]
+
+    def _bucket(self, account_id):
+        account = self.accounts[account_id]
+        if account["refreshed"] is None or (
+            self.clock() - account["refreshed"] >= self.refresh_interval
+        ):
+            return self.refresh(account_id)
+        return account["bucket"]
+
+    def _observe_usage(self):
+        usage = getUsage()
+        now = self.clock()
+        if usage["regain_access_seconds"]:
+            self.paused_until = max(self.paused_until, now + usage["regain_access_seconds"])
+        elif usage["percent"] >= self.usage_threshold:
+            # No estimate from the API: back off for a minute and look again.
+            self.paused_until = max(self.paused_until, now + 60.0)
+
+    def submit(self, post, params):
+        """Queue a post for the account described by params."""
+        account_id = self.add_account(params)
+        heapq.heappush(self._queue, (self.clock(), next(self._order), account_id, post))
+
+    def pending(self):
+        return len(self._queue)
+
+    def next_due(self):
+        """Seconds until the earliest queued post may be sent, None if empty."""
+        if not self._queue:
+            return None
+        return max(0.0, self._queue[0][0] - self.clock(), self.paused_until - self.clock())
+
+    def run_pending(self):
+        """Send every queued post that is due and fits its account's budget.
+
+        Returns:
+            list: (post, result) pairs for the posts sent in this call.
+        """
+        results = []
+        while self._queue and self.clock() >= self.paused_until:
+            due, order, account_id, post = self._queue[0]
+            if due > self.clock():
+                break
+            heapq.heappop(self._queue)
+            bucket = self._bucket(account_id)
+            if not bucket.try_acquire():
+                self._defer(account_id, order, post)
+                continue
+            result = self.publish(post, self.accounts[account_id]["params"])
+            self.sent += 1
+            self._observe_usage()
+            if result.get("status") != "PUBLISHED":
+                bucket.refund()
+                if result.get("error_code") == QUOTA_ERROR:
+                    # Used up by posts the local model does not know about.
+                    bucket.exhaust()
+                    self._defer(account_id, order, post)
+                    continue
+            results.append((post, result))
+        return results
+
+    def _defer(self, account_id, order, post):
+        """Put post back until a slot frees up or the quota is read again."""
+        account = self.accounts[account_id]
+        wait = account["refreshed"] + self.refresh_interval - self.clock()
+        available = account["bucket"].time_until_available()
+        if available is not None:
+            wait = min(wait, available)
+        self.deferred += 1
+        heapq.heappush(self._queue, (self.clock() + max(wait, 1.0), order, account_id, post))
+
+    def run(self):
+        """Send queued posts as they become due until the queue is empty."""
+        results = []
+        while self._queue:
+            results.extend(self.run_pending())
+            wait = self.next_due()
+            if wait:
+                self.sleep(wait)
+        return results
@@ -0,0 +1,195 @@
+"""Production server: pre-forked gevent workers sharing one copy of the model.
+
+The master loads the caption model once, moves its weights into shared
+memory and forks --workers processes that all accept on the same listening
+socket. Each worker limits torch to its share of the CPU cores so the
+workers do not oversubscribe them.
+
+A POST to /reload (or SIGHUP to the master) reloads the model in the master,
+shares the new weights and replaces every worker with a fresh fork, so all
+workers switch to the new checkpoints and still share one copy of them.
+Old workers finish the requests they are serving before they exit.
+
+    python serve.py --workers 4 --port 8000 [model options from inference.py]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import os
+import select
+import signal
+import json
+import socket
+import sys
+import tempfile
+
+import gevent
+import torch
+from gevent.pywsgi import WSGIServer
+
+
+def share_model(model):
+    """Move the model weights into shared memory before forking."""
+    for module in (model.encoder, model.decoder):
+        try:
+            module.share_memory()
+        except (RuntimeError, NotImplementedError):
+            # Packed int8 weights cannot be moved; they stay copy-on-write.
+            pass
+
+
+def run_worker(app, listener, num_threads):
+    """Serve requests on the inherited socket until told to stop."""
+    torch.set_num_threads(num_threads)
+    # Drop the master's handlers; reloads are the master's job.
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    server = WSGIServer(listener, app, log=None)
+    gevent.signal_handler(signal.SIGTERM, server.stop, 5)
+    server.serve_forever()
+
+
+def spawn_worker(app, listener, num_threads):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(app, listener, num_threads)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def reload_requester(master_pid, path):
+    """RELOAD_HANDLER for app.py: pass the request on to the master."""
+
+    def request_reload(overrides):
+        overrides = {key: value for key, value in overrides.items() if value is not None}
+        with open(path + ".tmp", "w") as f:
+            json.dump(overrides, f)
+        os.replace(path + ".tmp", path)
+        os.kill(master_pid, signal.SIGHUP)
+        return {"status": "reloading"}
+
+    return request_reload
+
+
+def read_reload_request(path):
+    try:
+        with open(path) as f:
+            overrides = json.load(f)
+    except FileNotFoundError:
+        return {}
+    os.remove(path)
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers", type=int, default=2, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="torch threads per worker (default: cores / workers)",
+    )
+    args, _ = parser.parse_known_args()
+    num_threads = args.threads_per_worker or max(
+        1, (os.cpu_count() or 1) // args.workers
+    )
+
+    # Load on a single thread: workers must not inherit a busy OpenMP pool.
+    torch.set_num_threads(1)
+    from app import app, registry
+
+    share_model(registry.get())
+    reload_path = os.path.join(tempfile.gettempdir(), "serve-reload-{}.json".format(os.getpid()))
+    app.config["RELOAD_HANDLER"] = reload_requester(os.getpid(), reload_path)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(1024)
+
+    workers = set(spawn_worker(app, listener, num_threads) for _ in range(args.workers))
+    print(
+        "Serving on {}:{} with {} workers x {} threads".format(
+            args.host, args.port, args.workers, num_threads
+        )
+    )
+
+    retiring = set()
+
+    def reload():
+        overrides = read_reload_request(reload_path)
+        try:
+            version = registry.reload(**overrides)
+        except Exception as e:
+            print("Reload failed, keeping the current model: {}".format(e))
+            return
+        share_model(registry.get())
+        old = workers - retiring
+        workers.update(spawn_worker(app, listener, num_threads) for _ in range(args.workers))
+        for pid in old:
+            retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+        print("Reloaded model version {}; replacing {} workers".format(version, len(old)))
+
+    # Signal handlers only note the signal and wake the loop below, which
+    # does the actual work: no loading or forking inside a handler.
+    received = []
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+
+    def on_signal(signum, frame):
+        received.append(signum)
+        try:
+            os.write(wakeup_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, on_signal)
+
+    stopping = False
+    while workers:
+        signals = set()
+        while received:
+            signals.add(received.pop())
+        if not stopping and signals & {signal.SIGTERM, signal.SIGINT}:
+            stopping = True
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+        elif not stopping and signal.SIGHUP in signals:
+            # SIGHUPs that arrived during one reload are served by one more.
+            reload()
+
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            if select.select([wakeup_r], [], [], 0.5)[0]:
+                os.read(wakeup_r, 1024)
+            continue
+        if pid not in workers:
+            # Some other child of the master, e.g. a helper subprocess.
+            continue
+        workers.discard(pid)
+        if pid in retiring:
+            # Replaced after a reload.
+            retiring.discard(pid)
+        elif not stopping:
+            # A worker died on its own; replace it.
+            workers.add(spawn_worker(app, listener, num_threads))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
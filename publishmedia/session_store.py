@@ -0,0 +1,108 @@
+"""Reuse instagrapi sessions instead of logging in on every run.
+
+A full cl.login() costs several round trips, sometimes a challenge, and
+repeated logins make Instagram more likely to flag the account. SessionStore
+saves each account's client settings (device, cookies, tokens) as JSON after
+a login and restores them on the next start; ClientPool keeps the logged-in
+clients of the current process so many uploads share one session.
+"""
+import json
+import logging
+import os
+import threading
+
+from instagrapi import Client
+from instagrapi.exceptions import ClientError, ClientLoginRequired, LoginRequired
+
+from publish_content_all_users import login
+
+# Raised by instagrapi when a session stops being accepted in the middle of a run
+LOGIN_ERRORS = (LoginRequired, ClientLoginRequired)
+
+SESSION_DIR = os.environ.get("SESSION_DIR", os.path.join(os.path.dirname(__file__), "sessions"))
+
+
+class SessionStore(object):
+    """One JSON settings file per account under directory."""
+
+    def __init__(self, directory=SESSION_DIR):
+        self.directory = directory
+        self.restored = 0
+        self.logins = 0
+
+    def path(self, username):
+        return os.path.join(self.directory, "{}.json".format(username))
+
+    def save(self, username, cl):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(username)
+        # Write then rename so a crash never leaves half a session behind.
+        # The settings hold the session cookies, so the file is private.
+        os.close(os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+        cl.dump_settings(path + ".tmp")
+        os.chmod(path + ".tmp", 0o600)
+        os.replace(path + ".tmp", path)
+
+    def forget(self, username):
+        if os.path.exists(self.path(username)):
+            os.remove(self.path(username))
+
+    def restore(self, username):
+        """Client with the saved session if it is still accepted, else None."""
+        path = self.path(username)
+        if not os.path.exists(path):
+            return None
+        cl = Client()
+        try:
+            cl.load_settings(path)
+            # One light authenticated request tells us whether the cookies still work.
+            cl.get_timeline_feed()
+        except (ClientError, ValueError, KeyError, json.JSONDecodeError) as e:
+            logging.info("Saved session for %s is no longer valid: %s", username, e)
+            self.forget(username)
+            return None
+        return cl
+
+    def login(self, username=None, password=None):
+        """Logged-in client, restoring the saved session when possible.
+
+        Falls back to a full publish_content_all_users.login() when there is
+        no saved session or it has expired, and saves the new one.
+        """
+        username = username or os.environ.get("USERNAME")
+        cl = self.restore(username)
+        if cl is not None:
+            self.restored += 1
+            return cl
+        cl = login(username, password)
+        self.logins += 1
+        self.save(username, cl)
+        return cl
+
+
+class ClientPool(object):
+    """Logged-in clients shared by every upload of the process.
+
+    get() is safe to call from several threads; each account is logged in
+    at most once, other accounts are not blocked while that happens.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or SessionStore()
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, username, password=None):
+        with self._lock:
+            lock = self._locks.setdefault(username, threading.Lock())
+        with lock:
+            if username not in self._clients:
+                self._clients[username] = self.store.login(username, password)
+            return self._clients[username]
+
+    def discard(self, username):
+        """Drop a client whose session was rejected so the next get() logs in again."""
+        with self._lock:
+            self._clients.pop(username, None)
+        self.store.forget(username)
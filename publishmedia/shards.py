@@ -0,0 +1,121 @@
+import argparse
+import io
+import json
+import os
+import tarfile
+
+from PIL import Image
+
+from caption_store import CaptionStore
+
+
+class ShardIndex(object):
+    """index.json of a shard directory written by write_shards().
+
+    Every shard is a plain tar file of JPEGs named <image number>.jpg, where
+    the number is the image's position in the caption store's paths table.
+    The index lists for each shard the image numbers and the offset and size
+    of each JPEG inside the tar, so a reader streams a shard front to back
+    without parsing tar headers and without a single open() per image.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as f:
+            self.meta = json.load(f)
+        self.shards = self.meta['shards']
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, shard['name'])
+
+    def check_store(self, store):
+        if self.meta['images'] != len(store.paths):
+            raise ValueError("Shards in {} hold {} images, the caption store has {}".format(
+                self.directory, self.meta['images'], len(store.paths)))
+
+    def __len__(self):
+        return len(self.shards)
+
+
+def iter_shard(path, shard, buffer_size=1 << 20):
+    """(image number, JPEG bytes) of one shard, read sequentially."""
+    with open(path, 'rb', buffering=buffer_size) as f:
+        for image, offset, size in zip(shard['images'], shard['offsets'], shard['sizes']):
+            f.seek(offset)
+            yield image, f.read(size)
+
+
+def decode_image(record):
+    return Image.open(io.BytesIO(record)).convert('RGB')
+
+
+def resize_record(path, image_size, quality):
+    """JPEG bytes of the image at path resized to image_size x image_size."""
+    with Image.open(path) as image:
+        image.draft('RGB', (image_size, image_size))
+        image = image.convert('RGB').resize((image_size, image_size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def write_shards(root, store, directory, image_size=256, shard_bytes=256 << 20, quality=90):
+    """Pack the images of a caption store into tar shards of about shard_bytes.
+
+    Args:
+        root: image directory.
+        store: CaptionStore; its paths are packed in order.
+        directory: output directory for the shards and index.json.
+        image_size: side of the stored square images, the training
+            resolution before the random crop.
+        shard_bytes: a new shard is started once a shard is this large.
+        quality: JPEG quality of the re-encoded images.
+    """
+    os.makedirs(directory, exist_ok=True)
+    shards = []
+    tar = None
+    for i, path in enumerate(store.paths):
+        if tar is None or tar.offset >= shard_bytes:
+            if tar is not None:
+                tar.close()
+            name = 'shard-{:05d}.tar'.format(len(shards))
+            tar = tarfile.open(os.path.join(directory, name), 'w', format=tarfile.USTAR_FORMAT)
+            shards.append({'name': name, 'images': [], 'offsets': [], 'sizes': []})
+        record = resize_record(os.path.join(root, path), image_size, quality)
+        info = tarfile.TarInfo('{:08d}.jpg'.format(i))
+        info.size = len(record)
+        # The data follows the member's header.
+        offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+        tar.addfile(info, io.BytesIO(record))
+        shards[-1]['images'].append(i)
+        shards[-1]['offsets'].append(offset)
+        shards[-1]['sizes'].append(len(record))
+        if (i+1) % 1000 == 0:
+            print("[{}/{}] Packed the images.".format(i+1, len(store.paths)))
+    if tar is not None:
+        tar.close()
+
+    # index.json last: its presence marks a complete set of shards
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump({'images': len(store.paths), 'image_size': image_size, 'shards': shards}, f)
+    return ShardIndex(directory)
+
+
+def main(args):
+    store = CaptionStore(args.caption_store)
+    index = write_shards(args.image_dir, store, args.shard_dir, args.image_size,
+                         args.shard_mb << 20, args.quality)
+    print("Saved {} images in {} shards to '{}'".format(
+        index.meta['images'], len(index), args.shard_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=str, default='data/resized2014', help='directory for images')
+    parser.add_argument('--caption_store', type=str, default='data/captions',
+                        help='caption store written by caption_store.py')
+    parser.add_argument('--shard_dir', type=str, default='data/shards', help='where to write the shards')
+    parser.add_argument('--image_size', type=int, default=256, help='side of the stored images')
+    parser.add_argument('--shard_mb', type=int, default=256, help='approximate size of one shard')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the stored images')
+    args = parser.parse_args()
+    main(args)
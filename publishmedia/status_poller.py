@@ -0,0 +1,151 @@
+import random
+import time
+
+from utils import makeApiCall
+
+TERMINAL_STATUSES = ("FINISHED", "PUBLISHED", "ERROR", "EXPIRED")
+
+
+def getMediaObjectsStatus(mediaObjectIds, params):
+    """Check the status of several media objects in one request
+
+    Args:
+            mediaObjectIds: list of media object ids
+            params: dictionary of params
+
+    API Endpoint:
+            https://graph.facebook.com/v13.0/?ids={ig-container-id},{ig-container-id}...&fields=status_code
+
+    Returns:
+            object: data from the endpoint, keyed by media object id
+
+    """
+
+    url = params["endpoint_base"]
+
+    endpointParams = dict()
+    endpointParams["ids"] = ",".join(mediaObjectIds)
+    endpointParams["fields"] = "status_code"
+    endpointParams["access_token"] = params["access_token"]
+
+    return makeApiCall(url, endpointParams, "GET")
+
+
+class PollTimeout(RuntimeError):
+    """Some containers were still processing when the deadline passed."""
+
+    def __init__(self, statuses):
+        pending = [id for id, status in statuses.items() if status not in TERMINAL_STATUSES]
+        super(PollTimeout, self).__init__(
+            "Containers still processing at the deadline: {}".format(", ".join(pending))
+        )
+        self.statuses = statuses
+
+
+class PollError(RuntimeError):
+    """The status request failed, or left out a container that was asked for."""
+
+    def __init__(self, message, statuses):
+        super(PollError, self).__init__(message)
+        self.statuses = statuses
+
+
+def backoffIntervals(initial=0.5, maximum=10.0, factor=2.0, jitter=0.1, rand=random.random):
+    """Yield sleep intervals growing by factor up to maximum, each with +-jitter"""
+
+    interval = initial
+    while True:
+        yield interval * (1.0 + jitter * (2.0 * rand() - 1.0))
+        interval = min(interval * factor, maximum)
+
+
+class StatusPoller(object):
+    """Wait for many media containers at once with exponential backoff.
+
+    Every round asks for the status of all still-pending containers in one
+    request (?ids=a,b,c), drops each container from the round as soon as it
+    reaches a terminal status and calls on_terminal for it right away, so a
+    caller can publish a FINISHED container while the others keep polling.
+    The first checks come quickly because most images finish in well under a
+    second; later checks back off so slow videos do not burn API calls.
+    """
+
+    def __init__(self, params, initial_interval=0.5, max_interval=10.0, backoff=2.0,
+                 jitter=0.1, deadline=300.0, clock=time.monotonic, sleep=time.sleep):
+        """Configure the poller.
+
+        Args:
+            params: credentials from utils.getCreds().
+            initial_interval: seconds before the second status round.
+            max_interval: upper bound for the backoff.
+            backoff: factor the interval grows by after every round.
+            jitter: relative random spread applied to every interval.
+            deadline: seconds after which poll() gives up with PollTimeout.
+            clock: monotonic time source, replaceable in tests.
+            sleep: function used to wait between rounds.
+        """
+        self.params = params
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.clock = clock
+        self.sleep = sleep
+        self.rounds = 0
+
+    def poll(self, containerIds, on_terminal=None):
+        """Poll until every container is terminal or the deadline passes.
+
+        Args:
+            containerIds: ids of the containers to wait for.
+            on_terminal: optional callback(container_id, status_code) run as
+                soon as a container reaches a terminal status.
+
+        Returns:
+            dict: container id -> final status_code.
+
+        Raises:
+            PollError: the API answered with an error, or without the
+                status of a container; retrying would not change that.
+            PollTimeout: containers were still processing at the deadline.
+        """
+        statuses = dict.fromkeys(containerIds, "IN_PROGRESS")
+        pending = list(statuses)
+        intervals = backoffIntervals(
+            self.initial_interval, self.max_interval, self.backoff, self.jitter
+        )
+        give_up_at = self.clock() + self.deadline
+
+        while pending:
+            self.rounds += 1
+            response = getMediaObjectsStatus(pending, self.params)["json_data"]
+            if "error" in response:
+                raise PollError(
+                    "Status request failed: {}".format(
+                        response["error"].get("message", response["error"])
+                    ),
+                    statuses,
+                )
+            missing = [id for id in pending if "status_code" not in response.get(id, {})]
+            if missing:
+                raise PollError("No status returned for {}".format(", ".join(missing)), statuses)
+            still_pending = []
+            for container_id in pending:
+                status = response[container_id]["status_code"]
+                statuses[container_id] = status
+                if status in TERMINAL_STATUSES:
+                    if on_terminal is not None:
+                        on_terminal(container_id, status)
+                else:
+                    still_pending.append(container_id)
+            pending = still_pending
+            if not pending:
+                break
+
+            remaining = give_up_at - self.clock()
+            if remaining <= 0:
+                raise PollTimeout(statuses)
+            self.sleep(min(next(intervals), remaining))
+
+        return statuses
@@ -0,0 +1,52 @@
+"""publishPosts against the fake Graph API.
+
+    python -m pytest test_async_publishing.py
+"""
+import asyncio
+import time
+import unittest
+
+from async_publishing import publishPosts
+from fake_graph_api import FakeGraphAPI
+
+
+class DroppingGraphAPI(FakeGraphAPI):
+    """Fake Graph API whose batched status reads leave every id out."""
+
+    def handle(self, method, path, params):
+        status, payload = super(DroppingGraphAPI, self).handle(method, path, params)
+        if method == "GET" and not path and "ids" in params:
+            payload = {}
+        return status, payload
+
+
+def post(i):
+    return {"media_url": "https://example.com/{}.jpg".format(i), "caption": str(i)}
+
+
+class PublishPostsTest(unittest.TestCase):
+    def publish(self, api, posts, **kwargs):
+        with api:
+            return asyncio.run(
+                publishPosts(posts, api.creds(), initial_interval=0.01, **kwargs)
+            )
+
+    def test_publishes_finished_containers(self):
+        results = self.publish(FakeGraphAPI(processing_time=0.0), [post(0), post(1)])
+        self.assertEqual([result["status"] for result in results], ["PUBLISHED"] * 2)
+
+    def test_containers_still_processing_fail_at_the_timeout(self):
+        start = time.monotonic()
+        results = self.publish(FakeGraphAPI(processing_time=60.0), [post(0)], timeout=0.1)
+        self.assertLess(time.monotonic() - start, 5.0)
+        self.assertEqual(results[0]["status"], "FAILED")
+        self.assertIn("IN_PROGRESS", results[0]["error"])
+
+    def test_missing_status_fails_the_container(self):
+        results = self.publish(DroppingGraphAPI(processing_time=0.0), [post(0)], timeout=60.0)
+        self.assertEqual(results[0]["status"], "FAILED")
+        self.assertIn(results[0]["container_id"], results[0]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""BulkPublisher with a fake instagrapi client.
+
+    python -m pytest test_bulk_publish.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from bulk_publish import BulkPublisher, read_manifest
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.uploads = []
+
+    def photo_upload(self, path, caption):
+        self.uploads.append(path)
+
+
+class ReadManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def manifest(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_bad_rows_fail_without_ending_the_run(self):
+        path = self.manifest("manifest.jsonl", "\n".join([
+            '{"account": "a", "media": "1.jpg"}',
+            '{"account": "a", "media": ',
+            '{"media": "3.jpg"}',
+            '{"account": "a", "media": "4.jpg"}',
+        ]))
+        client = FakeClient()
+        engine = BulkPublisher({"a": "secret"}, workers=2, min_interval=0.0,
+                               login=lambda username, password: client)
+        results = sorted(engine.run(read_manifest(path)), key=lambda result: result["line"])
+
+        self.assertEqual([result["status"] for result in results], ["ok", "failed", "failed", "ok"])
+        self.assertIn("JSONDecodeError", results[1]["error"])
+        self.assertIn("KeyError", results[2]["error"])
+        self.assertEqual(client.uploads, ["1.jpg", "4.jpg"])
+
+    def test_csv_without_account_column(self):
+        path = self.manifest("manifest.csv", "type,media\nphoto,1.jpg\nphoto,2.jpg\n")
+        self.assertEqual(
+            [(item["line"], item["status"]) for item in read_manifest(path)],
+            [(1, "failed"), (2, "failed")],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""PageCache and job_queue.publishToFacebook against the fake Graph API.
+
+    python -m pytest test_fb_pages.py
+"""
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import fb_pages
+from fake_graph_api import FakeGraphAPI
+from fb_pages import PageCache
+from job_queue import JobQueue, runStage
+
+
+class PageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.api = FakeGraphAPI(pages=3).start()
+        self.params = dict(self.api.creds(), media_type="IMAGE", media_url="https://example.com/a.jpg")
+        fb_pages._caches.clear()
+
+    def tearDown(self):
+        fb_pages._caches.clear()
+        self.api.stop()
+        shutil.rmtree(self.directory)
+
+    def posts_per_page(self):
+        return sorted(len(page["posts"]) for page in self.api.pages.values())
+
+    def test_rotated_tokens_are_refetched_and_retried_once(self):
+        cache = PageCache(self.params, path=None)
+        cache.pages()
+        self.api.rotate_page_tokens()
+
+        results = cache.publish(self.params)
+        self.assertTrue(all("error" not in data for data in results.values()))
+        self.assertEqual(cache.fetches, 2)
+        self.assertEqual(self.posts_per_page(), [1, 1, 1])
+
+    def test_follows_the_paging_cursor(self):
+        first = {"data": [{"id": "1", "name": "a", "access_token": "t1"}],
+                 "paging": {"cursors": {"after": "c1"}, "next": "https://example.com/next"}}
+        second = {"data": [{"id": "2", "name": "b", "access_token": "t2"}],
+                  "paging": {"cursors": {"after": "c2"}}}
+        responses = [{"json_data": first}, {"json_data": second}]
+        with mock.patch.object(fb_pages, "get_list_of_all_pages", side_effect=responses) as listed:
+            pages = PageCache(self.params, path=None).pages()
+        self.assertEqual([page["id"] for page in pages], ["1", "2"])
+        self.assertEqual(listed.call_args_list[1][0][2], "c1")
+
+    def test_saved_page_list_is_private(self):
+        path = os.path.join(self.directory, "pages.json")
+        PageCache(self.params, path=path).pages()
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        self.assertEqual(PageCache(self.params, path=path).pages(),
+                         PageCache(self.params, path=None).pages())
+
+    def test_retry_only_posts_to_the_pages_that_failed(self):
+        jobs = JobQueue(os.path.join(self.directory, "jobs.sqlite3"))
+        job_id, _ = jobs.enqueue({"target": "facebook", "media_url": self.params["media_url"]}, "account")
+        failing = sorted(self.api.pages)[0]
+        upload = fb_pages.upload_post_to_fb
+
+        def flaky_upload(params, page_id, token):
+            if page_id == failing:
+                return {"json_data": {"error": {"message": "Temporary failure", "code": 2}}}
+            return upload(params, page_id, token)
+
+        job = jobs.claim("first")[0]
+        with mock.patch.object(fb_pages, "upload_post_to_fb", side_effect=flaky_upload):
+            with self.assertRaises(RuntimeError):
+                runStage(job, self.params, jobs)
+        self.assertEqual(len(jobs.page_posts(job)), 2)
+
+        with mock.patch.object(jobs, "clock", return_value=jobs.clock() + jobs.lease + 1):
+            job = jobs.claim("second")[0]
+        runStage(job, self.params, jobs)
+        self.assertEqual(jobs.get(job_id)["stage"], "published")
+        self.assertEqual(len(jobs.get(job_id)["media_id"].split(",")), 3)
+        self.assertEqual(self.posts_per_page(), [1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""JobQueue resuming after a crash, against the fake Graph API.
+
+    python -m pytest test_job_queue.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import posting_content
+from fake_graph_api import FakeGraphAPI
+from job_queue import CREATED, PUBLISHED, QUEUED, JobQueue, runStage
+
+
+class CarouselResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.jobs = JobQueue(os.path.join(self.directory, "jobs.sqlite3"))
+        self.api = FakeGraphAPI(processing_time=0.0).start()
+        self.params = self.api.creds()
+
+    def tearDown(self):
+        self.api.stop()
+        shutil.rmtree(self.directory)
+
+    def children_created(self):
+        return sum(1 for container in self.api.containers.values()
+                   if container["params"].get("is_carousel_item") == "true")
+
+    def test_retry_reuses_the_children_already_created(self):
+        urls = ["https://example.com/{}.jpg".format(i) for i in range(3)]
+        job_id, _ = self.jobs.enqueue({"media_type": "CAROUSEL", "media_urls": urls}, "account")
+
+        # The worker dies after the children exist but before the carousel does.
+        job = self.jobs.claim("first")[0]
+        with mock.patch.object(posting_content, "createCarouselContainer",
+                               side_effect=RuntimeError("worker died")):
+            with self.assertRaises(RuntimeError):
+                runStage(job, self.params, self.jobs)
+        self.assertEqual(self.jobs.get(job_id)["stage"], QUEUED)
+        self.assertEqual(len(self.jobs.children(job)), 3)
+
+        with mock.patch.object(self.jobs, "clock", return_value=self.jobs.clock() + self.jobs.lease + 1):
+            job = self.jobs.claim("second")[0]
+        runStage(job, self.params, self.jobs)
+        self.assertEqual(self.jobs.get(job_id)["stage"], CREATED)
+        self.assertEqual(self.children_created(), 3)
+
+        while self.jobs.get(job_id)["stage"] != PUBLISHED:
+            job = self.jobs.claim("second")[0]
+            runStage(job, self.params, self.jobs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Pipeline with a stub model: failures are reported and never hang the run.
+
+    python -m pytest test_pipeline.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from PIL import Image
+
+from inference import caption_to_hashtags, get_transform
+from pipeline import Pipeline
+
+
+class StubModel(object):
+    """Captions every image "a cat"; the batches listed in fail_batches raise."""
+
+    def __init__(self, fail_batches=()):
+        self.transform = get_transform()
+        self.fail_batches = set(fail_batches)
+        self.batches = 0
+
+    def caption_images(self, images):
+        self.batches += 1
+        if self.batches in self.fail_batches:
+            raise RuntimeError("out of memory")
+        return ["<start> a cat <end>"] * len(images)
+
+
+class StubRegistry(object):
+    def __init__(self, model=None, error=None):
+        self.model = model
+        self.error = error
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.model
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(12):
+            path = os.path.join(self.directory, "{:02d}.jpg".format(i))
+            Image.new("RGB", (64, 48), (i * 20, 0, 0)).save(path)
+            self.paths.append(path)
+        self.published = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_pipeline(self, registry):
+        def publish(path, caption):
+            self.published.append(path)
+            return "media-" + os.path.basename(path)
+
+        pipeline = Pipeline(registry, publish, batch_size=4, queue_size=2, loaders=2,
+                            publishers=2, caption_prefix="")
+        outcome = []
+        thread = threading.Thread(target=lambda: outcome.append(pipeline.run(self.paths)), daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), "pipeline hung")
+        results, _ = outcome[0]
+        self.assertEqual(sorted(result["path"] for result in results), self.paths)
+        return results
+
+    def test_all_images_published(self):
+        results = self.run_pipeline(StubRegistry(StubModel()))
+        self.assertEqual({result["status"] for result in results}, {"published"})
+        self.assertEqual(results[0]["caption"], caption_to_hashtags("<start> a cat <end>"))
+
+    def test_failed_batch_is_reported_and_the_rest_published(self):
+        results = self.run_pipeline(StubRegistry(StubModel(fail_batches={1})))
+        failed = [result for result in results if result["status"] == "failed"]
+        self.assertTrue(failed)
+        self.assertTrue(all(result["error"] == "caption: out of memory" for result in failed))
+        self.assertEqual(len(self.published), len(self.paths) - len(failed))
+
+    def test_model_that_fails_to_load_fails_every_image(self):
+        results = self.run_pipeline(StubRegistry(error=RuntimeError("checkpoint missing")))
+        self.assertEqual({result["status"] for result in results}, {"failed"})
+        self.assertTrue(all("checkpoint missing" in result["error"] for result in results))
+        self.assertEqual(self.published, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""PublishScheduler against the fake Graph API on a simulated clock.
+
+    python -m pytest test_publish_scheduler.py
+"""
+import unittest
+
+from fake_graph_api import FakeGraphAPI
+from publish_scheduler import DAY, PublishScheduler, QuotaWindow
+
+
+class SimulatedClock(object):
+    """Clock that only moves when sleep() is called."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def post(i):
+    return {"media_url": "https://example.com/{}.jpg".format(i), "caption": str(i)}
+
+
+class QuotaWindowTest(unittest.TestCase):
+    def test_api_usage_is_not_refilled_over_time(self):
+        clock = SimulatedClock()
+        window = QuotaWindow(25, used=24, clock=clock)
+        self.assertTrue(window.try_acquire())
+        self.assertFalse(window.try_acquire())
+        clock.sleep(3456)
+        self.assertFalse(window.try_acquire())
+        # Only our own send leaves the window; the 24 read from the API stay.
+        self.assertEqual(window.time_until_available(), DAY - 3456)
+        clock.sleep(DAY)
+        self.assertEqual(window.remaining(), 1)
+
+    def test_full_window_waits_for_the_next_read(self):
+        window = QuotaWindow(25, used=25, clock=SimulatedClock())
+        self.assertFalse(window.try_acquire())
+        self.assertIsNone(window.time_until_available())
+
+    def test_own_sends_expire_after_the_window(self):
+        clock = SimulatedClock()
+        window = QuotaWindow(2, clock=clock)
+        window.try_acquire()
+        clock.sleep(10)
+        window.try_acquire()
+        self.assertEqual(window.time_until_available(), DAY - 10)
+        clock.sleep(DAY - 10)
+        self.assertEqual(window.remaining(), 1)
+
+    def test_exhaust_fills_the_window(self):
+        window = QuotaWindow(25, used=3, clock=SimulatedClock())
+        window.try_acquire()
+        window.exhaust()
+        self.assertEqual(window.remaining(), 0)
+
+
+class PublishSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = SimulatedClock()
+        self.api = FakeGraphAPI(processing_time=0.0, quota_clock=self.clock)
+        self.api.start()
+        self.params = self.api.creds()
+        self.times = []
+
+    def tearDown(self):
+        self.api.stop()
+
+    def scheduler(self, **kwargs):
+        from publish_scheduler import publishOne
+
+        def publish(post, params):
+            self.times.append(self.clock())
+            return publishOne(post, params)
+
+        return PublishScheduler(publish, clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_posts_over_quota_wait_for_the_window(self):
+        scheduler = self.scheduler()
+        for i in range(27):
+            scheduler.submit(post(i), self.params)
+        results = scheduler.run()
+
+        self.assertEqual([result["status"] for _, result in results], ["PUBLISHED"] * 27)
+        self.assertEqual(len(self.times), 27)
+        self.assertGreaterEqual(self.times[25] - self.times[0], DAY)
+        self.assertEqual(scheduler.pending(), 0)
+
+    def test_quota_error_requeues_the_post(self):
+        scheduler = self.scheduler(refresh_interval=3600.0)
+        scheduler.submit(post(0), self.params)
+        scheduler.run_pending()
+        # Another client uses up the quota after our last read.
+        self.api.publish_times.extend([self.clock()] * 25)
+        scheduler.submit(post(1), self.params)
+
+        self.assertEqual(scheduler.run_pending(), [])
+        self.assertEqual(scheduler.pending(), 1)
+        self.assertEqual(scheduler.deferred, 1)
+
+        results = scheduler.run()
+        self.assertEqual([result["status"] for _, result in results], ["PUBLISHED"])
+        self.assertGreaterEqual(self.times[-1] - self.times[0], DAY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""StatusPoller against the fake Graph API.
+
+    python -m pytest test_status_poller.py
+"""
+import unittest
+from unittest import mock
+
+import status_poller
+from fake_graph_api import FakeGraphAPI
+from posting_content import createMediaObject
+from status_poller import PollError, PollTimeout, StatusPoller
+
+
+class SimulatedClock(object):
+    """Clock that only moves when sleep() is called."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class StatusPollerTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeGraphAPI(processing_time=0.0).start()
+        self.params = self.api.creds()
+        self.clock = SimulatedClock()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def poller(self, **kwargs):
+        return StatusPoller(self.params, clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def container(self):
+        post = dict(self.params, media_type="IMAGE", media_url="https://example.com/a.jpg", caption="")
+        return createMediaObject(post)["json_data"]["id"]
+
+    def test_finished_containers(self):
+        container_id = self.container()
+        finished = []
+        statuses = self.poller().poll([container_id], lambda id, status: finished.append(id))
+        self.assertEqual(statuses, {container_id: "FINISHED"})
+        self.assertEqual(finished, [container_id])
+
+    def test_missing_id_raises_at_once(self):
+        container_id = self.container()
+        poller = self.poller()
+        with self.assertRaises(PollError) as raised:
+            poller.poll([container_id, "17000000000099999"])
+        self.assertIn("17000000000099999", str(raised.exception))
+        self.assertEqual(poller.rounds, 1)
+
+    def test_error_response_raises_at_once(self):
+        response = {"json_data": {"error": {"message": "Invalid OAuth access token", "code": 190}}}
+        poller = self.poller()
+        with mock.patch.object(status_poller, "getMediaObjectsStatus", return_value=response):
+            with self.assertRaises(PollError) as raised:
+                poller.poll([self.container()])
+        self.assertIn("Invalid OAuth access token", str(raised.exception))
+        self.assertEqual(poller.rounds, 1)
+
+    def test_processing_containers_time_out(self):
+        self.api.processing_time = 3600.0
+        with self.assertRaises(PollTimeout):
+            self.poller(deadline=60.0).poll([self.container()])
+        self.assertLessEqual(self.clock.now, 1000.0 + 60.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
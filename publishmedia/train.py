@@ -0,0 +1,166 @@
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+from torch.nn.utils.rnn import pack_padded_sequence
+
+from data_loader import get_feature_loader, get_loader, get_shard_loader
+from model import DEFAULT_BACKBONE, DecoderRNN, EncoderCNN, load_checkpoint, save_checkpoint
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def train_epoch(encoder, decoder, criterion, optimizer, data_loader, precomputed=False,
+                log_step=10, epoch=0, num_epochs=1):
+    """One pass over data_loader; returns (seconds, mean loss).
+
+    With precomputed=True the batches hold pooled trunk features from
+    features.py instead of images, and only the encoder head runs.
+    """
+    total_step = len(data_loader)
+    total_loss = 0.0
+    start = time.perf_counter()
+    for i, (inputs, captions, lengths) in enumerate(data_loader):
+        inputs = inputs.to(device)
+        captions = captions.to(device)
+        targets = pack_padded_sequence(captions, lengths, batch_first=True)[0]
+
+        # Forward, backward and optimize
+        if precomputed:
+            features = encoder.embed_features(inputs)
+        else:
+            features = encoder(inputs)
+        outputs = decoder(features, captions, lengths)
+        loss = criterion(outputs, targets)
+        decoder.zero_grad()
+        encoder.zero_grad()
+        loss.backward()
+        optimizer.step()
+        total_loss += loss.item()
+
+        if log_step and i % log_step == 0:
+            print('Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}, Perplexity: {:5.4f}'
+                  .format(epoch, num_epochs, i, total_step, loss.item(), np.exp(loss.item())))
+    return time.perf_counter() - start, total_loss / max(total_step, 1)
+
+
+def build_models(args, vocab):
+    """Encoder (ImageNet or --encoder_path trunk) and decoder, plus their optimizer."""
+    encoder = EncoderCNN(args.embed_size, args.backbone, pretrained=args.encoder_path is None)
+    if args.encoder_path is not None:
+        state_dict, meta = load_checkpoint(args.encoder_path)
+        if meta['backbone'] != args.backbone:
+            raise ValueError("{} was trained with {}, not {}".format(
+                args.encoder_path, meta['backbone'], args.backbone))
+        encoder.load_state_dict(state_dict)
+    encoder = encoder.to(device)
+    decoder = DecoderRNN(args.embed_size, args.hidden_size, len(vocab), args.num_layers).to(device)
+
+    # The trunk is frozen: only the encoder head and the decoder learn.
+    params = list(decoder.parameters()) + list(encoder.linear.parameters()) + list(encoder.bn.parameters())
+    optimizer = torch.optim.Adam(params, lr=args.learning_rate)
+    return encoder, decoder, optimizer
+
+
+def main(args):
+    # Create model directory
+    if not os.path.exists(args.model_path):
+        os.makedirs(args.model_path)
+
+    # Load vocabulary wrapper
+    with open(args.vocab_path, 'rb') as f:
+        vocab = pickle.load(f)
+
+    if args.features_path is not None:
+        # Decoder-only mode on features precomputed by features.py
+        data_loader = get_feature_loader(args.caption_store, args.features_path, vocab,
+                                         args.batch_size, True, args.num_workers,
+                                         bucketing=args.bucketing)
+    else:
+        # Image preprocessing, normalization for the pretrained resnet
+        transform = transforms.Compose([
+            transforms.RandomCrop(args.crop_size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.485, 0.456, 0.406),
+                                 (0.229, 0.224, 0.225))])
+        if args.shard_dir is not None:
+            data_loader = get_shard_loader(args.shard_dir, args.caption_store, vocab, transform,
+                                           args.batch_size, True, args.num_workers)
+        else:
+            data_loader = get_loader(args.image_dir, args.caption_path, vocab,
+                                     transform, args.batch_size,
+                                     shuffle=True, num_workers=args.num_workers,
+                                     caption_store=args.caption_store,
+                                     bucketing=args.bucketing)
+
+    encoder, decoder, optimizer = build_models(args, vocab)
+    criterion = nn.CrossEntropyLoss()
+    if args.features_path is not None:
+        # The features were extracted with the trunk in eval mode.
+        encoder.resnet.eval()
+
+    for epoch in range(args.num_epochs):
+        if hasattr(data_loader.dataset, 'set_epoch'):
+            data_loader.dataset.set_epoch(epoch)
+        seconds, loss = train_epoch(encoder, decoder, criterion, optimizer, data_loader,
+                                    args.features_path is not None, args.log_step,
+                                    epoch, args.num_epochs)
+        print('Epoch [{}/{}] took {:.1f}s, mean loss {:.4f}'.format(
+            epoch, args.num_epochs, seconds, loss))
+
+        # Save the model checkpoints; the encoder keeps its trunk so
+        # inference can run on images again.
+        save_checkpoint(os.path.join(args.model_path, 'decoder-{}.ckpt'.format(epoch + 1)),
+                        decoder, backbone=args.backbone, embed_size=args.embed_size,
+                        hidden_size=args.hidden_size, num_layers=args.num_layers)
+        save_checkpoint(os.path.join(args.model_path, 'encoder-{}.ckpt'.format(epoch + 1)),
+                        encoder, backbone=args.backbone)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='models/', help='path for saving trained models')
+    parser.add_argument('--crop_size', type=int, default=224, help='size for randomly cropping images')
+    parser.add_argument('--vocab_path', type=str, default='vocab.pkl', help='path for vocabulary wrapper')
+    parser.add_argument('--image_dir', type=str, default='data/resized2014', help='directory for resized images')
+    parser.add_argument('--caption_path', type=str, default='data/train_data.txt',
+                        help='path for train annotation file')
+    parser.add_argument('--caption_store', type=str, default=None,
+                        help='pre-tokenized captions from caption_store.py')
+    parser.add_argument('--features_path', type=str, default=None,
+                        help='train on features from features.py (needs --caption_store)')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='stream the images from shards.py shards (needs --caption_store)')
+    parser.add_argument('--bucketing', action='store_true',
+                        help='batch captions of similar length (needs --caption_store)')
+    parser.add_argument('--encoder_path', type=str, default=None,
+                        help='encoder checkpoint to start from; ImageNet trunk when omitted')
+    parser.add_argument('--log_step', type=int, default=10, help='step size for printing log info')
+
+    # Model parameters
+    parser.add_argument('--backbone', type=str, default=DEFAULT_BACKBONE)
+    parser.add_argument('--embed_size', type=int, default=256, help='dimension of word embedding vectors')
+    parser.add_argument('--hidden_size', type=int, default=512, help='dimension of lstm hidden states')
+    parser.add_argument('--num_layers', type=int, default=2, help='number of layers in lstm')
+
+    parser.add_argument('--num_epochs', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+    args = parser.parse_args()
+    if args.features_path is not None and args.caption_store is None:
+        parser.error('--features_path needs --caption_store')
+    if args.bucketing and args.caption_store is None:
+        parser.error('--bucketing needs --caption_store')
+    if args.shard_dir is not None and args.caption_store is None:
+        parser.error('--shard_dir needs --caption_store')
+    if args.shard_dir is not None and args.bucketing:
+        parser.error('--bucketing does not apply to --shard_dir')
+    print(args)
+    main(args)
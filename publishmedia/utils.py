@@ -1,10 +1,130 @@
 import requests
 import json
 import os
+import threading
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 
+# Graph API allows at most 50 requests in one batch call
+BATCH_LIMIT = 50
+
+# Response headers in which the Graph API reports rate limit usage
+USAGE_HEADERS = ("X-App-Usage", "X-Business-Use-Case-Usage", "X-Ad-Account-Usage")
+
+_session = None
+_session_lock = threading.Lock()
+_timeout = None
+_usage = {"percent": 0, "regain_access_seconds": 0}
+
+
+def configureSession(pool_size=None, timeout=None, retries=None):
+    """(Re)build the shared keep-alive session used by makeApiCall
+
+    Args:
+            pool_size: connections kept open per host (GRAPH_POOL_SIZE, default 10)
+            timeout: seconds before a call gives up (GRAPH_TIMEOUT, default 30)
+            retries: retries on connection errors (GRAPH_RETRIES, default 0)
+
+    Returns:
+            object: the requests.Session
+
+    """
+
+    global _session, _timeout
+    if pool_size is None:
+        pool_size = int(os.environ.get("GRAPH_POOL_SIZE", 10))
+    if timeout is None:
+        timeout = float(os.environ.get("GRAPH_TIMEOUT", 30))
+    if retries is None:
+        retries = int(os.environ.get("GRAPH_RETRIES", 0))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    with _session_lock:
+        old, _session, _timeout = _session, session, timeout
+    if old is not None:
+        old.close()
+    return session
+
+
+def getSession():
+    """Shared session, so Graph API calls reuse their TCP + TLS connections"""
+
+    if _session is None:
+        configureSession()
+    return _session
+
+
+def parseUsageHeaders(headers):
+    """Read the rate limit usage headers of a Graph API response
+
+    Args:
+            headers: response headers (case-insensitive mapping)
+
+    Returns:
+            tuple: (highest usage percentage of any counter, seconds until
+                    access is regained when throttled, else 0)
+
+    """
+
+    percent = 0
+    regain = 0
+    for name in USAGE_HEADERS:
+        value = headers.get(name)
+        if not value:
+            continue
+        try:
+            usage = json.loads(value)
+        except ValueError:
+            continue
+        # X-Business-Use-Case-Usage nests lists of counters per business id
+        counters = []
+        for item in usage.values() if name == "X-Business-Use-Case-Usage" else [usage]:
+            counters.extend(item if isinstance(item, list) else [item])
+        for counter in counters:
+            for key in ("call_count", "total_cputime", "total_time", "acc_id_util_pct"):
+                percent = max(percent, float(counter.get(key) or 0))
+            minutes = counter.get("estimated_time_to_regain_access") or 0
+            regain = max(regain, float(minutes) * 60)
+    return percent, regain
+
+
+def recordUsage(headers):
+    """Remember the rate limit usage reported by the latest response"""
+
+    if any(headers.get(name) for name in USAGE_HEADERS):
+        percent, regain = parseUsageHeaders(headers)
+        _usage["percent"] = percent
+        _usage["regain_access_seconds"] = regain
+
+
+def getUsage():
+    """Latest rate limit usage as {"percent", "regain_access_seconds"}"""
+
+    return dict(_usage)
+
+
+class ApiResponse(dict):
+    """Response dictionary whose *_pretty entries are only built when read"""
+
+    def __missing__(self, key):
+        if key == "endpoint_params_pretty":
+            value = json.dumps(self["endpoint_params"], indent=4)
+        elif key == "json_data_pretty":
+            value = json.dumps(self["json_data"], indent=4)
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
 
 def getCreds():
     """Get creds required for use in the applications
@@ -24,12 +144,14 @@ def getCreds():
     return creds
 
 
-def makeApiCall(url, endpointParams, type):
+def makeApiCall(url, endpointParams, type, pretty=False):
     """Request data from endpoint with params
 
     Args:
             url: string of the url endpoint to make request from
             endpointParams: dictionary keyed by the names of the url parameters
+            type: "POST" or "GET"
+            pretty: build the *_pretty entries right away instead of on first read
 
 
     Returns:
@@ -37,19 +159,77 @@ def makeApiCall(url, endpointParams, type):
 
     """
 
+    session = getSession()
     if type == "POST":
-        if "CAROUSEL" in url:
-            data = requests.post(url)
-        else:
-            data = requests.post(url, endpointParams)
+        data = session.post(url, endpointParams, timeout=_timeout)
     else:
-        data = requests.get(url, endpointParams)
+        data = session.get(url, params=endpointParams, timeout=_timeout)
 
-    response = dict()
+    recordUsage(data.headers)
+
+    response = ApiResponse()
     response["url"] = url
     response["endpoint_params"] = endpointParams
-    response["endpoint_params_pretty"] = json.dumps(endpointParams, indent=4)
+    response["headers"] = data.headers
     response["json_data"] = json.loads(data.content)
-    response["json_data_pretty"] = json.dumps(response["json_data"], indent=4)
+    if pretty:
+        response["endpoint_params_pretty"]
+        response["json_data_pretty"]
 
     return response
+
+
+def makeBatchApiCall(calls, params, pretty=False):
+    """Send several calls in Graph API batch requests of up to 50 calls each
+
+    Args:
+            calls: list of (url, endpointParams, type) tuples, as for makeApiCall
+            params: dictionary of params with graph_domain and access_token
+            pretty: build the *_pretty entries right away
+
+    API Endpoint:
+            https://graph.facebook.com?batch=[{"method":"GET","relative_url":"..."}]&access_token={access-token}
+
+    Returns:
+            list: one makeApiCall style response per call, in order
+
+    """
+
+    responses = []
+    for start in range(0, len(calls), BATCH_LIMIT):
+        batch = []
+        for url, endpointParams, type in calls[start : start + BATCH_LIMIT]:
+            request = {"method": type}
+            relative_url = url[len(params["graph_domain"]) :].lstrip("/")
+            if type == "POST":
+                request["relative_url"] = relative_url
+                request["body"] = urlencode(endpointParams)
+            else:
+                separator = "&" if "?" in relative_url else "?"
+                request["relative_url"] = (
+                    relative_url + separator + urlencode(endpointParams)
+                )
+            batch.append(request)
+
+        endpointParams = dict()
+        endpointParams["batch"] = json.dumps(batch)
+        endpointParams["access_token"] = params["access_token"]
+        batchResponse = makeApiCall(params["graph_domain"], endpointParams, "POST")
+
+        for (url, callParams, type), result in zip(
+            calls[start : start + BATCH_LIMIT], batchResponse["json_data"]
+        ):
+            response = ApiResponse()
+            response["url"] = url
+            response["endpoint_params"] = callParams
+            if result is None:
+                # Graph API returns null for calls that timed out inside the batch
+                response["json_data"] = {"error": {"message": "Batch call timed out"}}
+            else:
+                response["json_data"] = json.loads(result["body"])
+            if pretty:
+                response["endpoint_params_pretty"]
+                response["json_data_pretty"]
+            responses.append(response)
+
+    return responses